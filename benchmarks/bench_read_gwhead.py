@@ -0,0 +1,67 @@
+# Benchmark of head print file parsing engines
+#
+#   python benchmarks/bench_read_gwhead.py [head_file:nlayers | synthetic:nnodes:ntimes ...]
+#
+# Compares the original read_fwf based reader with the 'python' (line by line) and 'numpy'
+# (vectorized) engines of reader.read_gwhead. Defaults to the C2VSimCG and SVSim test files and a
+# synthetic model (see pyiwfm.synthetic), which needs no model data
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+from pyiwfm import reader, synthetic
+
+DEFAULT_FILES = ['tests/data/C2VSim_CG_1921IC_R374_rev/Results/CVGWheadall.out:4',
+                 'data/svsim_beta/Results/SVSim_GW_HeadAll.out:9',
+                 'synthetic:10000:240']
+
+
+def read_gwhead_fwf(gwheadfile, nlayers):
+    '''the read_fwf based reader this benchmark is measured against'''
+    dfh = pd.read_fwf(gwheadfile, skiprows=5, sep=r'\s+', nrows=1)
+    colspecs = [(i * 12 + 22, i * 12 + 34) for i in range(0, len(dfh.columns))]
+    colspecs = [(0, 22)] + colspecs
+    df = pd.read_fwf(gwheadfile, skiprows=6, header=None, sep=r'\s+', colspecs=colspecs)
+    layer_df = {i: df.iloc[i::nlayers] for i in range(nlayers)}
+    idx = pd.to_datetime(layer_df[0].iloc[:, 0].str.split('_', expand=True).iloc[:, 0])
+    idx.name = 'Time'
+    for i in range(nlayers):
+        dfl = layer_df[i].drop(0, axis=1)
+        dfl.columns = dfl.columns.astype('str')
+        layer_df[i] = dfl.dropna(axis=1).astype('float')
+        layer_df[i].index = idx[0:len(layer_df[i])]
+    return layer_df
+
+
+def timeit(func, *args, **kwargs):
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    return time.perf_counter() - start, result
+
+
+def bench(gwheadfile, nlayers):
+    print(f'{gwheadfile} ({nlayers} layers)')
+    elapsed, expected = timeit(read_gwhead_fwf, gwheadfile, nlayers)
+    print(f'  read_fwf      {elapsed:8.2f} s')
+    for engine in reader.GWHEAD_ENGINES:
+        elapsed, result = timeit(reader.read_gwhead, gwheadfile, nlayers, engine=engine)
+        same = all(np.allclose(result[k].loc[:, expected[k].columns].values, expected[k].values,
+                               equal_nan=True) for k in range(nlayers))
+        print(f'  {engine:12s}  {elapsed:8.2f} s  {"matches" if same else "DIFFERS"}')
+
+
+if __name__ == '__main__':
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for arg in sys.argv[1:] or DEFAULT_FILES:
+            if arg.startswith('synthetic:'):
+                _, nnodes, ntimes = arg.split(':')
+                model = synthetic.write_model(tmp_dir, nnodes=int(nnodes), ntimes=int(ntimes))
+                arg = f'{model.head_file}:{model.nlayers}'
+            file, nlayers = arg.rsplit(':', 1)
+            try:
+                bench(file, int(nlayers))
+            except FileNotFoundError:
+                print(f'{file} not found, skipping')
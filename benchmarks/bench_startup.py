@@ -0,0 +1,46 @@
+# Benchmark of the startup time of the library and the command line
+#
+#   python benchmarks/bench_startup.py [repeats]
+#
+# Times fresh interpreters running 'import pyiwfm' and 'pyiwfm --version' and lists the heavy
+# (visualization, interpolation) packages that were imported anyway. Those are imported on first
+# use (see pyiwfm/__init__.py) and none should be listed
+import statistics
+import subprocess
+import sys
+import time
+
+HEAVY_MODULES = ['holoviews', 'panel', 'geoviews', 'datashader', 'cartopy', 'spatialpandas', 'dask',
+                 'matplotlib', 'scipy', 'bokeh', 'PIL', 'requests', 'geopandas', 'fiona']
+COMMANDS = {
+    'import pyiwfm': [sys.executable, '-c', 'import pyiwfm'],
+    'pyiwfm --version': [sys.executable, '-m', 'pyiwfm', '--version'],
+}
+
+
+def heavy_imports(statement='import pyiwfm'):
+    '''
+    The heavy modules imported by statement in a fresh interpreter
+    '''
+    code = (f'import sys; {statement}; '
+            f'print(" ".join(m for m in {HEAVY_MODULES!r} if m in sys.modules))')
+    return subprocess.run([sys.executable, '-c', code], capture_output=True, text=True,
+                          check=True).stdout.split()
+
+
+def timeit(command, repeats):
+    elapsed = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        subprocess.run(command, capture_output=True, check=True)
+        elapsed.append(time.perf_counter() - start)
+    return statistics.median(elapsed), min(elapsed)
+
+
+if __name__ == '__main__':
+    repeats = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    for name, command in COMMANDS.items():
+        median, best = timeit(command, repeats)
+        print(f'  {name:18s}  median {median:6.2f} s  best {best:6.2f} s')
+    heavy = heavy_imports()
+    print(f'  heavy imports       {" ".join(heavy) if heavy else "none"}')
@@ -2,6 +2,7 @@ import panel as pn
 pn.extension()
 import functools
 import asyncio
+from pyiwfm import profiling
 
 def deferred_load(title="Loading data...", template="vanilla"):
     """
@@ -47,7 +48,10 @@ def deferred_load(title="Loading data...", template="vanilla"):
             # Function to load actual component asynchronously
             def load_component():
                 # Get the actual component
-                result = func(*args, **kwargs)
+                with profiling.timed(f'dashboard.{func.__name__}'):
+                    result = func(*args, **kwargs)
+                if profiling.is_enabled():  # PYIWFM_PROFILE=1
+                    profiling.report()
                 
                 # Check if the result is a template (has sidebar and main attributes)
                 if hasattr(result, 'sidebar') and hasattr(result, 'main'):
@@ -4,6 +4,43 @@ except ImportError:
     # If running from source without setuptools_scm installed
     __version__ = "0.0.1+unknown"
 
-from .reader import read_elements, read_gwhead, read_hydrograph, read_nodes, read_stratigraphy, load_data, load_gwh, load_gwh_feather, read_and_cache
-from .obsreader import load_obs_stations, load_and_merge_observations, load_calib_stations, load_calib_measurements, load_gwheads, load_obs_measurements
-from .gwh_obs_interpolater import interpolate_observations_to_mesh, cache_obs_interpolation_feather, load_obs_interpolation_feather, visualize_interpolated_results
+import importlib
+
+from .reader import (read_elements, read_gwhead, read_hydrograph, read_nodes, read_stratigraphy,
+                     load_data, load_gwh, load_gwh_feather, load_gwh_cube, read_and_cache,
+                     gwhead_info, read_gwhyd, load_gwhyd)
+from .ensemble import build_ensemble, load_ensemble
+
+# the observation readers (geopandas, fiona), the interpolation (scipy) and the visualization
+# modules (holoviews, panel, datashader...) take seconds to import, so they are imported on first
+# use
+_LAZY_ATTRIBUTES = {
+    'load_obs_stations': 'obsreader',
+    'load_and_merge_observations': 'obsreader',
+    'load_calib_stations': 'obsreader',
+    'load_calib_measurements': 'obsreader',
+    'load_gwheads': 'obsreader',
+    'load_obs_measurements': 'obsreader',
+    'interpolate_observations_to_mesh': 'gwh_obs_interpolater',
+    'cache_obs_interpolation_feather': 'gwh_obs_interpolater',
+    'load_obs_interpolation_feather': 'gwh_obs_interpolater',
+    'visualize_interpolated_results': 'gwh_obs_interpolater',
+}
+_LAZY_MODULES = ('budget', 'geo', 'gwh_obs_calib_tsplotter', 'gwh_obs_interpolater',
+                 'gwh_obs_tsplotter', 'gwh_tsplotter', 'locator', 'meshcalc', 'obsreader',
+                 'sketch', 'synthetic', 'trimesh_animator')
+
+
+def __getattr__(name):
+    if name in _LAZY_ATTRIBUTES:
+        value = getattr(importlib.import_module(f'.{_LAZY_ATTRIBUTES[name]}', __name__), name)
+    elif name in _LAZY_MODULES:
+        value = importlib.import_module(f'.{name}', __name__)
+    else:
+        raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_LAZY_ATTRIBUTES) | set(_LAZY_MODULES))
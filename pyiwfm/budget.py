@@ -0,0 +1,276 @@
+# IWFM budget and zone budget (HDF5) output
+# A budget file (GW, root zone, stream...) has an 'Attributes' group describing the time steps and
+# the locations (subregions...) and, for each location, a dataset of time steps x budget columns
+# named after it. A zone budget file has, for each layer, a group 'Layer_<k>' of datasets of time
+# steps x elements, one per budget column, that are summed over the elements of each zone.
+#
+# Budget and ZoneBudget read lazily like LazyHeads: budget[location].loc[times, columns] reads only
+# that hyperslab of the dataset. The times are the time stamps of the time steps (date part, as
+# for load_gwh) so budgets and heads share their time axis.
+import re
+from collections import OrderedDict
+from collections.abc import Mapping
+
+import h5py
+import numpy as np
+import pandas as pd
+
+from . import cache
+from .lazy import LazyLayer, _cache_frame, _frames_bytes
+from .reader import water_years
+
+# IWFM time step units to pandas frequencies
+BUDGET_TIME_UNITS = {'MON': 'ME', 'YEAR': 'YE', 'DAY': 'D', 'HOUR': 'h', 'MIN': 'min'}
+BUDGET_AGGREGATES = ('sum', 'mean', 'min', 'max')
+
+
+def _decode(value):
+    if isinstance(value, bytes):
+        return value.decode().strip()
+    if isinstance(value, np.ndarray):
+        if value.dtype.kind in 'SO':
+            return [_decode(v) for v in value.ravel()]
+        return value.item() if value.size == 1 else value
+    return value
+
+
+def _attribute(group, name, default=None):
+    '''
+    Attribute of the group, or dataset in it, decoded to str/number or list of str
+    '''
+    if name in group.attrs:
+        return _decode(group.attrs[name])
+    if name in group:
+        return _decode(group[name][()])
+    return default
+
+
+def budget_times(begin, ntimes, unit):
+    '''
+    Time stamps (date part) of ntimes time steps from begin ('10/31/1973_24:00') every unit
+    ('1MON', '1DAY'...)
+    '''
+    count, name = re.match(r'(\d*)\s*([A-Z]*)', unit.strip().upper()).groups()
+    freq = next((f for key, f in BUDGET_TIME_UNITS.items() if name.startswith(key)), None)
+    if not name or freq is None:
+        raise ValueError(f'unsupported budget time unit {unit}')
+    return pd.DatetimeIndex(pd.date_range(pd.to_datetime(begin.split('_')[0]), periods=ntimes,
+                                          freq=(count or '1') + freq), name='Time')
+
+
+def _read_times(attrs):
+    return budget_times(_attribute(attrs, 'TimeStep%BeginDateAndTime'),
+                        int(_attribute(attrs, 'NTimeSteps')), _attribute(attrs, 'TimeStep%Unit'))
+
+
+def _hyperslab(dataset, rows, cols, transposed):
+    '''
+    dataset[rows, cols] (positional) reading only the bounding box of the rows and cols. The
+    dataset is stored as cols x rows if transposed
+    '''
+    keys, picks = [], []
+    for key in (rows, cols):
+        if isinstance(key, slice) or np.isscalar(key):
+            keys.append(key)
+            picks.append(slice(None) if isinstance(key, slice) else None)
+        else:
+            key = np.asarray(key, dtype='int')
+            lo = key.min() if len(key) else 0
+            keys.append(slice(lo, key.max() + 1 if len(key) else 0))
+            picks.append(key - lo)
+    values = np.asarray(dataset[keys[1], keys[0]] if transposed else dataset[keys[0], keys[1]])
+    if transposed and np.ndim(values) == 2:
+        values = values.T
+    picks = [p for p in picks if p is not None]
+    if len(picks) == 2 and isinstance(picks[0], np.ndarray) and isinstance(picks[1], np.ndarray):
+        return values[np.ix_(picks[0], picks[1])]
+    return values[tuple(picks)]
+
+
+class BudgetLocation(LazyLayer):
+    '''
+    One location (subregion, zone...) of a budget, a lazy dataframe of time x budget column
+    '''
+
+    @property
+    def index(self):
+        return self.heads.times
+
+    @property
+    def columns(self):
+        return self.heads.columns[self.layer]
+
+
+class Budget(Mapping):
+    '''
+    Read only mapping of location name -> BudgetLocation for an IWFM budget HDF5 file.
+
+    Nothing is read until a location is indexed. Locations used as dataframes (to_frame) are kept
+    while under max_bytes, like LazyHeads. Call close() (or use with) to close the file
+    '''
+
+    def __init__(self, file, max_bytes=None):
+        self.file = file
+        self.h5 = h5py.File(file, 'r')
+        self.max_bytes = max_bytes
+        self._frames = OrderedDict()
+        attrs = self.h5['Attributes']
+        self.times = _read_times(attrs)
+        datasets = [name for name in self.h5 if name != 'Attributes'
+                    and isinstance(self.h5[name], h5py.Dataset)]
+        names = _attribute(attrs, 'cLocationNames', datasets)
+        self.locations = [names] if isinstance(names, str) else list(names)
+        self.datasets = [name if name in self.h5 else datasets[i]
+                         for i, name in enumerate(self.locations)]
+        self.columns = {}
+        for i, location in enumerate(self.locations):
+            headers = _attribute(attrs, f'LocationData{i + 1}%cFullColumnHeaders')
+            if headers is None:  # the same columns for all locations
+                headers = _attribute(attrs, 'LocationData1%cFullColumnHeaders')
+            ncols = self._shape(location)[1]
+            if headers is None:
+                headers = [str(c) for c in range(1, ncols + 1)]
+            self.columns[location] = pd.Index(headers[-ncols:])  # without the time column
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.h5.close()
+
+    def __getitem__(self, location):
+        if location not in self.columns:
+            raise KeyError(location)
+        return BudgetLocation(self, location)
+
+    def __iter__(self):
+        return iter(self.locations)
+
+    def __len__(self):
+        return len(self.locations)
+
+    def _dataset(self, location):
+        return self.h5[self.datasets[self.locations.index(location)]]
+
+    def _transposed(self, location):
+        shape = self._dataset(location).shape
+        return shape[0] != len(self.times) and shape[1] == len(self.times)
+
+    def _shape(self, location):
+        shape = self._dataset(location).shape
+        return shape[::-1] if self._transposed(location) else shape
+
+    def read(self, location, rows, cols):
+        '''
+        Values of location at positional rows (times) and cols (budget columns)
+        '''
+        return _hyperslab(self._dataset(location), rows, cols, self._transposed(location))
+
+    def loaded_bytes(self):
+        return _frames_bytes(self._frames)
+
+    def layer_frame(self, location):
+        if location in self._frames:
+            self._frames.move_to_end(location)
+            return self._frames[location]
+        df = pd.DataFrame(self.read(location, slice(None), slice(None)), index=self.times,
+                          columns=self.columns[location])
+        return _cache_frame(self._frames, location, df, self.max_bytes)
+
+    def aggregate(self, resolution='water_year', how='sum', recache=False):
+        '''
+        Dictionary of location -> dataframe of the budget columns aggregated (how) by water year or
+        decade (resolution), each labelled by its last time.
+
+        The aggregates of all locations are computed in one pass and cached with the budget file
+        '''
+        cache_file = cache.cache_filename(self.file, f'.{resolution}_{how}.pik')
+        if recache or not cache.is_cache_valid(cache_file, self.file):
+            cache.remove_manifest(cache_file)
+            groups = _groups(self.times, resolution)
+            aggregates = {location: _aggregate(self.layer_frame(location), groups, how)
+                          for location in self.locations}
+            with cache.atomic_write(cache_file) as fh:
+                pd.to_pickle(aggregates, fh)
+            cache.write_manifest(cache_file, self.file)
+            return aggregates
+        return pd.read_pickle(cache_file)
+
+
+def _groups(times, resolution):
+    wy = water_years(times)
+    if resolution == 'water_year':
+        return wy
+    if resolution == 'decade':
+        return wy // 10 * 10
+    raise ValueError(f'resolution {resolution} is not water_year or decade')
+
+
+def _aggregate(df, groups, how):
+    if how not in BUDGET_AGGREGATES:
+        raise ValueError(f'how {how} is not one of {BUDGET_AGGREGATES}')
+    grouped = df.groupby(groups)
+    result = getattr(grouped, how)()
+    result.index = pd.DatetimeIndex(df.index.to_series().groupby(groups).max().values,
+                                    name=df.index.name)
+    return result
+
+
+def load_budget(file, max_bytes=None):
+    '''
+    Opens an IWFM budget HDF5 file as a Budget (mapping of location -> lazy dataframe)
+    '''
+    return Budget(file, max_bytes=max_bytes)
+
+
+class ZoneBudget(Budget):
+    '''
+    Read only mapping of zone -> BudgetLocation for an IWFM zone budget HDF5 file, the budget
+    columns of the elements in each zone (of layer) summed.
+
+    zones maps element ids (1 based, the order of the elements in the file) to zones, e.g. the
+    subregion column of the elements file. Only the times indexed are read, for all elements
+    '''
+
+    def __init__(self, file, zones, layer=1, max_bytes=None):
+        self.file = file
+        self.h5 = h5py.File(file, 'r')
+        self.max_bytes = max_bytes
+        self._frames = OrderedDict()
+        self.times = _read_times(self.h5['Attributes'])
+        self.group = self.h5[f'Layer_{layer}']
+        self.data_names = list(self.group)
+        zones = pd.Series(zones)
+        self.locations = sorted(zones.unique().tolist())
+        self.element_zone = pd.Index(self.locations).get_indexer(zones.values)
+        self.element_pos = zones.index.values.astype('int') - 1
+        self.columns = {zone: pd.Index(self.data_names) for zone in self.locations}
+
+    def _dataset(self, location):
+        return self.group[self.data_names[0]]
+
+    def read(self, location, rows, cols):
+        zone = self.locations.index(location)
+        names = np.asarray(self.data_names)[cols]
+        transposed = self._transposed(location)
+        values = []
+        for name in np.atleast_1d(names):
+            data = _hyperslab(self.group[name], rows, slice(None), transposed)
+            values.append(np.sum(data[..., self.element_pos[self.element_zone == zone]], axis=-1))
+        values = np.stack(values, axis=-1)
+        return values[..., 0] if np.ndim(names) == 0 else values
+
+    def aggregate(self, resolution='water_year', how='sum', recache=False):
+        # zones are not part of the file, so the aggregates are not cached on disk
+        groups = _groups(self.times, resolution)
+        return {zone: _aggregate(self.layer_frame(zone), groups, how) for zone in self.locations}
+
+
+def load_zone_budget(file, zones, layer=1, max_bytes=None):
+    '''
+    Opens an IWFM zone budget HDF5 file as a ZoneBudget (mapping of zone -> lazy dataframe)
+    '''
+    return ZoneBudget(file, zones, layer=layer, max_bytes=max_bytes)
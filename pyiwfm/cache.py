@@ -0,0 +1,256 @@
+# cache validation
+# A manifest (json) next to each cache file records the fingerprint of the source file it was
+# built from and the parameters used to build it. A cache is only used when both still match.
+#
+# Caches are written next to the source file unless a cache directory is configured (the
+# PYIWFM_CACHE_DIR environment variable or configure), e.g. for read only model archives. Each
+# source file then has an entry directory in it, named by a digest of the source path, holding all
+# its caches. When the total size of the entries is over the budget (PYIWFM_CACHE_MAX_BYTES,
+# e.g. 20G) the least recently used entries are removed. Caches already next to a source file
+# are still used.
+import hashlib
+import json
+import os
+import shutil
+from contextlib import contextmanager
+
+CACHE_DIR_ENV = 'PYIWFM_CACHE_DIR'
+CACHE_MAX_BYTES_ENV = 'PYIWFM_CACHE_MAX_BYTES'
+_SIZE_UNITS = {'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30, 'T': 1 << 40}
+_config = {}
+
+
+def configure(cache_dir=None, max_bytes=None):
+    '''
+    Sets the cache directory and its size budget (bytes or a string like '20G'), overriding the
+    environment variables. None for either resets it to the environment variable
+    '''
+    _config['cache_dir'] = cache_dir
+    _config['max_bytes'] = max_bytes
+
+
+def parse_size(size):
+    '''
+    Number of bytes of size, an int or a string like '500M' or '20G'
+    '''
+    if size is None or isinstance(size, int):
+        return size
+    size = str(size).strip().upper().rstrip('B')
+    if size and size[-1] in _SIZE_UNITS:
+        return int(float(size[:-1]) * _SIZE_UNITS[size[-1]])
+    return int(size)
+
+
+def cache_dir():
+    '''
+    The configured cache directory or None to cache next to the source files
+    '''
+    return _config.get('cache_dir') or os.environ.get(CACHE_DIR_ENV) or None
+
+
+def cache_max_bytes():
+    '''
+    The size budget of the cache directory or None for no limit
+    '''
+    return parse_size(_config.get('max_bytes') or os.environ.get(CACHE_MAX_BYTES_ENV) or None)
+
+
+def entry_dirname(source_file):
+    '''
+    Entry directory of source_file in the cache directory
+    '''
+    key = hashlib.blake2b(os.path.realpath(source_file).encode(), digest_size=16).hexdigest()
+    return os.path.join(cache_dir(), key[:2], key)
+
+
+def cache_filename(source_file, suffix, in_place=False):
+    '''
+    Cache file (suffix e.g. '.cube') of source_file: next to it if no cache directory is
+    configured, in_place or a cache is already there, otherwise in the entry of source_file. The
+    entry directory is only created when the cache is written (see atomic_write)
+    '''
+    local_file = f'{source_file}{suffix}'
+    if in_place or cache_dir() is None or os.path.exists(local_file):
+        return local_file
+    return os.path.join(entry_dirname(source_file), os.path.basename(local_file))
+
+
+def _entry_of(cache_file):
+    '''
+    Entry directory of a cache file in the cache directory, None if it is not in it
+    '''
+    root = cache_dir()
+    if root is None:
+        return None
+    entry = os.path.dirname(os.path.realpath(cache_file))
+    parent = os.path.dirname(os.path.dirname(entry))
+    return entry if parent == os.path.realpath(root) else None
+
+
+def _entry_size(entry):
+    size = 0
+    for dirpath, _, files in os.walk(entry):
+        for f in files:
+            try:
+                size += os.path.getsize(os.path.join(dirpath, f))
+            except OSError:  # removed meanwhile
+                pass
+    return size
+
+
+def cache_entries():
+    '''
+    List of (last used, size, entry directory) of the cache directory, least recently used first
+    '''
+    root = cache_dir()
+    entries = []
+    if root is None or not os.path.isdir(root):
+        return entries
+    for prefix in os.scandir(root):
+        if not prefix.is_dir():
+            continue
+        for entry in os.scandir(prefix.path):
+            if entry.is_dir():
+                entries.append((entry.stat().st_mtime_ns, _entry_size(entry.path), entry.path))
+    return sorted(entries)
+
+
+def evict(max_bytes=None, keep=()):
+    '''
+    Removes the least recently used entries of the cache directory (except those in keep) until
+    their total size is within max_bytes (by default the configured budget). Returns the entries
+    removed
+    '''
+    max_bytes = parse_size(max_bytes) if max_bytes is not None else cache_max_bytes()
+    keep = {os.path.realpath(entry) for entry in keep}
+    entries = cache_entries()
+    total = sum(size for _, size, _ in entries)
+    removed = []
+    for _, size, entry in entries:
+        if max_bytes is None or total <= max_bytes:
+            break
+        if os.path.realpath(entry) in keep:
+            continue
+        # memory maps of removed files stay readable, their space is freed once closed
+        shutil.rmtree(entry, ignore_errors=True)
+        total -= size
+        removed.append(entry)
+    return removed
+
+
+def hash_file(file, blocksize=1 << 20):
+    h = hashlib.blake2b(digest_size=16)
+    with open(file, 'rb') as fh:
+        for block in iter(lambda: fh.read(blocksize), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def source_fingerprint(file, content_hash=False):
+    '''
+    Size and modification time of the file and optionally a hash of its content
+    '''
+    st = os.stat(file)
+    fingerprint = {'size': st.st_size, 'mtime': st.st_mtime_ns}
+    if content_hash:
+        fingerprint['hash'] = hash_file(file)
+    return fingerprint
+
+
+def fingerprint_matches(fingerprint, file):
+    '''
+    True if the file still matches the recorded fingerprint.
+
+    Size must match. A changed modification time is accepted only when a content hash was recorded
+    and the content still hashes the same (e.g. a model directory that was copied or touched)
+    '''
+    if not os.path.exists(file):
+        return False
+    current = source_fingerprint(file)
+    if fingerprint.get('size') != current['size']:
+        return False
+    if fingerprint.get('mtime') == current['mtime']:
+        return True
+    return 'hash' in fingerprint and fingerprint['hash'] == hash_file(file)
+
+
+@contextmanager
+def atomic_write(file):
+    '''
+    Opens a temporary file for binary writing that replaces file only once it is completely written.
+    Processes that have the old file memory mapped keep reading it instead of seeing it truncated.
+    The directory of file (e.g. an entry of the cache directory) is created if needed
+    '''
+    os.makedirs(os.path.dirname(os.path.abspath(file)), exist_ok=True)
+    tmp_file = f'{file}.{os.getpid()}.tmp'
+    try:
+        with open(tmp_file, 'wb') as fh:
+            yield fh
+        os.replace(tmp_file, file)
+    except BaseException:
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+        raise
+
+
+def manifest_filename(cache_file):
+    return f'{cache_file}.json'
+
+
+def read_manifest(cache_file):
+    '''
+    Returns the manifest dictionary or None if missing or unreadable
+    '''
+    try:
+        with open(manifest_filename(cache_file), 'r') as fh:
+            return json.load(fh)
+    except (OSError, ValueError):
+        return None
+
+
+def write_manifest(cache_file, source_file, content_hash=False, source=None, **params):
+    '''
+    Writes the manifest for cache_file. Call this after the cache file is completely written.
+
+    source is the fingerprint of source_file taken before the cache was built (see
+    source_fingerprint), by default it is taken now
+    '''
+    manifest = dict(params)
+    if source is None:
+        source = source_fingerprint(source_file, content_hash)
+    manifest['source'] = source
+    with atomic_write(manifest_filename(cache_file)) as fh:
+        fh.write(json.dumps(manifest).encode())
+    entry = _entry_of(cache_file)
+    if entry is not None:
+        os.utime(entry)
+        evict(keep=(entry,))
+    return manifest
+
+
+def remove_manifest(cache_file):
+    '''
+    Invalidates the cache before it is rewritten
+    '''
+    if os.path.exists(manifest_filename(cache_file)):
+        os.remove(manifest_filename(cache_file))
+
+
+def is_cache_valid(cache_file, source_file, **params):
+    '''
+    True if cache_file exists and its manifest matches the source file fingerprint and the params
+    '''
+    if not os.path.exists(cache_file):
+        return False
+    manifest = read_manifest(cache_file)
+    if manifest is None or 'source' not in manifest:
+        return False
+    for key, value in params.items():
+        if manifest.get(key) != value:
+            return False
+    if not fingerprint_matches(manifest['source'], source_file):
+        return False
+    entry = _entry_of(cache_file)
+    if entry is not None:  # last used, for eviction
+        os.utime(entry)
+    return True
@@ -5,6 +5,8 @@ import pyiwfm
 def serve(app, **kwargs):
     import panel as pn
     pn.extension()
+    if pyiwfm.profiling.is_enabled():  # the loading is done, the server runs until stopped
+        pyiwfm.profiling.report()
     pn.serve(app, **kwargs)
 
 def start_trimesh_animator(args, extra_args):
@@ -14,43 +16,78 @@ def start_trimesh_animator(args, extra_args):
     from pyiwfm import trimesh_animator
     gwa = trimesh_animator.build_gwh_animator(
         args.elements_file, args.nodes_file, args.strat_file,
-        args.head_file, gw_head_file_base=args.head_file_base)
+        args.head_file, gw_head_file_base=args.head_file_base, workers=args.workers,
+        bbox=args.bbox, subregion=args.subregion, node_major=args.node_major)
+    if args.follow:
+        if args.head_file_base:
+            raise ValueError('--follow can not be used with --head-file-base')
+        trimesh_animator.follow_heads(gwa, args.head_file, period=args.follow)
     serve(trimesh_animator.build_panel(gwa))
 
 
+def build_ensemble(args):
+    print('building ensemble store: ', args.store_dir)
+    pyiwfm.build_ensemble(args.store_dir, args.elements_file, args.nodes_file, args.strat_file,
+                          args.head_files, runs=args.runs, workers=args.workers)
+
+
+def build_ensemble_statistics(args):
+    print('computing statistics of ensemble store: ', args.store_dir)
+    ens = pyiwfm.load_ensemble(args.store_dir)
+    files = pyiwfm.ensemble.ensemble_statistics(ens.head_files, ens.grid_data.nlayers, args.prefix,
+                                                quantiles=args.quantiles, workers=args.workers)
+    for name, file in files.items():
+        print(name, file)
+
+
+def start_ensemble_animator(args):
+    print('starting ensemble animator: ', args.store_dir)
+    from pyiwfm import trimesh_animator
+    gwa = trimesh_animator.build_ensemble_animator(args.store_dir, bbox=args.bbox,
+                                                   subregion=args.subregion)
+    serve(trimesh_animator.build_panel(gwa))
+
+
+def write_synthetic_model(args):
+    print('writing synthetic model: ', args.output_dir)
+    from pyiwfm import synthetic
+    model = synthetic.write_model(args.output_dir, nnodes=args.nodes, nlayers=args.layers,
+                                  ntimes=args.timesteps, nstations=args.stations, seed=args.seed)
+    for name, file in zip(model._fields, model[:6]):
+        print(name, file)
+
+
 def start_gwh_obs_nodes(args):
     print('starting ground water head observations vs nodes comparator')
     from pyiwfm import gwh_obs_tsplotter
     gpane = gwh_obs_tsplotter.build_dashboard(
         args.elements_file, args.nodes_file, args.strat_file, args.head_file,
-        args.stations_file, args.measurements_file, distance=1000)
-    import panel as pn
-    pn.extension()
-    pn.serve(gpane)
+        args.stations_file, args.measurements_file, distance=1000, workers=args.workers,
+        node_major=args.node_major)
+    serve(gpane)
 
 
 def start_gwh_calib_obs_nodes(args):
     print('starting groundwater calibration observations vs nodes comparator')
     from . import gwh_obs_calib_tsplotter
     gpane = gwh_obs_calib_tsplotter.build_dashboard(args.elements_file, args.nodes_file, args.strat_file,
-        args.head_file, args.calib_gdb_file, distance=5000)
-    import panel as pn
-    pn.extension()
-    pn.serve(gpane)
+        args.head_file, args.calib_gdb_file, distance=5000, workers=args.workers,
+        node_major=args.node_major)
+    serve(gpane)
 
 
 def build_calib_rmse_map(args):
     print('starting calib rmse map')
     from . import gwh_obs_calib_tsplotter
     dfhyd = pyiwfm.read_hydrograph(args.cvprint_file)
+    gwhyd = pyiwfm.load_gwhyd(args.hydrograph_file, dfhyd) if args.hydrograph_file else None
     plt = gwh_obs_calib_tsplotter.build_calib_plotter(args.elements_file, args.nodes_file, args.strat_file,
-                args.head_file, args.calib_gdb_file)
+                args.head_file, args.calib_gdb_file, workers=args.workers,
+                node_major=args.node_major, gwhyd=gwhyd)
     rmse_map = gwh_obs_calib_tsplotter.build_rmse_map(plt, dfhyd)
     if args.output_file:
         gwh_obs_calib_tsplotter.save_html(rmse_map, args.output_file)
-    import panel as pn
-    pn.extension()
-    pn.serve(rmse_map)
+    serve(rmse_map)
 
 
 def start_gwh_nodes(args):
@@ -58,11 +95,10 @@ def start_gwh_nodes(args):
     from pyiwfm import gwh_tsplotter
     plt = gwh_tsplotter.build_dashboard(
         args.elements_file, args.nodes_file, args.strat_file,
-        args.head_file, gwh_file_base=args.head_file_base)
+        args.head_file, gwh_file_base=args.head_file_base, workers=args.workers,
+        node_major=args.node_major)
     gpane = gwh_tsplotter.build_gwh_ts_pane(plt)
-    import panel as pn
-    pn.extension()
-    pn.serve(gpane)
+    serve(gpane)
 
 
 def start_nodes_gis(args):
@@ -84,7 +120,7 @@ def start_nodes_gis(args):
         print('writing output to ', args.output_dir)
         gnodes.to_file(args.output_dir)
 
-    pn.serve(gpane)
+    serve(gpane)
 
 
 def start_elements_gis(args):
@@ -107,7 +143,23 @@ def start_elements_gis(args):
         print('writing output to ', args.output_dir)
         gel.to_file(args.output_dir)
 
-    pn.serve(gpane)
+    serve(gpane)
+
+
+def interpolate_observations(args):
+    print('interpolating groundwater head observations to mesh nodes: ', args.output_file)
+    from pyiwfm import gwh_obs_interpolater
+    gwh_obs_interpolater.interpolate_observations(args.elements_file, args.nodes_file,
+                                                  args.strat_file, args.stations_file,
+                                                  args.measurements_file, args.output_file)
+
+
+def show_obs_interpolation(args):
+    print('starting interpolated groundwater head observations viewer')
+    from pyiwfm import gwh_obs_interpolater
+    gwh_obs_interpolater.visualize_interpolated_results(args.elements_file, args.nodes_file,
+                                                        args.strat_file, args.interpolated_file,
+                                                        title=args.title)
 
 
 def cli(args=None):
@@ -122,6 +174,16 @@ def cli(args=None):
         help='Show the conda-prefix-replacement version number and exit.',
         version="pyiwfm %s" % __version__,
     )
+    p.add_argument('--cache-dir', type=str, default=None,
+                   help='directory for the caches instead of next to the model files '
+                   '(default $PYIWFM_CACHE_DIR)')
+    p.add_argument('--profile', action='store_true',
+                   help='print the time and memory of the loading stages (or $PYIWFM_PROFILE=1)')
+    p.add_argument('--profile-json', type=str, default=None,
+                   help='also write the loading stages to this json file')
+    p.add_argument('--cache-max-bytes', type=str, default=None,
+                   help='size budget of the cache directory, e.g. 20G, least recently used '
+                   'caches are removed (default $PYIWFM_CACHE_MAX_BYTES)')
 
     sub_p = p.add_subparsers(help='sub-command help')
     # add animator command
@@ -136,6 +198,18 @@ def cli(args=None):
                                  help='path to heads-all.out file')
     parser_animator.add_argument('--head-file-base', type=str, required=False,
                                  help='path to base heads-all.out file to display differences calculated as headfile - headfilebase')
+    parser_animator.add_argument('--node-major', action='store_true',
+                                 help='also cache heads by node for time series')
+    parser_animator.add_argument('--workers', type=int, default=1,
+                                 help='number of processes parsing heads-all.out when caching it')
+    parser_animator.add_argument('--follow', type=float, required=False, metavar='SECONDS',
+                                 help='follow the heads-all.out file of a running simulation, '
+                                 'checking for new timesteps every SECONDS')
+    parser_animator.add_argument('--bbox', type=float, nargs=4, required=False,
+                                 metavar=('XMIN', 'YMIN', 'XMAX', 'YMAX'),
+                                 help='only load the nodes inside this bounding box')
+    parser_animator.add_argument('--subregion', type=int, nargs='+', required=False,
+                                 help='only load the elements of these subregions (elements file)')
     parser_animator.set_defaults(func=start_trimesh_animator)
     # head-obs-nodes
     parser_gwh_obs_nodes = sub_p.add_parser(
@@ -152,6 +226,10 @@ def cli(args=None):
         '--stations-file', type=str, required=True, help='path to groundwater periodic stations file')
     parser_gwh_obs_nodes.add_argument(
         '--measurements-file', type=str, required=True, help='path to groundwater periodic measurements file')
+    parser_gwh_obs_nodes.add_argument('--node-major', action='store_true',
+                                      help='also cache heads by node for time series')
+    parser_gwh_obs_nodes.add_argument('--workers', type=int, default=1,
+                                 help='number of processes parsing heads-all.out when caching it')
     parser_gwh_obs_nodes.set_defaults(func=start_gwh_obs_nodes)
     # calib-head-obs-nodes
     parser_calib_gwh_obs_nodes = sub_p.add_parser(
@@ -166,6 +244,10 @@ def cli(args=None):
                                  help='path to heads-all.out file')
     parser_calib_gwh_obs_nodes.add_argument('--calib-gdb-file', type=str, required=True,
                                  help='path to gdb file')
+    parser_calib_gwh_obs_nodes.add_argument('--node-major', action='store_true',
+                                            help='also cache heads by node for time series')
+    parser_calib_gwh_obs_nodes.add_argument('--workers', type=int, default=1,
+                                 help='number of processes parsing heads-all.out when caching it')
     parser_calib_gwh_obs_nodes.set_defaults(func=start_gwh_calib_obs_nodes)
     # calib-rmse-map
     parser_rmse_map = sub_p.add_parser(
@@ -182,8 +264,15 @@ def cli(args=None):
                                  help='path to gdb file')
     parser_rmse_map.add_argument('--cvprint-file', type=str, required=True,
                                  help='path to cvprint file')
+    parser_rmse_map.add_argument('--hydrograph-file', type=str, required=False,
+                                 help='path to the GW hydrograph output file, the RMSE is then '
+                                 'calculated from the simulated hydrographs of the stations')
     parser_rmse_map.add_argument('--output-file', type=str, required=False,
                                  help='html file to save rmse map to')
+    parser_rmse_map.add_argument('--node-major', action='store_true',
+                                 help='also cache heads by node for time series')
+    parser_rmse_map.add_argument('--workers', type=int, default=1,
+                                 help='number of processes parsing heads-all.out when caching it')
 
     parser_rmse_map.set_defaults(func=build_calib_rmse_map)
     # head-nodes
@@ -199,6 +288,10 @@ def cli(args=None):
                                  help='path to heads-all.out file')
     parser_gwh_nodes.add_argument('--head-file-base', type=str, required=False,
                                  help='path to heads-all.out file to display differences calculated as headfile - headfilebase')
+    parser_gwh_nodes.add_argument('--node-major', action='store_true',
+                                  help='also cache heads by node for time series')
+    parser_gwh_nodes.add_argument('--workers', type=int, default=1,
+                                 help='number of processes parsing heads-all.out when caching it')
     parser_gwh_nodes.set_defaults(func=start_gwh_nodes)
     # nodes-gis
     parser_nodes_gis = sub_p.add_parser(
@@ -219,6 +312,59 @@ def cli(args=None):
                                   help='output directory to write out shapefile information')
     parser_elements_gis.set_defaults(func=start_elements_gis)
     # add gwh-obs-interpolater command
+    # ensemble of runs
+    parser_ensemble = sub_p.add_parser(
+        'build-ensemble', help='store the heads of runs that share a grid (e.g. PEST runs)')
+    parser_ensemble.add_argument('--store-dir', type=str, required=True,
+                                 help='directory of the ensemble store')
+    parser_ensemble.add_argument('--elements-file', type=str,
+                                 required=True, help='path to elements.dat file')
+    parser_ensemble.add_argument('--nodes-file', type=str, required=True,
+                                 help='path to nodes.dat file')
+    parser_ensemble.add_argument('--strat-file', type=str, required=True,
+                                 help='path to stratigraphy.dat file')
+    parser_ensemble.add_argument('--head-files', type=str, nargs='+', required=True,
+                                 help='paths to the heads-all.out files of the runs')
+    parser_ensemble.add_argument('--runs', type=str, nargs='+', required=False,
+                                 help='names of the runs, by default from the head file paths')
+    parser_ensemble.add_argument('--workers', type=int, default=None,
+                                 help='number of processes caching the runs (default all cpus)')
+    parser_ensemble.set_defaults(func=build_ensemble)
+    parser_ensemble_stats = sub_p.add_parser(
+        'ensemble-stats', help='mean, std and quantiles of the heads of an ensemble store, '
+        'written as head files for the trimesh animator')
+    parser_ensemble_stats.add_argument('--store-dir', type=str, required=True,
+                                       help='directory of the ensemble store')
+    parser_ensemble_stats.add_argument('--prefix', type=str, required=True,
+                                       help='path prefix of the statistics head files')
+    parser_ensemble_stats.add_argument('--quantiles', type=float, nargs='+',
+                                       default=[0.1, 0.5, 0.9], help='quantiles (0..1)')
+    parser_ensemble_stats.add_argument('--workers', type=int, default=1,
+                                       help='number of processes reading the runs')
+    parser_ensemble_stats.set_defaults(func=build_ensemble_statistics)
+    parser_ensemble_animator = sub_p.add_parser(
+        'ensemble-animator', help='start trimesh animator for the runs of an ensemble store')
+    parser_ensemble_animator.add_argument('--store-dir', type=str, required=True,
+                                          help='directory of the ensemble store')
+    parser_ensemble_animator.add_argument('--bbox', type=float, nargs=4, required=False,
+                                          metavar=('XMIN', 'YMIN', 'XMAX', 'YMAX'),
+                                          help='only load the nodes inside this bounding box')
+    parser_ensemble_animator.add_argument('--subregion', type=int, nargs='+', required=False,
+                                          help='only load the elements of these subregions')
+    parser_ensemble_animator.set_defaults(func=start_ensemble_animator)
+    parser_synthetic = sub_p.add_parser(
+        'synthetic-model', help='write a synthetic model (grid, heads, observations) of any size')
+    parser_synthetic.add_argument('--output-dir', type=str, required=True,
+                                  help='directory to write the model files to')
+    parser_synthetic.add_argument('--nodes', type=int, default=10000,
+                                  help='number of nodes (at least, the grid is rectangular)')
+    parser_synthetic.add_argument('--layers', type=int, default=4, help='number of layers')
+    parser_synthetic.add_argument('--timesteps', type=int, default=120,
+                                  help='number of monthly timesteps of the heads')
+    parser_synthetic.add_argument('--stations', type=int, default=100,
+                                  help='number of observation stations')
+    parser_synthetic.add_argument('--seed', type=int, default=0, help='random seed')
+    parser_synthetic.set_defaults(func=write_synthetic_model)
     parser_gwh_obs_interpolater = sub_p.add_parser(
         'gwh-obs-interpolater', help='interpolate groundwater head observations to mesh nodes')
     parser_gwh_obs_interpolater.add_argument('--elements-file', type=str,
@@ -233,7 +379,7 @@ def cli(args=None):
                                  help='path to groundwater periodic measurements file')
     parser_gwh_obs_interpolater.add_argument('--output-file', type=str, required=True,
                                  help='path to output file to save interpolated results')
-    parser_gwh_obs_interpolater.set_defaults(func=pyiwfm.gwh_obs_interpolater.interpolate_observations)
+    parser_gwh_obs_interpolater.set_defaults(func=interpolate_observations)
     # add gwh-obs-interpolater-show command
     parser_gwh_obs_interpolater_show = sub_p.add_parser(
         'gwh-obs-interpolater-show', help='show interpolated groundwater head observations')
@@ -248,9 +394,12 @@ def cli(args=None):
                                     required=True, help='path to interpolated output file')
     parser_gwh_obs_interpolater_show.add_argument('--title', type=str, default='Groundwater Head Interpolation',
                                     help='Title for the visualization panel')
-    parser_gwh_obs_interpolater_show.set_defaults(func=pyiwfm.gwh_obs_interpolater.show_obs_interpolation)
+    parser_gwh_obs_interpolater_show.set_defaults(func=show_obs_interpolation)
     # Now call the appropriate response.
     pargs, extra_args = p.parse_known_args(args)
+    pyiwfm.cache.configure(pargs.cache_dir, pargs.cache_max_bytes)
+    if pargs.profile or pargs.profile_json:
+        pyiwfm.profiling.enable(pargs.profile_json)
     
     # Check if the handler function accepts extra_args
     import inspect
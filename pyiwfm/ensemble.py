@@ -0,0 +1,253 @@
+# ensemble of runs (e.g. PEST parameter ensembles) that share one grid
+# Each run keeps its own time major head cube (see reader.cache_gwh_cube), which makes "one run,
+# one frame" a contiguous read. The store adds a node major (layer, node, run, time) copy of all
+# runs so that "all runs, one node" is a contiguous read as well. The manifest records the grid
+# files, the runs and the fingerprints of their head files.
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import ExitStack
+from functools import reduce
+import os
+
+import numpy as np
+import pandas as pd
+
+from . import cache, profiling, reader, sketch
+from .lazy import LazyHeads
+
+EnsembleHeads = namedtuple('EnsembleHeads', ['grid_data', 'runs', 'head_files', 'cubes',
+                                             'node_data', 'times', 'columns'])
+
+
+def ensemble_filename(store_dir):
+    return os.path.join(store_dir, 'nodes.cube')
+
+
+def _run_names(head_files, runs):
+    if runs is None:
+        # the file names or, as PEST runs usually write the same file name, their directories
+        runs = [os.path.splitext(os.path.basename(f))[0] for f in head_files]
+        if len(set(runs)) < len(runs):
+            runs = [os.path.basename(os.path.dirname(os.path.abspath(f))) for f in head_files]
+        if len(set(runs)) < len(runs):
+            runs = [str(i) for i in range(len(head_files))]
+    runs = [str(r) for r in runs]
+    if len(runs) != len(head_files) or len(set(runs)) < len(runs):
+        raise ValueError('runs must be unique names, one for each head file')
+    return runs
+
+
+def _ensure_run_cube(args):
+    head_file, nlayers = args
+    return reader.ensure_gwh_cube(head_file, nlayers).data.shape
+
+
+def _ensure_run_cubes(head_files, nlayers, workers):
+    '''
+    (Re)builds the cubes of the runs as needed, in a pool of workers processes (None for all cpus)
+    '''
+    tasks = [(f, nlayers) for f in head_files]
+    if workers == 1:
+        list(map(_ensure_run_cube, tasks))
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            list(executor.map(_ensure_run_cube, tasks))
+    return _load_run_cubes(head_files)
+
+
+def _load_run_cubes(head_files):
+    cubes = [reader.load_gwh_cube(f) for f in head_files]
+    for f, cube in zip(head_files, cubes):
+        if cube.data.shape[1:] != cubes[0].data.shape[1:] or not cube.times.equals(cubes[0].times):
+            raise ValueError(f'{f} does not have the times and nodes of {head_files[0]}')
+    return cubes
+
+
+@profiling.stage()
+def build_ensemble(store_dir, elements_file, nodes_file, stratigraphy_file, head_files, runs=None,
+                   workers=None, chunk_bytes=reader.GWHEAD_BLOCK_BYTES):
+    '''
+    Builds the ensemble store in store_dir for the head files of runs that share the grid.
+
+    The cube of each run is (re)built as needed in a pool of workers processes (None for all cpus),
+    then the node major copy of all runs is written a chunk of nodes at a time. runs names the runs,
+    by default from the head file names. All runs must have the same times and nodes
+    '''
+    grid_data = reader.load_data(elements_file, nodes_file, stratigraphy_file)
+    runs = _run_names(head_files, runs)
+    head_files = [os.path.abspath(f) for f in head_files]
+    sources = [cache.source_fingerprint(f) for f in head_files]
+    cubes = _ensure_run_cubes(head_files, grid_data.nlayers, workers)
+    ntimes, nlayers, nnodes = cubes[0].data.shape
+    node_file = ensemble_filename(store_dir)
+    os.makedirs(store_dir, exist_ok=True)
+    cache.remove_manifest(node_file)
+    chunk = max(1, chunk_bytes // (max(ntimes, 1) * len(runs) * 4))
+    with cache.atomic_write(node_file) as fh:
+        for k in range(nlayers):
+            for n0 in range(0, nnodes, chunk):
+                # run, time, node -> node, run, time
+                block = np.stack([cube.data[:, k, n0:n0 + chunk] for cube in cubes])
+                np.ascontiguousarray(block.transpose(2, 0, 1)).tofile(fh)
+    cache.write_manifest(node_file, head_files[0], source=sources[0], nlayers=nlayers,
+                         parser_version=reader.GWHEAD_PARSER_VERSION,
+                         shape=[nlayers, nnodes, len(runs), ntimes], dtype='<f4', runs=runs,
+                         head_files=head_files,
+                         sources=sources,
+                         grid=[os.path.abspath(f) for f in (elements_file, nodes_file,
+                                                            stratigraphy_file)])
+    return load_ensemble(store_dir)
+
+
+def is_ensemble_valid(store_dir):
+    '''
+    True if the store exists and none of the head files of its runs changed since it was built
+    '''
+    node_file = ensemble_filename(store_dir)
+    manifest = cache.read_manifest(node_file)
+    if not os.path.exists(node_file) or manifest is None or 'sources' not in manifest:
+        return False
+    if manifest.get('parser_version') != reader.GWHEAD_PARSER_VERSION:
+        return False
+    return all(cache.fingerprint_matches(source, f)
+               for source, f in zip(manifest['sources'], manifest['head_files']))
+
+
+@profiling.stage()
+def load_ensemble(store_dir):
+    '''
+    Opens the ensemble store: the grid is read once and the cubes of the runs and the node major
+    copy are memory mapped
+    '''
+    if not is_ensemble_valid(store_dir):
+        raise ValueError(f'{store_dir} is not a valid ensemble store, build it with build_ensemble')
+    node_file = ensemble_filename(store_dir)
+    manifest = cache.read_manifest(node_file)
+    grid_data = reader.load_data(*manifest['grid'])
+    # run cubes evicted from the cache directory are rebuilt
+    cubes = _ensure_run_cubes(manifest['head_files'], manifest['nlayers'], 1)
+    node_data = np.memmap(node_file, dtype=manifest['dtype'], mode='r',
+                          shape=tuple(manifest['shape']))
+    return EnsembleHeads(grid_data, manifest['runs'], manifest['head_files'], cubes, node_data,
+                         cubes[0].times, cubes[0].columns)
+
+
+def run_heads(ensemble, run, lazy=False):
+    '''
+    Heads of one run like load_gwh: a dictionary of layer dataframes (views of the run cube) or
+    LazyHeads
+    '''
+    cube = ensemble.cubes[ensemble.runs.index(str(run))]
+    return LazyHeads(cube) if lazy else reader.gwh_cube_layers(cube)
+
+
+def run_frame(ensemble, run, time, layer=0):
+    '''
+    Heads of all nodes of layer at time for one run (Series indexed by node)
+    '''
+    cube = ensemble.cubes[ensemble.runs.index(str(run))]
+    return pd.Series(np.array(cube.data[ensemble.times.get_loc(time), layer, :]),
+                     index=cube.columns, name=pd.Timestamp(time))
+
+
+def node_heads(ensemble, node, layer=0):
+    '''
+    Heads of all runs at node (id) in layer, dataframe of time x run
+    '''
+    pos = ensemble.columns.get_loc(str(node))
+    return pd.DataFrame(np.array(ensemble.node_data[layer, pos]).T, index=ensemble.times,
+                        columns=pd.Index(ensemble.runs, name='run'))
+
+
+def statistic_filename(prefix, statistic):
+    return f'{prefix}_{statistic}.out'
+
+
+def _quantile_name(q):
+    return f'p{100 * q:g}'
+
+
+def _write_statistic_source(file, statistic, nruns):
+    '''
+    Head file (header only) that the cube of the statistic is the cache of
+    '''
+    with open(file, 'w') as fh:
+        fh.write('*' * 80 + f'\n*\n*   ENSEMBLE {statistic.upper()} OF {nruns} RUNS\n')
+        fh.write('*   GROUNDWATER HEAD AT ALL NODES\n*\n*   (HEADS ARE IN THE CUBE CACHE)\n')
+
+
+def _partial_statistics(args):
+    '''
+    Moments and quantile sketch of the heads of times t0:t1 and nodes n0:n1 of the runs, reading
+    up to size runs at a time
+    '''
+    head_files, t0, t1, n0, n1, size = args
+    partials = []
+    for i in range(0, len(head_files), size):
+        block = np.stack([reader.load_gwh_cube(f).data[t0:t1, :, n0:n1]
+                          for f in head_files[i:i + size]])
+        partials.append((sketch.moments(block), sketch.quantile_sketch(block, size)))
+    return partials
+
+
+def _merge_partials(partials, size):
+    return reduce(lambda a, b: (sketch.merge_moments(a[0], b[0]),
+                                sketch.merge_sketches(a[1], b[1], size)), partials)
+
+
+@profiling.stage()
+def ensemble_statistics(head_files, nlayers, prefix, quantiles=(0.1, 0.5, 0.9), sketch_size=64,
+                        workers=1, chunk_bytes=reader.GWHEAD_BLOCK_BYTES):
+    '''
+    Mean, standard deviation and quantiles (e.g. p10, p50, p90) of the heads of the runs for each
+    time, layer and node, in one pass over the runs.
+
+    The heads are read a chunk of times and nodes at a time. The runs are split among workers
+    processes (None for all cpus) whose moments and quantile sketches are merged. Quantiles are
+    exact up to sketch_size runs and approximate (sketch_size values per node) for more runs.
+
+    Each statistic is written as the cube cache of a head file (header only) named
+    {prefix}_{statistic}.out, which load_gwh or the trimesh animator open like the heads of a run.
+    Returns a dictionary of statistic name to head file
+    '''
+    head_files = [os.path.abspath(f) for f in head_files]
+    cubes = _ensure_run_cubes(head_files, nlayers, workers)
+    ntimes, nlayers, nnodes = cubes[0].data.shape
+    names = ['mean', 'std'] + [_quantile_name(q) for q in quantiles]
+    files = {name: statistic_filename(prefix, name) for name in names}
+    for name, file in files.items():
+        # the statistics are outputs, not caches, so they stay next to their head file
+        cache.remove_manifest(reader.gwh_cube_filename(file, in_place=True))
+        _write_statistic_source(file, name, len(head_files))
+    # sketch values and their sorted and merged copies dominate memory
+    cells = max(1, chunk_bytes // (sketch_size * 32))
+    nnodes_chunk = max(1, min(nnodes, cells // nlayers))
+    ntimes_chunk = max(1, cells // (nlayers * nnodes_chunk))
+    nparts = max(1, min(len(head_files), workers or os.cpu_count()))
+    parts = [head_files[i::nparts] for i in range(nparts)]
+    with ExitStack() as stack:
+        executor = stack.enter_context(ProcessPoolExecutor(max_workers=workers)) \
+            if nparts > 1 else None
+        fhs = {name: stack.enter_context(
+                   cache.atomic_write(reader.gwh_cube_filename(file, in_place=True)))
+               for name, file in files.items()}
+        for t0 in range(0, ntimes, ntimes_chunk):
+            t1 = min(t0 + ntimes_chunk, ntimes)
+            out = {name: np.empty((t1 - t0, nlayers, nnodes), dtype='<f4') for name in names}
+            tasks = [(part, t0, t1, n0, min(n0 + nnodes_chunk, nnodes), sketch_size)
+                     for n0 in range(0, nnodes, nnodes_chunk) for part in parts]
+            results = list(executor.map(_partial_statistics, tasks) if executor
+                           else map(_partial_statistics, tasks))
+            for i, task in enumerate(tasks[::nparts]):
+                n0, n1 = task[3], task[4]
+                partials = [p for r in results[i * nparts:(i + 1) * nparts] for p in r]
+                m, sk = _merge_partials(partials, sketch_size)
+                out['mean'][:, :, n0:n1] = sketch.moments_mean(m)
+                out['std'][:, :, n0:n1] = sketch.moments_std(m)
+                for q, values in zip(quantiles, sketch.sketch_quantiles(sk, quantiles)):
+                    out[_quantile_name(q)][:, :, n0:n1] = values
+            for name in names:
+                out[name].tofile(fhs[name])
+    for file in files.values():
+        reader.write_gwh_cube_manifest(file, nlayers, cubes[0].times, nnodes)
+    return files
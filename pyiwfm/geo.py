@@ -1,97 +1,174 @@
 # gis information
-import math
 import numpy as np
+import pandas as pd
 import geopandas as gpd
 import shapely
+from pyproj import Transformer
 
+from . import cache, profiling
 
-def nodes_gdf(nodes):
-    return gpd.GeoDataFrame(nodes.copy(), crs='EPSG:26910',
-                            geometry=[shapely.geometry.Point(v) for v in nodes.values])
+# the crs of the map tiles
+WEB_MERCATOR = 'EPSG:3857'
 
 
+@profiling.stage()
+def nodes_gdf(nodes, crs='EPSG:26910'):
+    '''
+    Nodes with a point geometry per node, made from all the columns of nodes (x, y and any others
+    as z), all at once
+    '''
+    return gpd.GeoDataFrame(nodes.copy(), crs=crs, geometry=shapely.points(nodes.values))
+
+
+@profiling.stage()
+def project_nodes(nodes, crs='EPSG:26910'):
+    '''
+    Nodes (indexed like nodes) in longitude and latitude (lon, lat) and in Web Mercator, the crs of
+    the map tiles (mercator_x, mercator_y)
+    '''
+    x, y = nodes.x.values, nodes.y.values
+    lon, lat = Transformer.from_crs(crs, 'EPSG:4326', always_xy=True).transform(x, y)
+    mx, my = Transformer.from_crs(crs, WEB_MERCATOR, always_xy=True).transform(x, y)
+    return pd.DataFrame({'lon': lon, 'lat': lat, 'mercator_x': mx, 'mercator_y': my},
+                        index=nodes.index)
+
+
+def projected_nodes_filename(nodes_file):
+    return cache.cache_filename(nodes_file, '.proj.pik')
+
+
+@profiling.stage()
+def load_projected_nodes(nodes_file, crs='EPSG:26910', recache=False):
+    '''
+    project_nodes of the nodes file, cached with it
+    '''
+    from .reader import read_nodes
+    cache_file = projected_nodes_filename(nodes_file)
+    if recache or not cache.is_cache_valid(cache_file, nodes_file, crs=crs):
+        cache.remove_manifest(cache_file)
+        source = cache.source_fingerprint(nodes_file)
+        df = project_nodes(read_nodes(nodes_file), crs)
+        with cache.atomic_write(cache_file) as fh:
+            df.to_pickle(fh)
+        cache.write_manifest(cache_file, nodes_file, source=source, crs=crs)
+        return df
+    return pd.read_pickle(cache_file)
+
+
+def element_rings(nodes, elements):
+    '''
+    (coords, indices) of the rings of the elements for shapely.linearrings: the coordinates (all the
+    columns of nodes) of the non zero nodes of each element in order and the element of each
+    '''
+    ids = elements.iloc[:, 0:4].values
+    mask = ids != 0  # triangles have a 0 4th node
+    positions = nodes.index.get_indexer(ids[mask])
+    if (positions < 0).any():
+        raise KeyError(f'nodes {sorted(set(ids[mask][positions < 0]))} of elements not in nodes')
+    coords = nodes.values[positions]
+    indices = np.repeat(np.arange(len(elements)), mask.sum(axis=1))
+    return coords, indices
+
+
+@profiling.stage()
 def elements_gdf(nodes, elements):
     '''
-    Adds polygons translating the simplex information to build a Polygon (left to right node transversal)
+    Adds polygons translating the simplex information to build a Polygon (left to right node
+    transversal), triangles and quads all at once
+    '''
+    coords, indices = element_rings(nodes, elements)
+    rings = shapely.linearrings(coords, indices=indices)
+    return gpd.GeoDataFrame(elements.copy(), crs='EPSG:26910', geometry=shapely.polygons(rings))
+
+
+def _quad_local(a, b, c, root_sign):
+    '''
+    Local coordinate (-1..1) solving a t^2 + 2 b t + c = 0 (linear where a is 0), NaN where the
+    element is degenerate (a point or line) or invalid
+    '''
+    with np.errstate(divide='ignore', invalid='ignore'):
+        disc = b * b - a * c
+        t = np.where(a == 0.0, np.where(b == 0.0, np.nan, -c / (2.0 * b)),
+                     (-b + root_sign * np.sqrt(np.where(disc < 0.0, np.nan, disc))) / a)
+    return np.clip(t, -1.0, 1.0)
+
+
+def interp_quad_weights(xp, yp, x, y):
+    '''
+    Weights (n x 4) of the nodes of quadrilaterals (x, y of n x 4 nodes, counterclockwise) at the
+    points xp, yp (n), from the bilinear shape functions. NaN for degenerate or invalid elements
+    '''
+    xp, yp = np.asarray(xp, dtype='float'), np.asarray(yp, dtype='float')
+    x, y = np.asarray(x, dtype='float').T, np.asarray(y, dtype='float').T
+    bx = -y[0] + y[1] - y[2] + y[3]
+    by = x[0] - x[1] + x[2] - x[3]
+    a = (y[0] - y[1]) * (x[2] - x[3]) - (y[2] - y[3]) * (x[0] - x[1])
+    b = y[0] * x[3] - y[1] * x[2] + y[2] * x[1] - y[3] * x[0] + bx * xp + by * yp
+    c = (-(y[0] + y[1]) * (x[2] + x[3]) + (y[2] + y[3]) * (x[0] + x[1])
+         + 2.0 * ((y[0] + y[1] - y[2] - y[3]) * xp + (-x[0] - x[1] + x[2] + x[3]) * yp))
+    xt = _quad_local(a, b, c, 1.0)
+    a = (y[1] - y[2]) * (x[0] - x[3]) - (y[0] - y[3]) * (x[1] - x[2])
+    b = y[0] * x[1] - y[1] * x[0] + y[2] * x[3] - y[3] * x[2] + bx * xp + by * yp
+    c = (-(y[0] + y[3]) * (x[1] + x[2]) + (y[1] + y[2]) * (x[0] + x[3])
+         + 2.0 * ((y[0] - y[1] - y[2] + y[3]) * xp + (-x[0] + x[1] + x[2] - x[3]) * yp))
+    yt = _quad_local(a, b, c, -1.0)
+    return 0.25 * np.stack([(1.0 - xt) * (1.0 - yt), (1.0 + xt) * (1.0 - yt),
+                            (1.0 + xt) * (1.0 + yt), (1.0 - xt) * (1.0 + yt)], axis=-1)
+
+
+def interp_tri_weights(xp, yp, x, y):
+    '''
+    Weights (n x 4, the 4th 0) of the nodes of triangles (x, y of n x 3 or more nodes) at the points
+    xp, yp (n), from the linear shape functions. NaN for degenerate (zero area) triangles
     '''
-    geomarr = []
-    for i in range(len(elements)):
-        x = elements.iloc[i, 0:4]
-        p = nodes.loc[x[x != 0], :]
-        geomarr.append(shapely.geometry.Polygon(p.to_records(index=False).tolist()))
-    return gpd.GeoDataFrame(elements.copy(), crs='EPSG:26910', geometry=geomarr)
+    xp, yp = np.asarray(xp, dtype='float'), np.asarray(yp, dtype='float')
+    x, y = np.asarray(x, dtype='float').T, np.asarray(y, dtype='float').T
+    xij, xjk, xki = x[0] - x[1], x[1] - x[2], x[2] - x[0]
+    yij, yjk, yki = y[0] - y[1], y[1] - y[2], y[2] - y[0]
+    det = -xki * yjk + xjk * yki
+    det = np.where(det == 0.0, np.nan, det)
+    xt = np.maximum(0.0, (-x[0] * y[2] + x[2] * y[0] + yki * xp - xki * yp) / det)
+    yt = np.maximum(0.0, (x[0] * y[1] - x[1] * y[0] + yij * xp - xij * yp) / det)
+    return np.stack([1.0 - np.minimum(1.0, xt + yt), xt, yt, np.where(np.isnan(det), np.nan, 0.0)],
+                    axis=-1)
+
+
+def interp_weights(xp, yp, x, y):
+    '''
+    Weights (n x 4) of the nodes of elements at the points xp, yp (n). x, y are the coordinates of
+    the n x 4 nodes of the elements, NaN for the 4th node of triangles (whose 4th weight is 0).
+    NaN weights for degenerate or invalid elements
+    '''
+    x, y = np.atleast_2d(np.asarray(x, dtype='float')), np.atleast_2d(np.asarray(y, dtype='float'))
+    tri = np.isnan(x[:, 3]) | np.isnan(y[:, 3])
+    weights = np.full(x.shape, np.nan)
+    xp, yp = np.broadcast_to(xp, tri.shape), np.broadcast_to(yp, tri.shape)
+    weights[tri] = interp_tri_weights(xp[tri], yp[tri], x[tri], y[tri])
+    weights[~tri] = interp_quad_weights(xp[~tri], yp[~tri], x[~tri], y[~tri])
+    return weights
 
 
 def interp(xp, yp, x, y):
+    '''
+    Weights of the 3 or 4 nodes (x, y) of an element at xp, yp
+    '''
     if len(x) == 3 and len(y) == 3:
         return interp_tri(xp, yp, x, y)
     elif len(x) == 4 and len(y) == 4:
         return interp_quad(xp, yp, x, y)
     else:
-        raise "Can only interpolate to triangular or quadrilateral elements"
+        raise ValueError('Can only interpolate to triangular or quadrilateral elements')
+
+
+def _single(weights):
+    if np.isnan(weights).any():
+        raise ValueError('Element geometry is a point or line or its shape is invalid')
+    return weights
 
 
 def interp_quad(xp, yp, x, y):
-    coeff = np.full((4,), -1, dtype='f')
-    a = (y[0]-y[1])*(x[2]-x[3])-(y[2]-y[3])*(x[0]-x[1])
-    bo = y[0]*x[3]-y[1]*x[2]+y[2]*x[1]-y[3]*x[0]
-    bx = -y[0]+y[1]-y[2]+y[3]
-    by = x[0]-x[1]+x[2]-x[3]
-    b = bo+bx*xp+by*yp
-    co = -(y[0]+y[1])*(x[2]+x[3])+(y[2]+y[3])*(x[0]+x[1])
-    cx = y[0]+y[1]-y[2]-y[3]
-    cy = -x[0]-x[1]+x[2]+x[3]
-    c = co+2.0*(cx*xp+cy*yp)
-    if (a == 0.0):
-        if (b == 0.0):
-            raise('Polygon geometry is a point or line!')
-        xt = -c/(2.0*b)
-    else:
-        xt = b*b-a*c
-        if (xt < 0.0):
-            raise ('Polygon shape is invalid!')
-        xt = (-b+math.sqrt(xt))/a
-    xt = max(-1.0, min(xt, 1.0))
-    a = (y[1]-y[2])*(x[0]-x[3])-(y[0]-y[3])*(x[1]-x[2])
-    bo = y[0]*x[1]-y[1]*x[0]+y[2]*x[3]-y[3]*x[2]
-    bx = -y[0]+y[1]-y[2]+y[3]
-    by = x[0]-x[1]+x[2]-x[3]
-    b = bo+bx*xp+by*yp
-    co = -(y[0]+y[3])*(x[1]+x[2])+(y[1]+y[2])*(x[0]+x[3])
-    cx = y[0]-y[1]-y[2]+y[3]
-    cy = -x[0]+x[1]+x[2]-x[3]
-    c = co+2.0*(cx*xp+cy*yp)
-    if (a == 0.0):
-        if (b == 0.0):
-            raise('Polygon geometry is a point or line!')
-        yt = -c/(2.0*b)
-    else:
-        yt = b*b-a*c
-        if (yt < 0.0):
-            raise('Polygon shape is invalid')
-        yt = (-b-math.sqrt(yt))/a
-    yt = max(-1.0, min(yt, 1.0))
-    coeff[0] = 0.25*(1.0-xt)*(1.0-yt)
-    coeff[1] = 0.25*(1.0+xt)*(1.0-yt)
-    coeff[2] = 0.25*(1.0+xt)*(1.0+yt)
-    coeff[3] = 0.25*(1.0-xt)*(1.0+yt)
-    return coeff
+    return _single(interp_quad_weights([xp], [yp], [x], [y])[0])
 
 
 def interp_tri(xp, yp, x, y):
-    coeff = np.full((3,), -1, dtype='f')
-    # Triangular element
-    xij = x[0]-x[1]
-    xjk = x[1]-x[2]
-    xki = x[2]-x[0]
-    yij = y[0]-y[1]
-    yjk = y[1]-y[2]
-    yki = y[2]-y[0]
-    xt = (-x[0]*y[2]+x[2]*y[0]+yki*xp-xki*yp)/(-xki*yjk+xjk*yki)
-    xt = max(0.0, xt)
-    yt = (x[0]*y[1]-x[1]*y[0]+yij*xp-xij*yp)/(-xki*yjk+xjk*yki)
-    yt = max(0.0, yt)
-    coeff[0] = 1.0-min(1.0, xt+yt)
-    coeff[1] = xt
-    coeff[2] = yt
-    return coeff
+    return _single(interp_tri_weights([xp], [yp], [x], [y])[0, :3])
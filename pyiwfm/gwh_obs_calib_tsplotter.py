@@ -7,12 +7,12 @@ import pandas as pd
 import panel as pn
 from panel.layout import grid
 import param
-# imports for geometry
-import shapely
 from holoviews import opts
 
 import pyiwfm
 import pyiwfm.geo
+import pyiwfm.locator
+from pyiwfm import profiling
 
 pn.extension()
 
@@ -57,39 +57,39 @@ def get_model_obs_data_for_sid(gnodes, gwh, stations, measurements, sid=1, dista
     return model_data, obs_data
 
 
-def get_model_interpolated_obs_data_for_sid(gelements, gwh, stations, measurements, sid=1, layer=0):
+def get_model_interpolated_obs_data_for_sid(locator, gwh, stations, measurements, sid=1, layer=0):
     dfstn = get_obs_for_id(measurements, sid)
-    model_data = get_model_interpolated_data_for_sid(gelements, gwh, stations, sid, layer=layer)
+    model_data = get_model_interpolated_data_for_sid(locator, gwh, stations, sid, layer=layer)
     obs_data = dfstn[['Value_']]
     obs_data.index.name = 'Time'
     return model_data, obs_data
 
 
-def get_model_interpolated_data_for_sid(gelements, gwh, stations, sid, layer=0):
+def get_model_interpolated_data_for_sid(locator, gwh, stations, sid, layer=0):
+    '''
+    Heads interpolated to the station from the nodes of the element it is in, found with the
+    locator (an ElementLocator of the grid, see pyiwfm.locator)
+    '''
     station_selected = stations[stations['Calibration_ID'] == sid]
     station_geometry = station_selected.geometry.values[0]
-    xp, yp = station_geometry.coords.xy
-    xp, yp = xp[0], yp[0]
-    gel = gelements[gelements.contains(station_geometry)]
-    poly_containing = gel.geometry.values[0]
-    npts = len(poly_containing.exterior.coords) - 1
-    nodes_list = gel.iloc[0, 0:npts].astype('str').to_list()
-    node_heads = gwh[layer].loc[:, nodes_list]
-    x, y = poly_containing.exterior.coords.xy
-    x, y = x[:-1], y[:-1]
-    coeffs = pyiwfm.geo.interp(xp, yp, x, y)
-    head_weighted = node_heads * coeffs
-    head_xy = head_weighted.sum(axis=1)
-    return head_xy
-
-
-def calculate_model_metric(gelements, gwh, stations, measurements, dfhyd):
+    operator = pyiwfm.locator.point_operator(locator, station_geometry.x, station_geometry.y,
+                                             layer)
+    if operator.matrix.nnz == 0:
+        raise ValueError(f'station {sid} is not in any element')
+    return pyiwfm.locator.apply_point_operator(operator, gwh)[0]
+
+
+def calculate_model_metric(locator, gwh, stations, measurements, dfhyd):
+    layer = dfhyd[dfhyd['Calibration_ID'] == 3]['iouthl'].values[0] - 1
+    # the heads at all the stations at once, NaN (and so the RMSE) for stations outside the mesh
+    operator = pyiwfm.locator.point_operator(locator, stations.geometry.x.values,
+                                             stations.geometry.y.values, layer)
+    model_heads = pyiwfm.locator.apply_point_operator(operator, gwh)
     rmse_arr = []
-    for sid in stations['Calibration_ID']:
-        layer = dfhyd[dfhyd['Calibration_ID'] == 3]['iouthl'].values[0] - 1
-        model_data, obs_data = get_model_interpolated_obs_data_for_sid(
-            gelements, gwh, stations, measurements, sid, layer)
-        model_data_interp = model_data.resample('D').interpolate()
+    for i, sid in enumerate(stations['Calibration_ID']):
+        obs_data = get_obs_for_id(measurements, sid)[['Value_']]
+        obs_data.index.name = 'Time'
+        model_data_interp = model_heads[i].resample('D').interpolate()
         dfall = pd.concat([model_data_interp, obs_data], axis=1).dropna()
         dfdiff = dfall.iloc[:, :-1].subtract(dfall.iloc[:, -1], axis=0)
         rmse = np.mean((dfdiff**2).mean()**0.5)
@@ -97,17 +97,36 @@ def calculate_model_metric(gelements, gwh, stations, measurements, dfhyd):
     return rmse_arr
 
 
+def calculate_hydrograph_metric(gwhyd, stations, measurements):
+    '''
+    RMSE of the simulated hydrograph of each station (gwhyd keyed by Calibration_ID, see
+    reader.load_gwhyd), NaN for stations without a hydrograph
+    '''
+    rmse_arr = []
+    for sid in stations['Calibration_ID']:
+        if str(sid) not in gwhyd.columns:
+            rmse_arr.append(np.nan)
+            continue
+        model_data_interp = gwhyd[str(sid)].resample('D').interpolate()
+        obs_data = get_obs_for_id(measurements, sid)['Value_']
+        dfall = pd.concat([model_data_interp, obs_data], axis=1).dropna()
+        rmse_arr.append(((dfall.iloc[:, 0] - dfall.iloc[:, 1])**2).mean()**0.5)
+    return rmse_arr
+
+
 class CalibPlotter(param.Parameterized):
     layer = param.ObjectSelector(objects={'1': 0, '2': 1, '3': 2, '4': 3}, default=0)
     distance = param.Number(default=5000, bounds=(0, 10000))
     selected = param.List(default=[0], doc='Selected node indices to display in plot')
 
-    def __init__(self, grid_data, gwh, stations, measurements, **kwargs):
+    def __init__(self, grid_data, gwh, stations, measurements, gwhyd=None, locator=None,
+                 **kwargs):
         super().__init__(**kwargs)
         self.grid_data = grid_data
         self.gwh = gwh
-        self.gnodes = gpd.GeoDataFrame(self.grid_data.nodes.copy(), geometry=[
-            shapely.geometry.Point(v) for v in self.grid_data.nodes.values], crs='EPSG:26910')
+        self.gwhyd = gwhyd  # simulated hydrographs keyed by Calibration_ID
+        self.locator = locator  # of the elements, built when needed if not given
+        self.gnodes = pyiwfm.geo.nodes_gdf(self.grid_data.nodes)
         self.stations = stations
         self.measurements = measurements
 
@@ -148,6 +167,9 @@ class CalibPlotter(param.Parameterized):
         obs_data.index.name = 'Time'
         model_curves = [hv.Curve(model_data.iloc[:, i], group='Model', label=c)
                         for i, c in enumerate(model_data.columns)]
+        if self.gwhyd is not None and str(stn_id) in self.gwhyd.columns:
+            model_curves.insert(0, hv.Curve(self.gwhyd[str(stn_id)], group='Model',
+                                            label='Hydrograph [%s]' % stn_id))
         model_curves.insert(0, hv.Curve(obs_data, group='Observed',
                                         label='Observation [%s]' % dfselected['Calibration_ID']).opts(line_dash='dotted'))
         overlay = hv.Overlay(model_curves).opts(width=600, legend_position='top', legend_cols=True)
@@ -164,33 +186,46 @@ def build_panel(plt, distance):
     return gs
 
 
-def build_calib_plotter(elements_file, nodes_file, stratigraphy_file, gwh_file, calib_gdb_file):
+@profiling.stage()
+def build_calib_plotter(elements_file, nodes_file, stratigraphy_file, gwh_file, calib_gdb_file,
+                        workers=1, lazy=False, node_major=False, gwhyd=None):
     from . import obsreader, reader
     grid_data = reader.load_data(elements_file, nodes_file, stratigraphy_file)
-    gwh = reader.load_gwh(gwh_file, grid_data.nlayers)
+    gwh = reader.load_gwh(gwh_file, grid_data.nlayers, workers=workers, lazy=lazy,
+                          node_major=node_major)
     stations = obsreader.load_calib_stations(calib_gdb_file)
     measurements = obsreader.load_calib_measurements(calib_gdb_file)
-    plt = CalibPlotter(grid_data, gwh, stations, measurements)
+    locator = pyiwfm.locator.load_locator(elements_file, nodes_file)
+    plt = CalibPlotter(grid_data, gwh, stations, measurements, gwhyd=gwhyd, locator=locator)
     return plt
 
 
-def build_dashboard(element_file, node_file, strat_file, gwh_file, calib_gdb_file, distance=5000):
-    plt = build_calib_plotter(element_file, node_file, strat_file, gwh_file, calib_gdb_file)
+@profiling.stage()
+def build_dashboard(element_file, node_file, strat_file, gwh_file, calib_gdb_file, distance=5000,
+                    workers=1, node_major=False):
+    plt = build_calib_plotter(element_file, node_file, strat_file, gwh_file, calib_gdb_file,
+                              workers=workers, node_major=node_major)
     gpane = build_panel(plt, distance)
     return gpane
 
 
+@profiling.stage()
 def build_rmse_map(plt, dfhyd):
-    gelements = pyiwfm.geo.elements_gdf(plt.grid_data.nodes, plt.grid_data.elements)
-    rmse_arr = calculate_model_metric(
-        gelements, plt.gwh, plt.stations, plt.measurements, dfhyd)
+    if plt.gwhyd is not None:  # the simulated hydrographs at the stations
+        rmse_arr = calculate_hydrograph_metric(plt.gwhyd, plt.stations, plt.measurements)
+    else:
+        if plt.locator is None:
+            plt.locator = pyiwfm.locator.build_locator(plt.grid_data.nodes, plt.grid_data.elements)
+        rmse_arr = calculate_model_metric(
+            plt.locator, plt.gwh, plt.stations, plt.measurements, dfhyd)
     plt.stations['rmse'] = rmse_arr
     rmse_map = plt.stations.hvplot(geo=True, crs='EPSG:26910', c='rmse',
                                    s=50, alpha=0.6, cmap='rainbow', clim=(0, 100)).opts(frame_height=500, frame_width=400)
 
     desc = pn.pane.Markdown('''#### Root Mean Squared Error (RMSE) Map
     The map depicts RMSE calculated as the difference between calibration well level 
-    and the interpolated (triangular/quad) value from the element the station is within.
+    and the interpolated (triangular/quad) value from the element the station is within,
+    or the simulated hydrograph of the station when the hydrograph output file is given.
     
     The layer from the model to compare with observed is chosen from CVPrint.dat
 
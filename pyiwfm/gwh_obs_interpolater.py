@@ -3,12 +3,11 @@ import shapely.geometry
 import geopandas as gpd
 import pandas as pd
 import numpy as np
-from pyiwfm.meshcalc import build_least_squares_system
+from pyiwfm import profiling
+from pyiwfm.meshcalc import build_least_squares_system, element_locator
 import os
 from scipy.spatial import Delaunay
 from scipy.interpolate import LinearNDInterpolator, NearestNDInterpolator
-import matplotlib.pyplot as plt
-from matplotlib.tri import Triangulation
 
 def prepare_measurements(measurements, stations, station_id='Calibration_ID', time_col='Date_', value_col='Value_'):
     """
@@ -74,7 +73,7 @@ def get_measurements_at_time(merged_data, date_range_tuple, stations, station_id
     df = pd.merge(stations, gwh)[[station_id, 'geometry', value_col]]
     return df.geometry.x.values, df.geometry.y.values, df[value_col].values
 
-def spatial_interpolation(grid_data, x_obs, y_obs, obs_vals, reg_weight=1e-3):
+def spatial_interpolation(grid_data, x_obs, y_obs, obs_vals, reg_weight=1e-3, locator=None):
     """
     Perform spatial interpolation of observation values to mesh nodes.
     
@@ -88,14 +87,16 @@ def spatial_interpolation(grid_data, x_obs, y_obs, obs_vals, reg_weight=1e-3):
         Array of observation values
     reg_weight : float, optional
         Regularization weight for the least squares system
+    locator : ElementLocator, optional
+        meshcalc.element_locator of the grid, to reuse it for many calls
         
     Returns:
     --------
     numpy.ndarray
         Interpolated values at mesh nodes
     """
-    # Convert elements dataframe to array of triangle vertex indices
-    elements_array = grid_data.elements.values[:, :3].astype(int) - 1  # Convert to 0-based indexing
+    # Convert elements dataframe to array of vertex indices (-1 for the 4th of triangles)
+    elements_array = grid_data.elements.values[:, :4].astype(int) - 1  # Convert to 0-based indexing
     
     # Prepare observation points
     obs_points = np.column_stack((x_obs, y_obs))
@@ -106,7 +107,8 @@ def spatial_interpolation(grid_data, x_obs, y_obs, obs_vals, reg_weight=1e-3):
         elements_array, 
         obs_points, 
         obs_vals,
-        reg_weight=reg_weight
+        reg_weight=reg_weight,
+        locator=locator
     )
     
     return node_values
@@ -138,6 +140,9 @@ def interpolate_obs_to_mesh(grid_data, merged_data, date_range, output_file, reg
     
     # Create DataFrame all at once to avoid fragmentation
     results = pd.DataFrame(node_columns, index=date_range)
+    # the elements containing the observations are looked up in the same locator for every date
+    locator = element_locator(grid_data.nodes.values,
+                              grid_data.elements.values[:, :4].astype(int) - 1)
     
     # Perform interpolation for each date
     for date in date_range:
@@ -154,7 +159,8 @@ def interpolate_obs_to_mesh(grid_data, merged_data, date_range, output_file, reg
         try:
             # Perform spatial interpolation
             print(f"  Interpolating values for date {date}...")
-            node_values = spatial_interpolation(grid_data, x_obs, y_obs, obs_vals, reg_weight)
+            node_values = spatial_interpolation(grid_data, x_obs, y_obs, obs_vals, reg_weight,
+                                                locator=locator)
             print(f"  Interpolation complete for date {date}.")
             # Store results - update entire row at once
             results.loc[date] = dict(zip([str(i) for i in grid_data.nodes.index], node_values))
@@ -337,6 +343,7 @@ def cache_obs_interpolation_feather(file, df):
     # Save to feather file
     df.reset_index().to_feather(file)
     
+@profiling.stage()
 def load_obs_interpolation_feather(file):
     """
     Load observation interpolation results from feather format.
@@ -360,12 +367,10 @@ def load_obs_interpolation_feather(file):
     return df
 
 
-from pyiwfm.trimesh_animator import GWHeadAnimator, convertxy, build_panel
-import panel as pn
-pn.extension()
-
-
+@profiling.stage()
 def build_gwh_animator(elements_file, nodes_file, strat_file, interpolated_file, title=''):
+    import cartopy.crs as ccrs
+    from pyiwfm.trimesh_animator import GWHeadAnimator, mercator_nodes
     # Example of how to load the results
     loaded_results = load_obs_interpolation_feather(interpolated_file)
     loaded_results = loaded_results.ffill().bfill()  # Fill any NaNs
@@ -373,13 +378,13 @@ def build_gwh_animator(elements_file, nodes_file, strat_file, interpolated_file,
     # Load grid data
     grid_data = pyiwfm.load_data(elements_file, nodes_file, strat_file)
     #    
-    dfn0 = convertxy(grid_data.nodes)
+    dfn0 = mercator_nodes(grid_data.nodes, nodes_file)
     dfgw0 = dfgwh[0]
     dfn0['z'] = dfgw0.iloc[0, :].values
     # make animator
     return GWHeadAnimator(grid_data.elements, dfn0, dfgwh, grid_data.stratigraphy, 
                           name='Groundwater Level %s Animator',
-                          title=title)
+                          title=title, crs=ccrs.GOOGLE_MERCATOR)
 
 def visualize_interpolated_results(elements_file, nodes_file, strat_file, interpolated_file, title='Groundwater Level Interpolation'):
     """
@@ -398,6 +403,8 @@ def visualize_interpolated_results(elements_file, nodes_file, strat_file, interp
     title : str, optional
         Title for the visualization panel
     """
+    import panel as pn
+    from pyiwfm.trimesh_animator import build_panel
     gwa = build_gwh_animator(elements_file, nodes_file, strat_file, interpolated_file, title)
     template = build_panel(gwa)
     pn.serve(template, show=True, title='Groundwater Level Interpolation')
@@ -1,4 +1,3 @@
-import geopandas as gpd
 # imports for visuzalization
 import holoviews as hv
 import hvplot.pandas
@@ -6,11 +5,11 @@ import numpy as np
 import pandas as pd
 import panel as pn
 import param
-# imports for geometry
-import shapely
 from holoviews import opts
 from . import obsreader
 import pyiwfm
+import pyiwfm.geo
+from pyiwfm import profiling
 
 pn.extension()
 
@@ -55,14 +54,17 @@ class Plotter(param.Parameterized):
     distance = param.Number(default=5000, bounds=(0, 10000))
     selected = param.List(default=[0], doc='Selected node indices to display in plot')
 
-    def __init__(self, elements_file, nodes_file, stratigraphy_file, gwh_file, stations_file, measurements_file, gwh_file_base=None, **kwargs):
+    def __init__(self, elements_file, nodes_file, stratigraphy_file, gwh_file, stations_file,
+                 measurements_file, gwh_file_base=None, workers=1, lazy=False, node_major=False,
+                 **kwargs):
         super().__init__(**kwargs)
         self.grid_data = pyiwfm.load_data(elements_file, nodes_file, stratigraphy_file)
-        self.gwh = pyiwfm.read_and_cache(gwh_file, self.grid_data.nlayers)
+        self.gwh = pyiwfm.load_gwh(gwh_file, self.grid_data.nlayers, workers=workers, lazy=lazy,
+                                   node_major=node_major)
         if gwh_file_base:
-            self.gwh_base = pyiwfm.read_and_cache(gwh_file_base, self.grid_data.nlayers)
-        self.gnodes = gpd.GeoDataFrame(self.grid_data.nodes.copy(), geometry=[
-            shapely.geometry.Point(v) for v in self.grid_data.nodes.values], crs='EPSG:26910')
+            self.gwh_base = pyiwfm.load_gwh(gwh_file_base, self.grid_data.nlayers, workers=workers,
+                                            lazy=lazy, node_major=node_major)
+        self.gnodes = pyiwfm.geo.nodes_gdf(self.grid_data.nodes)
         self.stations = self.load_obs_stations(stations_file)
         self.measurements = obsreader.load_and_merge_observations(self.stations, measurements_file)
 
@@ -126,7 +128,10 @@ def build_panel(plt, distance):
     return gs
 
 
-def build_dashboard(element_file, node_file, strat_file, gwh_file, stations_file, measurements_file, distance=5000):
-    plt = Plotter(element_file, node_file, strat_file, gwh_file, stations_file, measurements_file)
+@profiling.stage()
+def build_dashboard(element_file, node_file, strat_file, gwh_file, stations_file, measurements_file,
+                    distance=5000, workers=1, node_major=False):
+    plt = Plotter(element_file, node_file, strat_file, gwh_file, stations_file, measurements_file,
+                  workers=workers, node_major=node_major)
     gpane = build_panel(plt, distance)
     return gpane
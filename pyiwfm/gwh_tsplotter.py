@@ -1,11 +1,10 @@
 # Display Groundwater level/depth for selected node
 import pyiwfm
+import pyiwfm.geo
+from pyiwfm import profiling
 import param
 import pandas as pd
 import numpy as np
-# imports for geometry
-import shapely
-import geopandas as gpd
 
 # imports for visuzalization
 import holoviews as hv
@@ -20,19 +19,29 @@ class NodeHeadPlotter(param.Parameterized):
     layer = param.ObjectSelector(objects={'1': 0, '2': 1, '3': 2, '4': 3},
                                  default=0, doc='Groundwater layers with 1 is top unconfined')
     selected = param.List(default=[0], doc='Selected node indices to display in plot')
-
-    def __init__(self, elements_file, nodes_file, stratigraphy_file, gwh_file, gwh_file_base=None, recache=False, **kwargs):
+    difference = param.Boolean(default=True,
+                               doc='With a base run show the difference, else the heads of the run')
+    resolution = param.ObjectSelector(default='month', objects=['month', 'water_year', 'decade'],
+                                      doc='Time resolution, coarser levels are precomputed')
+    aggregate = param.ObjectSelector(default='mean', objects=['mean', 'min', 'max'],
+                                     doc='Aggregate of the heads over the time resolution')
+
+    def __init__(self, elements_file, nodes_file, stratigraphy_file, gwh_file, gwh_file_base=None,
+                 recache=False, workers=1, lazy=False, node_major=False, **kwargs):
         super().__init__(**kwargs)
         self.grid_data = pyiwfm.load_data(elements_file, nodes_file, stratigraphy_file)
-        self.gwh = pyiwfm.read_and_cache(gwh_file, self.grid_data.nlayers, recache=recache)
+        self.gwh = pyiwfm.load_gwh(gwh_file, self.grid_data.nlayers, recache=recache,
+                                   workers=workers, lazy=lazy, node_major=node_major)
         if gwh_file_base:
-            self.gwh_base = pyiwfm.read_and_cache(
-                gwh_file_base, self.grid_data.nlayers, recache=recache)
+            self.gwh_base = pyiwfm.load_gwh(gwh_file_base, self.grid_data.nlayers, recache=recache,
+                                            workers=workers, lazy=lazy, node_major=node_major)
             self.gwh = pyiwfm.reader.diff_heads(self.gwh, self.gwh_base)
         else:
             self.gwh_base = None
-        self.gnodes = gpd.GeoDataFrame(self.grid_data.nodes.copy(), geometry=[
-            shapely.geometry.Point(v) for v in self.grid_data.nodes.values])
+        self.gwh_files = [f for f in [gwh_file, gwh_file_base] if f]
+        self.lazy = lazy
+        self.level_heads = {('month', None): self.gwh}
+        self.gnodes = pyiwfm.geo.nodes_gdf(self.grid_data.nodes, crs=None)
         self.node_map = self.gnodes.hvplot.points(geo=True, crs='EPSG:26910', tiles='CartoLight',
                                                   frame_height=400, frame_width=300,
                                                   fill_alpha=0.9, line_alpha=0.4,
@@ -47,29 +56,49 @@ class NodeHeadPlotter(param.Parameterized):
     def set_selected(self, index):
         self.selected = index
 
-    @param.depends('selected', 'depth', 'layer')
+    def heads_at(self, resolution, how):
+        '''
+        Heads (or their difference to the base run) at the coarsest aggregation level kept for the
+        time resolution and aggregate how
+        '''
+        level = pyiwfm.reader.gwh_level(resolution, how)
+        if level not in self.level_heads:
+            heads = [pyiwfm.load_gwh(f, self.grid_data.nlayers, lazy=self.lazy,
+                                     resolution=level[0], how=level[1]) for f in self.gwh_files]
+            self.level_heads[level] = pyiwfm.reader.diff_heads(*heads) if len(heads) > 1 \
+                else heads[0]
+        return self.level_heads[level]
+
+    @param.depends('selected', 'depth', 'layer', 'difference', 'resolution', 'aggregate')
     def show_ts(self):
         #print('show_ts', self.selected, self.depth, self.layer)
         index = self.selected
         if index is None or len(index) == 0:
             index = self.selected  # show last selected
         self.selected = index
+        show_difference = self.gwh_base is not None and self.difference
+        gwh = self.heads_at(self.resolution, self.aggregate)
+        gwh = gwh if show_difference or self.gwh_base is None else gwh.heads
         if self.depth:
             data = [self.grid_data.stratigraphy.iloc[i, 0] -
-                    self.gwh[self.layer].iloc[:, i] for i in self.selected]
+                    gwh[self.layer].iloc[:, i] for i in self.selected]
         else:
-            data = [self.gwh[self.layer].iloc[:, i] for i in self.selected]
+            data = [gwh[self.layer].iloc[:, i] for i in self.selected]
         els = [d.hvplot.line().opts(framewise=True) for d in data]
-        pretitle = 'Groundwater' if self.gwh_base == None else 'Groundwater difference'
+        pretitle = 'Groundwater difference' if show_difference else 'Groundwater'
         return hv.Overlay(els).opts(framewise=True, title='%s %s (Layer %s)'
                                     % (pretitle, 'Depth' if self.depth else 'Level', self.layer + 1))
 
 
-def build_dashboard(element_file, node_file, strat_file, gwh_file, gwh_file_base=None):
-    plt = NodeHeadPlotter(element_file, node_file, strat_file, gwh_file, gwh_file_base=gwh_file_base)
+@profiling.stage()
+def build_dashboard(element_file, node_file, strat_file, gwh_file, gwh_file_base=None, workers=1,
+                    node_major=False):
+    plt = NodeHeadPlotter(element_file, node_file, strat_file, gwh_file,
+                          gwh_file_base=gwh_file_base, workers=workers, node_major=node_major)
     return plt
 
 
+@profiling.stage()
 def build_gwh_ts_pane(plt):
     description_pane = pn.pane.Markdown('''
     # Depth to or Level of Groundwater head
@@ -93,8 +122,14 @@ def build_gwh_ts_pane(plt):
     Toggle to used display depth to groundwater, i.e. ground surface elevation (GSE) - water level in selected layer
 
     Layer 1-4 can be selected via drop down
+
+    # Resolution and Aggregate
+    Show water year (mean, min or max) or decade (mean) heads instead of the model timesteps
     ''')
-    map_tsplot = pn.Row(plt.node_map, pn.Column(plt.param.depth, plt.param.layer, plt.show_ts))
+    controls = [plt.param.depth, plt.param.layer, plt.param.resolution, plt.param.aggregate]
+    if plt.gwh_base is not None:
+        controls.append(plt.param.difference)
+    map_tsplot = pn.Row(plt.node_map, pn.Column(*controls, plt.show_ts))
     gpane = pn.GridSpec(sizing_mode='scale_both')
     gpane[0, 0:4] = pn.Accordion((('Description (Click to expand/collapse)', description_pane)))
     gpane[1:4, 0:3] = map_tsplot
@@ -0,0 +1,276 @@
+# lazy access to cached heads
+# LazyHeads mimics the dictionary of layer dataframes returned by load_gwh, i.e.
+# gwh[layer].loc[time, nodes], but reads from the memory mapped head cube only what is indexed.
+# DiffHeads does the same for the difference of two runs, subtracting only what is indexed
+from collections import OrderedDict
+from collections.abc import Mapping
+
+import numpy as np
+import pandas as pd
+
+
+def _positions(index, key):
+    '''
+    Translates a .loc key on index into a positional key (int, slice or int array)
+    '''
+    if isinstance(key, slice):
+        if key == slice(None):
+            return key
+        return index.slice_indexer(key.start, key.stop, key.step)
+    if pd.api.types.is_list_like(key):
+        key = np.asarray(key)
+        if key.dtype == bool:
+            return np.flatnonzero(key)
+        pos = index.get_indexer(key)
+        if (pos < 0).any():
+            raise KeyError(f'{list(key[pos < 0])} not in index')
+        return pos
+    return index.get_loc(key)
+
+
+def _iloc_positions(key):
+    if isinstance(key, slice) or np.isscalar(key):
+        return key
+    key = np.asarray(key)
+    return np.flatnonzero(key) if key.dtype == bool else key
+
+
+def _count(key, n):
+    if isinstance(key, slice):
+        return len(range(*key.indices(n)))
+    return 1 if np.isscalar(key) else len(key)
+
+
+def _cache_frame(frames, key, df, max_bytes):
+    '''
+    Adds df to the OrderedDict frames, dropping the least recently used frames while the total size
+    is over max_bytes (None for no limit). The last frame added is always kept
+    '''
+    frames[key] = df
+    if max_bytes is not None:
+        while len(frames) > 1 and _frames_bytes(frames) > max_bytes:
+            frames.popitem(last=False)
+    return df
+
+
+def _frames_bytes(frames):
+    return sum(df.memory_usage(index=False).sum() for df in frames.values())
+
+
+def _take(block, rows, cols):
+    '''
+    block[rows, cols] without numpy broadcasting two index arrays against each other
+    '''
+    if isinstance(rows, np.ndarray) and isinstance(cols, np.ndarray):
+        return np.array(block[np.ix_(rows, cols)])
+    return np.array(block[rows, cols])
+
+
+class _Indexer:
+
+    def __init__(self, layer, positional):
+        self.layer = layer
+        self.positional = positional
+
+    def __getitem__(self, key):
+        rows, cols = key if isinstance(key, tuple) else (key, slice(None))
+        if self.positional:
+            rows, cols = _iloc_positions(rows), _iloc_positions(cols)
+        else:
+            rows, cols = _positions(self.layer.index, rows), _positions(self.layer.columns, cols)
+        return self.layer.take(rows, cols)
+
+
+class LazyLayer:
+    '''
+    One layer of LazyHeads. Supports .loc, .iloc, .index and .columns like the layer dataframe,
+    anything else is delegated to the layer dataframe loaded with to_frame()
+    '''
+
+    def __init__(self, heads, layer):
+        self.heads = heads
+        self.layer = layer
+
+    @property
+    def index(self):
+        return self.heads.cube.times
+
+    @property
+    def columns(self):
+        return self.heads.cube.columns
+
+    @property
+    def shape(self):
+        return (len(self.index), len(self.columns))
+
+    def __len__(self):
+        return len(self.index)
+
+    @property
+    def loc(self):
+        return _Indexer(self, positional=False)
+
+    @property
+    def iloc(self):
+        return _Indexer(self, positional=True)
+
+    def values_at(self, rows, cols):
+        return self.heads.read(self.layer, rows, cols)
+
+    def take(self, rows, cols):
+        values = self.values_at(rows, cols)
+        scalar_row, scalar_col = np.isscalar(rows), np.isscalar(cols)
+        if scalar_row and scalar_col:
+            return values[()]
+        if scalar_row:
+            return pd.Series(values, index=self.columns[cols], name=self.index[rows])
+        # take keeps the frequency of the times like the iloc of a dataframe
+        positional = isinstance(rows, np.ndarray) and rows.dtype.kind in 'iu'
+        index = self.index.take(rows) if positional else self.index[rows]
+        if scalar_col:
+            return pd.Series(values, index=index, name=self.columns[cols])
+        return pd.DataFrame(values, index=index, columns=self.columns[cols])
+
+    def to_frame(self):
+        return self.heads.layer_frame(self.layer)
+
+    def __getattr__(self, name):
+        return getattr(self.to_frame(), name)
+
+
+class LazyHeads(Mapping):
+    '''
+    Read only mapping of layer (0 based) -> LazyLayer over a head cube (see reader.load_gwh_cube).
+
+    Whole layers are only loaded when a LazyLayer is used as a dataframe (to_frame). Loaded layers
+    are kept while their total size stays under max_bytes (None for no limit), least recently used
+    layers are dropped first
+    '''
+
+    def __init__(self, cube, max_bytes=None):
+        self.cube = cube
+        self.max_bytes = max_bytes
+        self._frames = OrderedDict()
+
+    def __getitem__(self, layer):
+        if not isinstance(layer, (int, np.integer)) or not 0 <= layer < len(self):
+            raise KeyError(layer)
+        return LazyLayer(self, int(layer))
+
+    def __iter__(self):
+        return iter(range(len(self)))
+
+    def __len__(self):
+        return self.cube.data.shape[1]
+
+    def read(self, layer, rows, cols):
+        '''
+        Values of layer at positional rows (times) and cols (nodes). Queries with more times than
+        nodes (time series) read from the node major copy if the cube has one, others (frames) from
+        the time major cube
+        '''
+        node_data = self.cube.node_data
+        ntimes, _, nnodes = self.cube.data.shape
+        if node_data is not None and _count(cols, nnodes) < _count(rows, ntimes):
+            return _take(node_data[layer], cols, rows).T
+        return _take(self.cube.data[:, layer, :], rows, cols)
+
+    def loaded_bytes(self):
+        return _frames_bytes(self._frames)
+
+    def layer_frame(self, layer):
+        if layer in self._frames:
+            self._frames.move_to_end(layer)
+            return self._frames[layer]
+        df = pd.DataFrame(np.array(self.cube.data[:, layer, :]), index=self.cube.times,
+                          columns=self.cube.columns)
+        return _cache_frame(self._frames, layer, df, self.max_bytes)
+
+
+def _values_at(layer, rows, cols):
+    '''
+    Values of a layer dataframe or LazyLayer at positional rows and cols
+    '''
+    if isinstance(layer, LazyLayer):
+        return layer.values_at(rows, cols)
+    if isinstance(rows, np.ndarray) and isinstance(cols, np.ndarray):
+        return layer.values[np.ix_(rows, cols)]
+    return np.asarray(layer.iloc[rows, cols])
+
+
+def _as_frame(layer):
+    return layer.to_frame() if isinstance(layer, LazyLayer) else layer
+
+
+def _valid_positions(positions, missing):
+    if np.ndim(positions):
+        return np.where(missing, 0, positions)
+    return 0 if missing else int(positions)
+
+
+class DiffLayer(LazyLayer):
+    '''
+    One layer of DiffHeads, heads - base computed only for the times and nodes that are indexed
+    '''
+
+    @property
+    def index(self):
+        return self.heads.heads[self.layer].index
+
+    @property
+    def columns(self):
+        return self.heads.heads[self.layer].columns
+
+    def values_at(self, rows, cols):
+        diff = self.heads
+        values = _values_at(diff.heads[self.layer], rows, cols)
+        base_rows, base_cols = diff.base_rows[rows], diff.base_cols[cols]
+        missing_rows, missing_cols = base_rows < 0, base_cols < 0
+        base = _values_at(diff.base[self.layer], _valid_positions(base_rows, missing_rows),
+                          _valid_positions(base_cols, missing_cols))
+        if np.ndim(base_rows) and np.ndim(base_cols):
+            missing = missing_rows[:, None] | missing_cols
+        else:
+            missing = missing_rows | missing_cols
+        return np.where(missing, np.nan, values - base)
+
+
+class DiffHeads(Mapping):
+    '''
+    Read only mapping of layer -> DiffLayer, the difference heads - base of two runs (dictionaries
+    of layer dataframes or LazyHeads). Both runs are kept as they are, so either can still be used
+    on its own.
+
+    Times and nodes are those of heads, where base has no matching time or node the difference is
+    NaN. Layers used as dataframes (to_frame) are kept while under max_bytes, like LazyHeads
+    '''
+
+    def __init__(self, heads, base, max_bytes=None):
+        self.heads = heads
+        self.base = base
+        self.max_bytes = max_bytes
+        self._frames = OrderedDict()
+        self.base_rows = base[0].index.get_indexer(heads[0].index)
+        self.base_cols = base[0].columns.get_indexer(heads[0].columns)
+
+    def __getitem__(self, layer):
+        if layer not in self.heads:
+            raise KeyError(layer)
+        return DiffLayer(self, layer)
+
+    def __iter__(self):
+        return iter(self.heads)
+
+    def __len__(self):
+        return len(self.heads)
+
+    def loaded_bytes(self):
+        return _frames_bytes(self._frames)
+
+    def layer_frame(self, layer):
+        if layer in self._frames:
+            self._frames.move_to_end(layer)
+            return self._frames[layer]
+        df = _as_frame(self.heads[layer]) - _as_frame(self.base[layer])
+        df = df.reindex(index=self.heads[layer].index, columns=self.heads[layer].columns)
+        return _cache_frame(self._frames, layer, df, self.max_bytes)
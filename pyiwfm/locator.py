@@ -0,0 +1,221 @@
+# point in element locator
+# Finds the element containing each of many points and the weights of its nodes at the point. The
+# elements are bucketed once into a uniform grid of cells (an element in every cell its bounding box
+# touches), so a point is only tested against the few elements of its cell. Triangles and quads are
+# tested as convex polygons; the weights are their shape functions (see geo.interp_weights).
+#
+# A locator is a namedtuple of arrays, cached (npz with a manifest) with the elements file of the
+# grid by load_locator.
+#
+# The heads at located points (e.g. the model equivalents of observation wells) are, for all times
+# at once, the heads of the nodes times a sparse (points x nodes) matrix of the weights, see
+# point_operator. Only the heads of the nodes of the elements of the points are read.
+from collections import namedtuple
+from collections.abc import Mapping
+
+import numpy as np
+import pandas as pd
+from scipy.sparse import csr_matrix
+
+from . import cache, geo, profiling
+from .ensemble import EnsembleHeads
+from .lazy import LazyHeads, _values_at
+from .reader import GWHeadCube, _node_positions
+
+# element ids, node ids (m x 4, 0 for the 4th of triangles), node coordinates (m x 4, the first
+# repeated for triangles) and the grid of cells, cell c holding the elements (positions)
+# cell_elements[cell_start[c]:cell_start[c + 1]]
+ElementLocator = namedtuple('ElementLocator', ['element_ids', 'vertices', 'x', 'y', 'origin',
+                                               'cell_size', 'shape', 'cell_start', 'cell_elements'])
+# element ids (-1 outside the mesh), node ids (n x 4, 0 for none) and their weights (n x 4, NaN
+# outside the mesh)
+Location = namedtuple('Location', ['elements', 'vertices', 'weights'])
+# sparse matrix (points x nodes) of the weights of the nodes (ids) at the points, the layer (0
+# based) of each point and their labels
+PointOperator = namedtuple('PointOperator', ['matrix', 'nodes', 'layers', 'points'])
+LOCATE_CHUNK = 1 << 20
+
+
+@profiling.stage()
+def build_locator(nodes, elements, cell_size=None):
+    '''
+    ElementLocator of the elements (node ids '1'..'4', 0 for the 4th node of triangles) of nodes
+    (x, y indexed by node id). cell_size defaults to half the median extent of the elements
+    '''
+    vertices = elements[['1', '2', '3', '4']].values.astype('int')
+    # triangles repeat their first node as the 4th, a zero length 4th edge
+    closed = np.where(vertices != 0, vertices, vertices[:, :1])
+    positions = nodes.index.get_indexer(closed.ravel()).reshape(closed.shape)
+    if (positions < 0).any():
+        raise KeyError(f'nodes {sorted(set(closed[positions < 0]))} of elements not in nodes')
+    x, y = nodes.x.values[positions], nodes.y.values[positions]
+    xmin, xmax, ymin, ymax = x.min(axis=1), x.max(axis=1), y.min(axis=1), y.max(axis=1)
+    if cell_size is None:
+        cell_size = float(np.median(np.maximum(xmax - xmin, ymax - ymin))) / 2 if len(x) else 1.
+    origin = np.array([xmin.min(), ymin.min()]) if len(x) else np.zeros(2)
+    shape = np.array([int((xmax.max() - origin[0]) // cell_size) + 1,
+                      int((ymax.max() - origin[1]) // cell_size) + 1]) if len(x) else np.ones(2)
+    i0, i1 = _cells(xmin, origin[0], cell_size, shape[0]), _cells(xmax, origin[0], cell_size,
+                                                                  shape[0])
+    j0, j1 = _cells(ymin, origin[1], cell_size, shape[1]), _cells(ymax, origin[1], cell_size,
+                                                                  shape[1])
+    # every (cell, element) of the cells covered by the bounding box of each element
+    ni = i1 - i0 + 1
+    counts = ni * (j1 - j0 + 1)
+    element = np.repeat(np.arange(len(x)), counts)
+    k = np.arange(len(element)) - np.repeat(np.cumsum(counts) - counts, counts)
+    cell = (j0[element] + k // ni[element]) * shape[0] + i0[element] + k % ni[element]
+    order = np.argsort(cell, kind='stable')
+    cell_start = np.concatenate([[0], np.cumsum(np.bincount(cell, minlength=shape.prod()))])
+    return ElementLocator(elements.index.values.astype('int'), vertices, x, y, origin,
+                          np.float64(cell_size), shape, cell_start, element[order])
+
+
+def _cells(values, origin, cell_size, n):
+    return np.clip(((np.asarray(values) - origin) // cell_size).astype('int'), 0, n - 1)
+
+
+def _contains(locator, element, xp, yp):
+    '''
+    True where the element (positions) contains the point xp, yp, boundaries included
+    '''
+    x, y = locator.x[element], locator.y[element]
+    xn, yn = x[:, [1, 2, 3, 0]], y[:, [1, 2, 3, 0]]
+    cross = (xn - x) * (yp[:, None] - y) - (yn - y) * (xp[:, None] - x)
+    tol = 1e-9 * locator.cell_size ** 2
+    return (cross >= -tol).all(axis=1) | (cross <= tol).all(axis=1)
+
+
+def _locate_positions(locator, xp, yp):
+    '''
+    Position of the element containing each point, -1 if none
+    '''
+    found = np.full(len(xp), -1)
+    ci = (xp - locator.origin[0]) // locator.cell_size
+    cj = (yp - locator.origin[1]) // locator.cell_size
+    inside = (ci >= 0) & (ci < locator.shape[0]) & (cj >= 0) & (cj < locator.shape[1])
+    points = np.flatnonzero(inside)
+    cell = (cj[inside] * locator.shape[0] + ci[inside]).astype('int')
+    start, end = locator.cell_start[cell], locator.cell_start[cell + 1]
+    # the k-th element of their cell for the points not found yet, most are found in the first few
+    k = 0
+    while len(points):
+        more = start + k < end
+        points, start, end = points[more], start[more], end[more]
+        candidate = locator.cell_elements[start + k]
+        hit = _contains(locator, candidate, xp[points], yp[points])
+        found[points[hit]] = candidate[hit]
+        points, start, end = points[~hit], start[~hit], end[~hit]
+        k += 1
+    return found
+
+
+@profiling.stage()
+def locate(locator, xp, yp, chunk=LOCATE_CHUNK):
+    '''
+    Location (element ids, node ids and node weights) of the points xp, yp, chunk points at a time.
+    A point on a boundary shared by elements is in the first of them
+    '''
+    xp = np.atleast_1d(np.asarray(xp, dtype='float'))
+    yp = np.atleast_1d(np.asarray(yp, dtype='float'))
+    position = np.concatenate([_locate_positions(locator, xp[i:i + chunk], yp[i:i + chunk])
+                               for i in range(0, len(xp), chunk)] or [np.empty(0, dtype='int')])
+    found = position >= 0
+    elements = np.where(found, locator.element_ids[position], -1)
+    vertices = np.where(found[:, None], locator.vertices[position], 0)
+    weights = np.full(vertices.shape, np.nan)
+    p = position[found]
+    tri = (vertices[found, 3] == 0)[:, None] & (np.arange(4) == 3)
+    weights[found] = geo.interp_weights(xp[found], yp[found], np.where(tri, np.nan, locator.x[p]),
+                                        np.where(tri, np.nan, locator.y[p]))
+    return Location(elements, vertices, weights)
+
+
+def locator_filename(elements_file):
+    return cache.cache_filename(elements_file, '.locator.npz')
+
+
+@profiling.stage()
+def load_locator(elements_file, nodes_file, recache=False):
+    '''
+    ElementLocator of the grid of the elements and nodes files, cached with the elements file and
+    rebuilt when either file changes
+    '''
+    from .reader import read_elements, read_nodes
+    cache_file = locator_filename(elements_file)
+    nodes_source = cache.source_fingerprint(nodes_file)
+    if recache or not cache.is_cache_valid(cache_file, elements_file, nodes=nodes_source):
+        cache.remove_manifest(cache_file)
+        source = cache.source_fingerprint(elements_file)
+        locator = build_locator(read_nodes(nodes_file), read_elements(elements_file))
+        with cache.atomic_write(cache_file) as fh:
+            np.savez(fh, **locator._asdict())
+        cache.write_manifest(cache_file, elements_file, source=source, nodes=nodes_source)
+        return locator
+    with np.load(cache_file) as data:
+        return ElementLocator(**{name: data[name] for name in ElementLocator._fields})
+
+
+def point_operator(locator, xp, yp, layers=0, points=None):
+    '''
+    PointOperator of the points xp, yp in layers (one for all or one per point), labelled points
+    (e.g. station ids, by default their positions). Points outside the mesh have no weights
+    '''
+    location = locate(locator, xp, yp)
+    rows, cols = np.nonzero(location.vertices)
+    keep = ~np.isnan(location.weights[rows, cols])  # not in a degenerate element
+    rows, cols = rows[keep], cols[keep]
+    weights = location.weights[rows, cols]
+    nodes, columns = np.unique(location.vertices[rows, cols], return_inverse=True)
+    npoints = len(location.elements)
+    matrix = csr_matrix((weights, (rows, columns)), shape=(npoints, len(nodes)))
+    layers = np.array(np.broadcast_to(np.asarray(layers, dtype='int'), (npoints,)))
+    points = pd.Index(np.arange(npoints) if points is None else points)
+    return PointOperator(matrix, nodes, layers, points)
+
+
+def _node_series(heads, layer, nodes):
+    '''
+    Index (times), labels of the series (None for one) and the heads (nodes x series x times) of
+    nodes (ids) in layer
+    '''
+    if isinstance(heads, EnsembleHeads):
+        values = np.asarray(heads.node_data[layer][_node_positions(heads.columns, nodes)])
+        return heads.times, pd.Index(heads.runs, name='run'), values
+    if isinstance(heads, GWHeadCube):
+        heads = LazyHeads(heads)
+    if not isinstance(heads, Mapping):
+        raise TypeError(f'heads of type {type(heads).__name__} are not layer dataframes, '
+                        'LazyHeads, a head cube or an ensemble')
+    frame = heads[layer]
+    values = _values_at(frame, slice(None), _node_positions(frame.columns, nodes))
+    return frame.index, None, np.asarray(values).T[:, None, :]
+
+
+@profiling.stage()
+def apply_point_operator(operator, heads):
+    '''
+    Dataframe (time x point) of the heads at the points of operator. heads is a dictionary of layer
+    dataframes or LazyHeads (see reader.load_gwh), a head cube (reader.load_gwh_cube) or an
+    ensemble (ensemble.load_ensemble), whose columns are then (run, point). Points outside the mesh
+    are NaN
+    '''
+    index, series, result = None, None, None
+    for layer in np.unique(operator.layers):
+        rows = np.flatnonzero(operator.layers == layer)
+        matrix = operator.matrix[rows]
+        used = np.unique(matrix.indices)
+        index, series, values = _node_series(heads, int(layer), operator.nodes[used])
+        nseries, ntimes = values.shape[1:]
+        if result is None:
+            result = np.full((len(operator.points), nseries, ntimes), np.nan)
+        result[rows] = (matrix[:, used] @ values.reshape(len(used), nseries * ntimes)).reshape(
+            len(rows), nseries, ntimes)
+    if result is None:
+        raise ValueError('no points')
+    result[np.diff(operator.matrix.indptr) == 0] = np.nan
+    if series is None:
+        return pd.DataFrame(result[:, 0, :].T, index=index, columns=operator.points)
+    columns = pd.MultiIndex.from_product([series, operator.points])
+    return pd.DataFrame(result.transpose(2, 1, 0).reshape(len(index), -1), index=index,
+                        columns=columns)
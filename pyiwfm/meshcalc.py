@@ -1,7 +1,9 @@
 import numpy as np
-from scipy.sparse import lil_matrix, vstack, identity
+import pandas as pd
+from scipy.sparse import csr_matrix, vstack, identity
 from scipy.sparse.linalg import lsqr
-from scipy.spatial import Delaunay
+
+import pyiwfm.locator
 
 
 def barycentric_weights(tri_coords, pt):
@@ -13,7 +15,20 @@ def barycentric_weights(tri_coords, pt):
     return bary
 
 
-def build_least_squares_system(nodes, elements, obs_pts, obs_vals, reg_weight=1e-3):
+def element_locator(nodes, elements):
+    """
+    ElementLocator (see pyiwfm.locator) of the (N, 2) node coordinates and the (M, 3) or (M, 4)
+    vertex indices of the elements (-1 for the 4th vertex of triangles)
+    """
+    elements = np.asarray(elements, dtype='int')
+    vertices = np.zeros((len(elements), 4), dtype='int')
+    vertices[:, :elements.shape[1]] = elements + 1  # node ids from 1, 0 for none
+    nodes = pd.DataFrame(np.asarray(nodes)[:, :2], columns=['x', 'y'],
+                         index=np.arange(1, len(nodes) + 1))
+    return pyiwfm.locator.build_locator(nodes, pd.DataFrame(vertices, columns=['1', '2', '3', '4']))
+
+
+def build_least_squares_system(nodes, elements, obs_pts, obs_vals, reg_weight=1e-3, locator=None):
     """
     Constructs and solves a least squares system to infer node values
     that best match observed values at interior points using linear interpolation.
@@ -21,28 +36,26 @@ def build_least_squares_system(nodes, elements, obs_pts, obs_vals, reg_weight=1e
 
     Parameters:
     - nodes: (N, 2) array of node coordinates
-    - elements: (M, 3) array of triangle vertex indices
+    - elements: (M, 3) array of triangle vertex indices or (M, 4) of triangle and quad vertex
+      indices, -1 for the 4th vertex of triangles
     - obs_pts: (K, 2) array of observation coordinates
     - obs_vals: (K,) array of observed values
     - reg_weight: regularization weight (float)
+    - locator: ElementLocator of the nodes and elements (see element_locator), to reuse it
     """
     n_nodes = len(nodes)
     n_obs = len(obs_pts)
-    A = lil_matrix((n_obs, n_nodes))
-    b = np.zeros(n_obs)
-
-    for i, (pt, val) in enumerate(zip(obs_pts, obs_vals)):
-        for tri in elements:
-            tri_coords = nodes[tri]  # 3x2
-            tri_delaunay = Delaunay(tri_coords)
-            if tri_delaunay.find_simplex(pt) >= 0:
-                bary = barycentric_weights(tri_coords, pt)
-                for k, node_idx in enumerate(tri):
-                    A[i, node_idx] = bary[k]
-                b[i] = val
-                break
-        else:
-            print(f"Observation point {pt} not found in any triangle.")
+    if locator is None:
+        locator = element_locator(nodes, elements)
+    obs_pts = np.asarray(obs_pts, dtype='float').reshape(-1, 2)
+    location = pyiwfm.locator.locate(locator, obs_pts[:, 0], obs_pts[:, 1])
+    found = ~np.isnan(location.weights[:, 0])  # in an element that is not degenerate
+    for pt in obs_pts[~found]:
+        print(f"Observation point {pt} not found in any element.")
+    rows, cols = np.nonzero(location.vertices * found[:, None])
+    A = csr_matrix((location.weights[rows, cols], (rows, location.vertices[rows, cols] - 1)),
+                   shape=(n_obs, n_nodes))
+    b = np.where(found, obs_vals, 0.)
 
     # Regularization term: minimize ||x||^2 (identity regularization)
     L = identity(n_nodes)
@@ -3,6 +3,9 @@ import geopandas as gpd
 import fiona
 import shapely
 
+from . import profiling
+
+@profiling.stage()
 def load_obs_stations(stations_file):
     """Load observation stations from a CSV file"""
     # read the first couple of lines to check the file format
@@ -60,6 +63,7 @@ def load_obs_stations(stations_file):
         raise ValueError("The stations file must contain 'LONGITUDE' and 'LATITUDE' or 'x' and 'y' or 'latitude' and 'longitude' columns for coordinates.")
     return gdfs
 
+@profiling.stage()
 def load_obs_measurements(measurements_file):
     """Load observation measurements from a CSV file"""
     dfc  = pd.read_csv(measurements_file, nrows=5)
@@ -78,6 +82,7 @@ def load_obs_measurements(measurements_file):
     df[date_col] = pd.to_datetime(df[date_col], format='mixed')
     return df
 
+@profiling.stage()
 def load_and_merge_observations(gdfs, file):
     dfobs = pd.read_csv(file, dtype={'SITE_CODE': 'category', 'WLM_ID': int,
                         'WLM_RPE': 'float', 'WLM_GSE': 'float', 'GWE': 'float', 'GSE_GWE': 'float',
@@ -85,6 +90,7 @@ def load_and_merge_observations(gdfs, file):
                         'COOP_ORG_NAME': 'category', 'MONITORING_PROGRAM': 'category', 'MSMT_CMT': 'category'})
     return dfobs.join(gdfs, on='SITE_CODE', rsuffix='OBS_')
 
+@profiling.stage()
 def load_calib_stations(gdb_file):
     # gdb_file = '../tests/data/c2vsim_cg_1921ic_r374_gis/C2VSim_CG_1921IC_R374.gdb'
     # Get all the layers from the .gdb file
@@ -92,6 +98,7 @@ def load_calib_stations(gdb_file):
     calib_stations = gpd.read_file(gdb_file, layer='CalibrationWell')
     return calib_stations
 
+@profiling.stage()
 def load_calib_measurements(gdb_file):
     # Get all the layers from the .gdb file
     layers = fiona.listlayers(gdb_file)
@@ -99,6 +106,7 @@ def load_calib_measurements(gdb_file):
     calib_measurements['Date_'] = pd.to_datetime(calib_measurements.Date_)
     return calib_measurements
 
+@profiling.stage()
 def load_gwheads(gdb_file):
     gwheads=gpd.read_file(gdb_file,layer='Output_GWHead')
     return gwheads
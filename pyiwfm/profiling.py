@@ -0,0 +1,172 @@
+# opt-in timing of loading stages
+# With PYIWFM_PROFILE=1 in the environment (or enable(), or the --profile CLI option) each named
+# stage (reading the grid, parsing the heads, building geodataframes, projecting the mesh...)
+# records its wall time, cpu time (including worker processes that finished in it) and the peak
+# resident memory of the process. Stages nest, e.g. load_data records read_elements, read_nodes and
+# read_stratigraphy inside it.
+#
+# report() prints a summary table and write_json() the records for tracking them over time. When
+# enabled from the environment the report is printed at exit and written to PYIWFM_PROFILE_JSON if
+# set. When disabled a stage costs one check.
+import atexit
+import functools
+import json
+import os
+import sys
+import time
+from contextlib import contextmanager
+
+import pandas as pd
+
+try:
+    import resource
+except ImportError:  # windows
+    resource = None
+
+PROFILE_ENV = 'PYIWFM_PROFILE'
+PROFILE_JSON_ENV = 'PYIWFM_PROFILE_JSON'
+_state = {'enabled': None, 'json_file': None, 'depth': 0, 'records': [], 'at_exit': False}
+
+
+def enable(json_file=None):
+    '''
+    Starts recording stages. The report is printed at exit and, with json_file, written to it
+    '''
+    _state['enabled'] = True
+    _state['json_file'] = json_file
+    _register_at_exit()
+
+
+def disable():
+    _state['enabled'] = False
+
+
+def is_enabled():
+    if _state['enabled'] is None:
+        _state['enabled'] = os.environ.get(PROFILE_ENV, '') not in ('', '0')
+        if _state['enabled']:
+            _state['json_file'] = os.environ.get(PROFILE_JSON_ENV) or None
+            _register_at_exit()
+    return _state['enabled']
+
+
+def reset():
+    _state['records'] = []
+
+
+def _register_at_exit():
+    if not _state['at_exit']:
+        atexit.register(_at_exit)
+        _state['at_exit'] = True
+
+
+def _at_exit():
+    if _state['enabled'] and _state['records']:
+        report(sys.stderr)
+        if _state['json_file']:
+            write_json(_state['json_file'])
+
+
+def peak_rss():
+    '''
+    Peak resident memory of the process in bytes (None if it can not be measured)
+    '''
+    if resource is not None:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == 'darwin' else peak * 1024  # bytes on macos, else KiB
+    try:
+        import psutil
+        info = psutil.Process().memory_info()
+        return getattr(info, 'peak_wset', info.rss)
+    except ImportError:
+        return None
+
+
+def _cpu_time():
+    t = os.times()
+    return time.process_time() + t.children_user + t.children_system
+
+
+@contextmanager
+def timed(name):
+    '''
+    Records the block as the stage name when enabled
+    '''
+    if not is_enabled():
+        yield
+        return
+    record = {'name': name, 'depth': _state['depth'], 'start': time.time()}
+    _state['records'].append(record)
+    _state['depth'] += 1
+    peak0, wall0, cpu0 = peak_rss(), time.perf_counter(), _cpu_time()
+    try:
+        yield
+    finally:
+        record['wall'] = time.perf_counter() - wall0
+        record['cpu'] = _cpu_time() - cpu0
+        record['peak_rss'] = peak_rss()
+        record['peak_rss_increase'] = record['peak_rss'] - peak0 if peak0 is not None else None
+        _state['depth'] -= 1
+
+
+def stage(name=None):
+    '''
+    Decorator recording each call of the function as a stage, named module.function by default
+    '''
+    def decorate(func):
+        label = name or f'{func.__module__.rsplit(".", 1)[-1]}.{func.__qualname__}'
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not is_enabled():
+                return func(*args, **kwargs)
+            with timed(label):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+def records():
+    '''
+    The stages recorded (finished), in the order they started
+    '''
+    return [dict(r) for r in _state['records'] if 'wall' in r]
+
+
+def summary():
+    '''
+    Dataframe of the stages (by nesting depth and name, in the order they first started) with their
+    number of calls, total wall and cpu seconds, the peak resident memory after them and the most
+    any call raised it (MB)
+    '''
+    df = pd.DataFrame(records(), columns=['name', 'depth', 'start', 'wall', 'cpu', 'peak_rss',
+                                          'peak_rss_increase'])
+    df[['peak_rss', 'peak_rss_increase']] = df[['peak_rss', 'peak_rss_increase']].astype(
+        'float') / 2**20
+    grouped = df.groupby(['depth', 'name'], sort=False)
+    return pd.DataFrame({'calls': grouped.size(), 'wall_s': grouped['wall'].sum(),
+                         'cpu_s': grouped['cpu'].sum(), 'peak_rss_mb': grouped['peak_rss'].max(),
+                         'peak_rss_increase_mb': grouped['peak_rss_increase'].max()})
+
+
+def report(file=None):
+    '''
+    Prints the summary table, stages indented by nesting
+    '''
+    file = file or sys.stdout
+    df = summary()
+    df.index = pd.Index(['  ' * depth + name for depth, name in df.index], name='stage')
+    print('pyiwfm stages', file=file)
+    print(df.to_string(float_format=lambda v: f'{v:.2f}', justify='left'), file=file)
+    file.flush()
+
+
+def write_json(file):
+    '''
+    Writes the command line, the records and the summary of the stages to file
+    '''
+    df = summary().reset_index()
+    with open(file, 'w') as fh:
+        json.dump({'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'argv': sys.argv,
+                   'records': records(),
+                   'summary': json.loads(df.to_json(orient='records'))}, fh, indent=1)
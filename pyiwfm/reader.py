@@ -1,18 +1,31 @@
-from collections import namedtuple
+from collections import deque, namedtuple
+import hashlib
+import numpy as np
 import pandas as pd
 import os
 import re
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import ExitStack
 
-def load_or_cache(file, **kwargs):
-    cache_file = file+'.pik'
-    if not os.path.exists(cache_file):
+from . import cache, profiling
+from .lazy import DiffHeads, LazyHeads
+
+@profiling.stage()
+def load_or_cache(file, recache=False, **kwargs):
+    cache_file = cache.cache_filename(file, '.pik')
+    read_args = repr(sorted(kwargs.items()))
+    if recache or not cache.is_cache_valid(cache_file, file, read_args=read_args):
+        cache.remove_manifest(cache_file)
         df = pd.read_csv(file, **kwargs)
-        df.to_pickle(cache_file)
+        with cache.atomic_write(cache_file) as fh:
+            df.to_pickle(fh)
+        cache.write_manifest(cache_file, file, read_args=read_args)
     else:
         df = pd.read_pickle(cache_file)
     return df
 
 
+@profiling.stage()
 def read_elements(file):
     with open(file, 'r') as fh:
         line = fh.readline()
@@ -27,6 +40,7 @@ def read_elements(file):
     return dfe
 
 
+@profiling.stage()
 def read_nodes(file):
     with open(file, 'r') as fh:
         line = fh.readline()
@@ -38,6 +52,7 @@ def read_nodes(file):
                            index_col=0, comment='C')
 
 
+@profiling.stage()
 def read_nodes(file):
     with open(file, 'r') as fh:
         line = fh.readline()
@@ -49,6 +64,7 @@ def read_nodes(file):
                            index_col=0, comment='C')
 
 
+@profiling.stage()
 def read_hydrograph(file):
     with open(file, 'r') as fh:
         line = fh.readline()
@@ -67,6 +83,7 @@ def read_hydrograph(file):
                            nrows=nrows)
 
 
+@profiling.stage()
 def read_stratigraphy(file):
     with open(file, 'r') as fh:
         line = fh.readline()
@@ -88,18 +105,372 @@ def read_stratigraphy(file):
                            header=None, names=cols, usecols=cols)
 
 
+# GW_HeadAll.out layout: a few header lines followed by one record per timestep.
+# Each record is nlayers lines, the first starts with a time stamp field and the
+# others leave it blank. Head values follow in fixed width fields, one per node.
+GWHEAD_HEADER_LINES = 6
+GWHEAD_TIME_WIDTH = 22
+GWHEAD_VALUE_WIDTH = 12
+# bump when a change to parsing changes the cached values so that existing caches are rebuilt
+GWHEAD_PARSER_VERSION = 1
+# bytes parsed at a time by the numpy engine
+GWHEAD_BLOCK_BYTES = 1 << 25
+GWHEAD_ENGINES = ('numpy', 'python')
+# bytes at each end of the cached part of the head file that are hashed to detect a re-run
+GWHEAD_PREFIX_CHECK_BYTES = 1 << 16
+
+
+def _parse_gwhead_time(field):
+    # 09/30/1973_24:00 -> date part only
+    return pd.to_datetime(field.decode().strip().split('_')[0])
+
+
+def _is_gwhead_record_start(line):
+    return bool(line[:GWHEAD_TIME_WIDTH].strip())
+
+
+def _count_gwhead_values(line):
+    width = len(line.rstrip()) - GWHEAD_TIME_WIDTH
+    return -(-width // GWHEAD_VALUE_WIDTH)
+
+
+def _parse_gwhead_values(line, nnodes):
+    end = GWHEAD_TIME_WIDTH + nnodes * GWHEAD_VALUE_WIDTH
+    line = line.rstrip(b'\r\n').ljust(end)
+    fields = np.array([line[i:i + GWHEAD_VALUE_WIDTH]
+                       for i in range(GWHEAD_TIME_WIDTH, end, GWHEAD_VALUE_WIDTH)])
+    try:
+        return fields.astype('float')
+    except ValueError:  # blank fields are missing values
+        return np.array([float(f) if f.strip() else np.nan for f in fields])
+
+
+def _skip_gwhead_header(fh):
+    for _ in range(GWHEAD_HEADER_LINES):
+        fh.readline()
+    return fh.tell()
+
+
+def _iter_gwhead_records(fh, nlayers, end=None):
+    '''
+    Yields (time, heads) for records starting at the current position of the binary file handle up
+    to byte offset end
+    '''
+    nnodes = None
+    while end is None or fh.tell() < end:
+        line = fh.readline()
+        if not line:
+            return
+        if not line.strip():
+            continue
+        if nnodes is None:
+            nnodes = _count_gwhead_values(line)
+        heads = np.empty((nlayers, nnodes))
+        time = _parse_gwhead_time(line[:GWHEAD_TIME_WIDTH])
+        heads[0] = _parse_gwhead_values(line, nnodes)
+        k = 1
+        while k < nlayers:
+            line = fh.readline()
+            if not line:  # incomplete record at the end of the file
+                return
+            if line.strip():
+                heads[k] = _parse_gwhead_values(line, nnodes)
+                k += 1
+        yield time, heads
+
+
+def iter_gwhead(gwheadfile, nlayers):
+    '''
+    Yields (time, heads) for each timestep in the head print file, heads being a
+    (nlayers, nnodes) array.
+
+    Only one timestep is parsed and held at a time. A trailing incomplete record is ignored.
+    '''
+    with open(gwheadfile, 'rb') as fh:
+        _skip_gwhead_header(fh)
+        yield from _iter_gwhead_records(fh, nlayers)
+
+
+def _next_gwhead_record_offset(fh, offset):
+    '''
+    Byte offset of the first record (time stamped line) starting at or after offset
+    '''
+    fh.seek(offset - 1)
+    fh.readline()  # move to the start of the next line, stays put if offset is at a line start
+    while True:
+        pos = fh.tell()
+        line = fh.readline()
+        if not line or _is_gwhead_record_start(line):
+            return pos
+
+
+def gwhead_byte_ranges(gwheadfile, nranges, start=None, end=None):
+    '''
+    Splits the records of the head print file into about nranges (start, end) byte ranges on
+    timestep boundaries.
+
+    start (a record offset) and end limit the ranges to part of the file, by default all records
+    '''
+    with open(gwheadfile, 'rb') as fh:
+        data_start = _skip_gwhead_header(fh)
+        start = data_start if start is None else start
+        end = os.fstat(fh.fileno()).st_size if end is None else end
+        step = max(1, (end - start) // nranges)
+        bounds = [start] + [_next_gwhead_record_offset(fh, offset)
+                            for offset in range(start + step, end, step)]
+    bounds = sorted(set(min(bound, end) for bound in bounds + [end]))
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def _complete_records_end(fh, start, nlayers):
+    '''
+    Byte offset just past the last complete record (all layer lines written) from the record
+    offset start
+    '''
+    fh.seek(start)
+    end = pos = start
+    nlines = 0
+    while True:
+        line = fh.readline()
+        if not line.endswith(b'\n'):  # end of file or a line still being written
+            return end
+        pos += len(line)
+        if line.strip():
+            nlines += 1
+            if nlines % nlayers == 0:
+                end = pos
+
+
+def gwhead_records_end(gwheadfile, nlayers, window=1 << 22):
+    '''
+    Byte offset just past the last complete record of the head print file, which may still
+    be written to
+    '''
+    with open(gwheadfile, 'rb') as fh:
+        data_start = _skip_gwhead_header(fh)
+        size = os.fstat(fh.fileno()).st_size
+        # look for the last record start close to the end of the file
+        while True:
+            offset = max(data_start, size - window)
+            start = data_start if offset == data_start else _next_gwhead_record_offset(fh, offset)
+            if start < size or offset == data_start:
+                break
+            window *= 2
+        return _complete_records_end(fh, start, nlayers)
+
+
+def _parse_gwhead_block(buf, nlayers):
+    '''
+    Vectorized parse of the complete records in buf (bytes) to
+    (times, heads[ntimes, nlayers, nnodes]).
+
+    The lines are laid out as a 2d array of characters, the value columns are viewed as fixed width
+    byte strings and converted to floats in one call. Returns None if the block is not regular
+    (e.g. blank fields), the caller then falls back to the line by line parser
+    '''
+    lines = [line for line in buf.splitlines() if line.strip()]
+    nrecords = len(lines) // nlayers
+    if nrecords == 0:
+        return [], np.empty((0, nlayers, 0))
+    lines = lines[:nrecords * nlayers]
+    nnodes = max(_count_gwhead_values(line) for line in lines)
+    end = GWHEAD_TIME_WIDTH + nnodes * GWHEAD_VALUE_WIDTH
+    chars = np.frombuffer(b''.join(line.ljust(end) for line in lines), dtype='S1')
+    chars = chars.reshape(len(lines), end)
+    stamped = (chars[:, :GWHEAD_TIME_WIDTH] != b' ').any(axis=1)
+    if not stamped[::nlayers].all() or stamped.sum() != nrecords:
+        return None
+    fields = np.ascontiguousarray(chars[:, GWHEAD_TIME_WIDTH:]).view(f'S{GWHEAD_VALUE_WIDTH}')
+    try:
+        values = fields.astype('float')
+    except ValueError:
+        return None
+    times = pd.to_datetime([line[:GWHEAD_TIME_WIDTH].decode().strip().split('_')[0]
+                            for line in lines[::nlayers]])
+    return list(times), values.reshape(nrecords, nlayers, nnodes)
+
+
+def _read_gwhead_range(gwheadfile, nlayers, start, end, dtype='float', engine='numpy'):
+    with open(gwheadfile, 'rb') as fh:
+        fh.seek(start)
+        if engine == 'numpy':
+            parsed = _parse_gwhead_block(fh.read(end - start), nlayers)
+            if parsed is not None:
+                times, heads = parsed
+                return times, heads.astype(dtype, copy=False)
+            fh.seek(start)
+        times = []
+        steps = []
+        for time, heads in _iter_gwhead_records(fh, nlayers, end):
+            times.append(time)
+            steps.append(heads.astype(dtype))
+    if not steps:
+        return times, np.empty((0, nlayers, 0), dtype=dtype)
+    return times, np.stack(steps)
+
+
+def iter_gwhead_blocks(gwheadfile, nlayers, workers=1, dtype='float', engine='numpy',
+                       block_bytes=GWHEAD_BLOCK_BYTES, start=None, end=None):
+    '''
+    Yields (times, heads) blocks in time order, heads being a (ntimes, nlayers, nnodes) array.
+
+    The file is split on timestep boundaries into byte ranges of about block_bytes. With workers > 1
+    (None for all cpus) the ranges are parsed in a process pool. engine is 'numpy' (vectorized,
+    default) or 'python' (line by line; serially this streams one timestep at a time via
+    iter_gwhead). start (a record offset) and end limit parsing to that byte range of the file
+    '''
+    if engine not in GWHEAD_ENGINES:
+        raise ValueError(f'engine must be one of {GWHEAD_ENGINES}, got {engine}')
+    parallel = workers is None or workers > 1
+    if not parallel and engine == 'python' and start is None and end is None:
+        for time, heads in iter_gwhead(gwheadfile, nlayers):
+            yield [time], heads[np.newaxis].astype(dtype)
+        return
+    workers = (workers or os.cpu_count()) if parallel else 1
+    nbytes = (os.path.getsize(gwheadfile) if end is None else end) - (start or 0)
+    nranges = max(workers * 4 if parallel else 1, -(-nbytes // block_bytes))
+    ranges = gwhead_byte_ranges(gwheadfile, nranges, start, end)
+    if parallel:
+        # at most 2 ranges per worker in flight so that parsed blocks waiting to be yielded stay
+        # bounded instead of growing to the whole file
+        futures = deque()
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            for start, end in ranges:
+                futures.append(executor.submit(_read_gwhead_range, gwheadfile, nlayers, start, end,
+                                               dtype, engine))
+                if len(futures) < 2 * workers:
+                    continue
+                times, heads = futures.popleft().result()
+                if times:
+                    yield times, heads
+            while futures:
+                times, heads = futures.popleft().result()
+                if times:
+                    yield times, heads
+    else:
+        for start, end in ranges:
+            times, heads = _read_gwhead_range(gwheadfile, nlayers, start, end, dtype, engine)
+            if times:
+                yield times, heads
+
+
+# timestep index: byte offset and time of each record so that date windows can be read directly
+GWHeadInfo = namedtuple('GWHeadInfo', ['nlayers', 'nnodes', 'ntimes', 'start', 'end'])
+
+
+def gwh_index_filename(file):
+    return cache.cache_filename(file, '.idx.npz')
+
+
+def scan_gwhead(gwheadfile, nlayers):
+    '''
+    One pass over the head print file (no values are parsed) returning (offsets, times, nnodes,
+    end), the byte offset and time of each complete record, the number of nodes and the offset just
+    past the last record
+    '''
+    offsets = []
+    stamps = []
+    nnodes = 0
+    with open(gwheadfile, 'rb') as fh:
+        pos = end = _skip_gwhead_header(fh)
+        nlines = 0
+        while True:
+            line = fh.readline()
+            if not line.endswith(b'\n'):
+                break
+            if line.strip():
+                if nlines % nlayers == 0:
+                    offsets.append(pos)
+                    stamps.append(line[:GWHEAD_TIME_WIDTH])
+                    nnodes = nnodes or _count_gwhead_values(line)
+                nlines += 1
+                if nlines % nlayers == 0:
+                    end = pos + len(line)
+            pos += len(line)
+    if nlines % nlayers:  # incomplete last record
+        offsets, stamps = offsets[:-1], stamps[:-1]
+    times = pd.DatetimeIndex([_parse_gwhead_time(stamp) for stamp in stamps], name='Time')
+    return np.array(offsets, dtype='int64'), times, nnodes, end
+
+
+@profiling.stage()
+def build_gwh_index(gwheadfile, nlayers):
+    '''
+    Scans the head print file and saves the timestep index next to it. The manifest holds the
+    summary (see gwhead_info)
+    '''
+    index_file = gwh_index_filename(gwheadfile)
+    cache.remove_manifest(index_file)
+    offsets, times, nnodes, end = scan_gwhead(gwheadfile, nlayers)
+    with cache.atomic_write(index_file) as fh:
+        np.savez(fh, offsets=offsets, times=times.values.astype('datetime64[s]'), end=end)
+    cache.write_manifest(index_file, gwheadfile, nlayers=nlayers,
+                         parser_version=GWHEAD_PARSER_VERSION, nnodes=nnodes, ntimes=len(times),
+                         start=times[0].isoformat() if len(times) else None,
+                         end=times[-1].isoformat() if len(times) else None)
+
+
+def _ensure_gwh_index(gwheadfile, nlayers):
+    if not cache.is_cache_valid(gwh_index_filename(gwheadfile), gwheadfile,
+                                nlayers=nlayers, parser_version=GWHEAD_PARSER_VERSION):
+        build_gwh_index(gwheadfile, nlayers)
+
+
+def load_gwh_index(gwheadfile, nlayers):
+    '''
+    Returns (offsets, times, end) from the timestep index, building it if missing or out of date
+    '''
+    _ensure_gwh_index(gwheadfile, nlayers)
+    with np.load(gwh_index_filename(gwheadfile)) as index:
+        return index['offsets'], pd.DatetimeIndex(index['times'], name='Time'), int(index['end'])
+
+
+def gwhead_info(gwheadfile, nlayers):
+    '''
+    Number of layers, nodes and timesteps and the first and last time of the head print file
+    from its index
+    '''
+    _ensure_gwh_index(gwheadfile, nlayers)
+    manifest = cache.read_manifest(gwh_index_filename(gwheadfile))
+    return GWHeadInfo(nlayers, manifest['nnodes'], manifest['ntimes'],
+                      pd.Timestamp(manifest['start']) if manifest['start'] else None,
+                      pd.Timestamp(manifest['end']) if manifest['end'] else None)
+
+
+def gwhead_window_offsets(gwheadfile, nlayers, start=None, end=None):
+    '''
+    Byte range (start, end) of the records with times from start to end
+    (inclusive, None for open ended)
+    '''
+    offsets, times, records_end = load_gwh_index(gwheadfile, nlayers)
+    first = 0 if start is None else times.searchsorted(pd.Timestamp(start), 'left')
+    last = len(times) if end is None else times.searchsorted(pd.Timestamp(end), 'right')
+    bounds = np.append(offsets, records_end)
+    return int(bounds[first]), int(bounds[max(first, last)])
+
+
+def _build_layer_frame(values, index):
+    # every node is kept (blank fields are NaN) so that columns line up with node ids,
+    # as in the cube cache
+    return pd.DataFrame(values, index=index,
+                        columns=[str(i) for i in range(1, values.shape[1] + 1)])
+
+
 def get_index(df0):
+    '''
+    Time index (frequency inferred) of the time stamps in the first column of a head print file
+    read as a table, e.g. with pd.read_fwf
+    '''
     # split the first column into date and time
     date_col = df0.iloc[:, 0].str.split('_', expand=True).iloc[:, 0]
-    # set index to date part
-    idx = pd.to_datetime(date_col)
-    idx.index = idx.index
-    idx.name = 'Time'
-    idx.freq = pd.infer_freq(idx)
-    return idx
+    return pd.DatetimeIndex(pd.to_datetime(date_col), name='Time', freq='infer')
 
 
 def rearrange(df0, drop_first=False):
+    '''
+    Values of a layer of a head print file read as a table with string column names, dropping the
+    time stamp column (drop_first) and columns with missing values
+    '''
     if drop_first:
         # drop the first columnn as it is index now
         df0 = df0.drop(0, axis=1)
@@ -108,74 +479,627 @@ def rearrange(df0, drop_first=False):
     return df0.astype('float')
 
 
-def read_gwhead(gwheadfile, nlayers):
-    dfh = pd.read_fwf(gwheadfile, skiprows=5, sep=r'\s+', nrows=1)
-    colspecs = [(i * 12 + 22, i * 12 + 34) for i in range(0, len(dfh.columns))]
-    colspecs = [(0, 22)] + colspecs
-    df = pd.read_fwf(gwheadfile, skiprows=6, header=None, sep=r'\s+', colspecs=colspecs)
+@profiling.stage()
+def read_gwhead(gwheadfile, nlayers, workers=1, engine='numpy', start=None, end=None,
+                dtype='float'):
+    '''
+    Reads the head print file into a dictionary of dataframes (time x node), one for each layer.
+    Blank values are NaN, dtype is the dtype of the values ('<f4' matches the cube cache).
+
+    workers > 1 (None for all cpus) parses byte ranges of the file in parallel processes.
+    engine is 'numpy' (vectorized tokenizer) or 'python' (line by line).
+    start and/or end (times, inclusive) read only that window, seeking to it with the timestep index
+    '''
+    window = start is not None or end is not None
+    offset_start = offset_end = None
+    if window:
+        offset_start, offset_end = gwhead_window_offsets(gwheadfile, nlayers, start, end)
+    times = []
+    layers = [[] for _ in range(nlayers)]
+    if not window or offset_start < offset_end:
+        for block_times, heads in iter_gwhead_blocks(gwheadfile, nlayers, workers, dtype=dtype,
+                                                     engine=engine, start=offset_start,
+                                                     end=offset_end):
+            times.extend(block_times)
+            for k in range(nlayers):
+                layers[k].append(heads[:, k, :])
+    idx = pd.DatetimeIndex(times, name='Time', freq='infer')
     # 4 layers --> 4 dataframes, one for each layer
-    layer_df = {i: df.iloc[i::nlayers] for i in range(nlayers)}
-    # get index from first layer as a time index
-    idx = get_index(layer_df[0])
-    # rearrange and drop columns
-    layer_df[0] = rearrange(layer_df[0], drop_first=True)  # ,cols_shift_left=1)
-    for i in range(1, nlayers):
-        layer_df[i] = rearrange(layer_df[i], drop_first=True)  # ,cols_shift_left=2)
-    # set index of each dataframe to time index
-    for i in range(nlayers):
-        layer_df[i].index = idx[0:len(layer_df[i])]
+    layer_df = {}
+    for k in range(nlayers):
+        values = np.concatenate(layers[k]) if layers[k] else np.empty((0, 0), dtype=dtype)
+        layers[k] = None  # release the blocks as soon as the layer is stacked
+        layer_df[k] = _build_layer_frame(values, idx)
     return layer_df
 
+
 # caching for gwhead
 
 
 def gwh_feather_filename(file, layer=0):
-    return f'{file}.{layer}.ftr'
+    return cache.cache_filename(file, f'.{layer}.ftr')
 
 
+@profiling.stage()
 def cache_gwh_feather(file, dfgh):
     for k in dfgh.keys():
-        ffile = f'{file}.{k}.ftr'
-        dfx = dfgh[k].reset_index().to_feather(ffile)
+        with cache.atomic_write(gwh_feather_filename(file, k)) as fh:
+            dfgh[k].reset_index().to_feather(fh)
 
 
+@profiling.stage()
 def load_gwh_feather(file, nlayers):
     dfgh = {}
     for k in range(nlayers):
-        ffile = f'{file}.{k}.ftr'
-        df = pd.read_feather(ffile)
+        df = pd.read_feather(gwh_feather_filename(file, k))
         dfgh[k] = df.set_index(df.columns[0])
     return dfgh
 
 
-def read_and_cache(gwh_file, nlayers, recache=False):
-    if recache or not os.path.exists(gwh_feather_filename(gwh_file)):
-        dfgwh = read_gwhead(gwh_file, nlayers)
-        cache_gwh_feather(gwh_file, dfgwh)
+# head cube cache: all layers in one float32 (time, layer, node) file that is memory mapped on load.
+# Optionally a node major (layer, node, time) copy is kept for reading time series of a few
+# nodes contiguously
+GWHeadCube = namedtuple('GWHeadCube', ['data', 'times', 'columns', 'node_data'], defaults=[None])
+
+
+def gwh_cube_filename(file, in_place=False):
+    return cache.cache_filename(file, '.cube', in_place)
+
+
+def gwh_node_cube_filename(file):
+    return cache.cache_filename(file, '.cube.nodes')
+
+
+def _gwhead_prefix_hash(file, offset):
+    '''
+    Hash of the first and last bytes before offset, i.e. of the part of the head file that is in the
+    cube. A re-run that rewrote that part no longer matches, even if the file is now longer
+    '''
+    h = hashlib.blake2b(digest_size=16)
+    with open(file, 'rb') as fh:
+        head = fh.read(min(offset, GWHEAD_PREFIX_CHECK_BYTES))
+        h.update(head)
+        fh.seek(max(len(head), offset - GWHEAD_PREFIX_CHECK_BYTES))
+        h.update(fh.read(offset - fh.tell()))
+    return h.hexdigest()
+
+
+def _write_gwh_cube_manifest(file, nlayers, times, nnodes, offset, source, prefix_hash):
+    cache.write_manifest(gwh_cube_filename(file), file, source=source,
+                         nlayers=nlayers, parser_version=GWHEAD_PARSER_VERSION,
+                         shape=[len(times), nlayers, nnodes], dtype='<f4', times=times,
+                         offset=offset, prefix_hash=prefix_hash)
+
+
+@profiling.stage()
+def cache_gwh_cube(file, nlayers, content_hash=False, workers=1, engine='numpy'):
+    '''
+    Streams the head print file into the cube cache one block of timesteps at a time.
+
+    The manifest (header) is written last so that an interrupted write never looks like a valid
+    cache. It records the byte offset just past the last complete record, and a hash of the bytes
+    before it, so that update_gwh_cube can append later timesteps. The source fingerprint is taken
+    before parsing so that a file that grows meanwhile does not match the cube
+    '''
+    cube_file = gwh_cube_filename(file)
+    cache.remove_manifest(cube_file)
+    source = cache.source_fingerprint(file, content_hash)
+    offset = gwhead_records_end(file, nlayers)
+    prefix_hash = _gwhead_prefix_hash(file, offset)
+    times = []
+    nnodes = 0
+    with cache.atomic_write(cube_file) as fh:
+        for block_times, heads in iter_gwhead_blocks(file, nlayers, workers, dtype='<f4',
+                                                     engine=engine, end=offset):
+            heads.tofile(fh)
+            times.extend(t.isoformat() for t in block_times)
+            nnodes = heads.shape[2]
+    _write_gwh_cube_manifest(file, nlayers, times, nnodes, offset, source, prefix_hash)
+
+
+@profiling.stage()
+def update_gwh_cube(file, nlayers):
+    '''
+    Appends the timesteps written to the head print file (e.g. by a simulation that is still
+    running) since the cube was built or last updated. Only the new bytes are parsed and a partially
+    written last record is left for the next update.
+
+    Rebuilds the cube if there is none or the part of the file that is cached was rewritten
+    (re-run). Returns the list of times added
+    '''
+    cube_file = gwh_cube_filename(file)
+    manifest = cache.read_manifest(cube_file)
+    if (manifest is None or manifest.get('nlayers') != nlayers or 'offset' not in manifest
+            or manifest.get('parser_version') != GWHEAD_PARSER_VERSION
+            or os.path.getsize(file) < manifest['offset'] or not os.path.exists(cube_file)
+            or manifest.get('prefix_hash') != _gwhead_prefix_hash(file, manifest['offset'])):
+        cache_gwh_cube(file, nlayers)
+        return list(pd.to_datetime(cache.read_manifest(cube_file)['times']))
+    source = cache.source_fingerprint(file)
+    with open(file, 'rb') as fh:
+        end = _complete_records_end(fh, manifest['offset'], nlayers)
+    if end <= manifest['offset']:
+        return []
+    times = manifest['times']
+    nnodes = manifest['shape'][2]
+    added = []
+    with open(cube_file, 'ab') as fh:
+        for block_times, heads in iter_gwhead_blocks(file, nlayers, dtype='<f4',
+                                                     start=manifest['offset'], end=end):
+            if nnodes and heads.shape[2] != nnodes:
+                raise ValueError(f'{file} has {heads.shape[2]} nodes after offset '
+                                 f'{manifest["offset"]}, cube has {nnodes}')
+            heads.tofile(fh)
+            added.extend(block_times)
+            nnodes = heads.shape[2]
+    _write_gwh_cube_manifest(file, nlayers, times + [t.isoformat() for t in added], nnodes, end,
+                             source, _gwhead_prefix_hash(file, end))
+    return added
+
+
+def write_gwh_cube_manifest(file, nlayers, times, nnodes):
+    '''
+    Makes a cube written elsewhere (e.g. statistics of runs, see ensemble) the cube cache of the
+    head file, whose records (if any) it then stands for
+    '''
+    offset = gwhead_records_end(file, nlayers)
+    _write_gwh_cube_manifest(file, nlayers, [pd.Timestamp(t).isoformat() for t in times], nnodes,
+                             offset, cache.source_fingerprint(file),
+                             _gwhead_prefix_hash(file, offset))
+
+
+def is_gwh_cube_valid(file, nlayers):
+    return cache.is_cache_valid(gwh_cube_filename(file), file,
+                                nlayers=nlayers, parser_version=GWHEAD_PARSER_VERSION)
+
+
+def _is_gwh_node_cube_valid(file, shape):
+    nlayers, nnodes, ntimes = shape[1], shape[2], shape[0]
+    return cache.is_cache_valid(gwh_node_cube_filename(file), file, nlayers=nlayers,
+                                parser_version=GWHEAD_PARSER_VERSION,
+                                shape=[nlayers, nnodes, ntimes])
+
+
+@profiling.stage()
+def cache_gwh_node_cube(file, chunk_bytes=GWHEAD_BLOCK_BYTES):
+    '''
+    Writes the node major (layer, node, time) copy of the cube cache, transposing chunks of
+    nodes at a time
+    '''
+    node_file = gwh_node_cube_filename(file)
+    cache.remove_manifest(node_file)
+    data = load_gwh_cube(file).data
+    ntimes, nlayers, nnodes = data.shape
+    chunk = max(1, chunk_bytes // (max(ntimes, 1) * data.itemsize))
+    with cache.atomic_write(node_file) as fh:
+        for k in range(nlayers):
+            for n0 in range(0, nnodes, chunk):
+                np.ascontiguousarray(data[:, k, n0:n0 + chunk].T).tofile(fh)
+    cache.write_manifest(node_file, file, nlayers=nlayers, parser_version=GWHEAD_PARSER_VERSION,
+                         shape=[nlayers, nnodes, ntimes], dtype=str(data.dtype))
+
+
+def _map_cube(file, dtype, shape):
+    '''
+    Read only memory map of a cube file, an empty array if the cube has no values (e.g. a head file
+    with only its header), which cannot be memory mapped
+    '''
+    if not all(shape):
+        return np.empty(shape, dtype=dtype)
+    return np.memmap(file, dtype=dtype, mode='r', shape=shape)
+
+
+def load_gwh_cube(file):
+    '''
+    Opens the cube cache as a read only memory map. Only the pages that are indexed are read
+    from disk.
+
+    The node major copy is opened as node_data if it exists and matches the cube, otherwise
+    node_data is None
+    '''
+    header = cache.read_manifest(gwh_cube_filename(file))
+    shape = tuple(header['shape'])
+    data = _map_cube(gwh_cube_filename(file), header['dtype'], shape)
+    times = pd.DatetimeIndex(pd.to_datetime(header['times']), name='Time', freq='infer')
+    columns = pd.Index([str(i) for i in range(1, shape[2] + 1)])
+    node_data = None
+    if _is_gwh_node_cube_valid(file, shape):
+        node_data = _map_cube(gwh_node_cube_filename(file), header['dtype'],
+                              (shape[1], shape[2], shape[0]))
+    return GWHeadCube(data, times, columns, node_data)
+
+
+def slice_gwh_cube(cube, start=None, end=None):
+    '''
+    Cube restricted to times from start to end (inclusive), the data remains a view of the
+    memory map
+    '''
+    rows = cube.times.slice_indexer(start, end)
+    node_data = None if cube.node_data is None else cube.node_data[:, :, rows]
+    return GWHeadCube(cube.data[rows], cube.times[rows], cube.columns, node_data)
+
+
+def _node_positions(columns, nodes):
+    '''
+    Positions of node ids in the head columns, raises KeyError for unknown ids
+    '''
+    cols = columns.get_indexer(pd.Index([str(n) for n in nodes]))
+    if (cols < 0).any():
+        raise KeyError(f'nodes {list(np.asarray(nodes)[cols < 0])} not in heads')
+    return cols
+
+
+def subset_gwh_cube(cube, nodes):
+    '''
+    Cube restricted to the node ids in nodes, in that order, copied into memory. With a node
+    major copy only the pages of those nodes are read, otherwise every page of the time major
+    cube is touched
+    '''
+    cols = _node_positions(cube.columns, nodes)
+    if cube.node_data is not None:
+        data = np.ascontiguousarray(np.asarray(cube.node_data[:, cols, :]).transpose(2, 0, 1))
     else:
-        dfgwh = load_gwh_feather(gwh_file, nlayers)
-    return dfgwh
+        data = np.ascontiguousarray(cube.data[:, :, cols])
+    return GWHeadCube(data, cube.times, cube.columns[cols])
+
+
+def gwh_cube_layers(cube, node_major=False):
+    '''
+    Dictionary of layer dataframes that are views into the (memory mapped) cube, no data is copied.
+
+    With node_major (and a cube that has the node major copy) the dataframes are views of the node
+    major copy, reading the time series of a node (column) is then contiguous and reading a time
+    (row) is strided
+    '''
+    if node_major and cube.node_data is not None:
+        return {k: pd.DataFrame(cube.node_data[k].T, index=cube.times, columns=cube.columns,
+                                copy=False)
+                for k in range(cube.node_data.shape[0])}
+    return {k: pd.DataFrame(cube.data[:, k, :], index=cube.times, columns=cube.columns, copy=False)
+            for k in range(cube.data.shape[1])}
+
+
+def ensure_gwh_cube(gwh_file, nlayers, recache=False, content_hash=False, workers=1,
+                    node_major=False):
+    '''
+    Opens the cube cache, (re)building it when recache is True or the cache no longer matches the
+    head file (size, modification time or content hash), the number of layers or the parser version.
+
+    workers > 1 (None for all cpus) parses the head file in parallel when the cache is built.
+    node_major also builds (if needed) the node major copy used for time series reads
+    '''
+    rebuilt = recache or not is_gwh_cube_valid(gwh_file, nlayers)
+    if rebuilt:
+        cache_gwh_cube(gwh_file, nlayers, content_hash=content_hash, workers=workers)
+    cube = load_gwh_cube(gwh_file)
+    if node_major and (rebuilt or cube.node_data is None):
+        cache_gwh_node_cube(gwh_file)
+        cube = load_gwh_cube(gwh_file)
+    return cube
+
+
+def read_and_cache(gwh_file, nlayers, recache=False, content_hash=False, workers=1):
+    return gwh_cube_layers(ensure_gwh_cube(gwh_file, nlayers, recache, content_hash, workers))
+
+
+# temporal aggregation levels of the cube, finest to coarsest, and the aggregates kept for each
+GWHEAD_RESOLUTIONS = ('month', 'water_year', 'decade')
+GWHEAD_LEVELS = {'water_year': ('mean', 'min', 'max'), 'decade': ('mean',)}
+
+
+def gwh_level_filename(file, resolution, how):
+    return cache.cache_filename(file, f'.cube.{resolution}_{how}')
+
+
+def water_years(times):
+    '''
+    Water years (October to September, named by the year they end in) of times
+    '''
+    times = pd.DatetimeIndex(times)
+    return np.asarray(times.year + (times.month >= 10))
+
+
+def gwh_level(resolution, how='mean'):
+    '''
+    The coarsest level (resolution, how) kept that is no coarser than resolution and has the
+    aggregate how, ('month', None) for the heads themselves
+    '''
+    coarsest = GWHEAD_RESOLUTIONS.index(resolution)
+    for level in reversed(GWHEAD_RESOLUTIONS[1:coarsest + 1]):
+        if how in GWHEAD_LEVELS[level]:
+            return level, how
+    return 'month', None
+
+
+def _group_bounds(labels):
+    '''
+    (start, end) rows of the runs of equal labels
+    '''
+    breaks = np.flatnonzero(np.diff(labels)) + 1
+    return list(zip(np.r_[0, breaks], np.r_[breaks, len(labels)]))
+
+
+def _gwh_level_params(cube_manifest):
+    return dict(nlayers=cube_manifest['nlayers'], parser_version=GWHEAD_PARSER_VERSION,
+                cube_shape=cube_manifest['shape'], cube_offset=cube_manifest.get('offset'))
+
+
+def _are_gwh_levels_valid(file):
+    manifest = cache.read_manifest(gwh_cube_filename(file))
+    return manifest is not None and all(
+        cache.is_cache_valid(gwh_level_filename(file, resolution, how), file,
+                             **_gwh_level_params(manifest))
+        for resolution, hows in GWHEAD_LEVELS.items() for how in hows)
+
+
+@profiling.stage()
+def cache_gwh_levels(file):
+    '''
+    Writes the water year mean, min and max and the decade (of water years) mean of the cube
+    next to it, each a cube with a time (the last time aggregated) per water year or decade.
+
+    The cube is read one water year at a time. Levels are rebuilt when the cube changes (e.g.
+    timesteps are appended)
+    '''
+    cube_manifest = cache.read_manifest(gwh_cube_filename(file))
+    cube = load_gwh_cube(file)
+    levels = [(resolution, how) for resolution, hows in GWHEAD_LEVELS.items() for how in hows]
+    for resolution, how in levels:
+        cache.remove_manifest(gwh_level_filename(file, resolution, how))
+    wy = water_years(cube.times)
+    decades = wy // 10 * 10
+    times = {'water_year': [], 'decade': []}
+    decade_sum = decade_count = None
+    with ExitStack() as stack:
+        fhs = {level: stack.enter_context(cache.atomic_write(gwh_level_filename(file, *level)))
+               for level in levels}
+        for r0, r1 in _group_bounds(wy):
+            block = np.asarray(cube.data[r0:r1], dtype='float')
+            for how in GWHEAD_LEVELS['water_year']:
+                getattr(block, how)(axis=0).astype('<f4').tofile(fhs[('water_year', how)])
+            times['water_year'].append(cube.times[r1 - 1].isoformat())
+            if decade_sum is None:
+                decade_sum, decade_count = block.sum(axis=0), 0
+            else:
+                decade_sum += block.sum(axis=0)
+            decade_count += r1 - r0
+            if r1 == len(wy) or decades[r1] != decades[r0]:
+                (decade_sum / decade_count).astype('<f4').tofile(fhs[('decade', 'mean')])
+                times['decade'].append(cube.times[r1 - 1].isoformat())
+                decade_sum = None
+    for resolution, how in levels:
+        cache.write_manifest(gwh_level_filename(file, resolution, how), file,
+                             source=cube_manifest['source'], times=times[resolution],
+                             shape=[len(times[resolution])] + list(cube.data.shape[1:]),
+                             dtype='<f4', **_gwh_level_params(cube_manifest))
+
+
+def load_gwh_level(file, resolution, how='mean'):
+    '''
+    Opens a temporal aggregation level of the cube (see cache_gwh_levels) as a cube
+    '''
+    level_file = gwh_level_filename(file, resolution, how)
+    header = cache.read_manifest(level_file)
+    shape = tuple(header['shape'])
+    data = np.memmap(level_file, dtype=header['dtype'], mode='r', shape=shape)
+    times = pd.DatetimeIndex(pd.to_datetime(header['times']), name='Time')
+    columns = pd.Index([str(i) for i in range(1, shape[2] + 1)])
+    return GWHeadCube(data, times, columns)
+
+
+def ensure_gwh_level(gwh_file, nlayers, resolution, how='mean', recache=False, workers=1):
+    '''
+    Cube of the heads at the coarsest level kept for resolution and how (see gwh_level), building
+    the cube and its levels as needed
+    '''
+    cube = ensure_gwh_cube(gwh_file, nlayers, recache=recache, workers=workers)
+    resolution, how = gwh_level(resolution, how)
+    if resolution == 'month' or not all(cube.data.shape):
+        return cube
+    if recache or not _are_gwh_levels_valid(gwh_file):
+        cache_gwh_levels(gwh_file)
+    return load_gwh_level(gwh_file, resolution, how)
+
+
+# GW hydrograph output file layout: header lines starting with '*', some of which list a value per
+# hydrograph (HYDROGRAPH ID, LAYER, NODE, ELEMENT), followed by one line per timestep of a time
+# stamp and the heads of the hydrographs in the order of the NOUTH table (see read_hydrograph)
+GWHYD_HEADER_ROWS = ('HYDROGRAPH ID', 'LAYER', 'NODE', 'ELEMENT')
+GWHYD_PARSER_VERSION = 1
+
+
+def gwhyd_cache_filename(file):
+    return cache.cache_filename(file, '.hyd')
+
+
+def _read_gwhyd_header(fh):
+    '''
+    Reads the header lines, returns the per hydrograph rows (by name) found in them and leaves the
+    file handle at the first timestep
+    '''
+    rows = {}
+    while True:
+        pos = fh.tell()
+        line = fh.readline()
+        if not line.startswith(b'*'):
+            fh.seek(pos)
+            return rows
+        text = line[1:].decode()
+        for name in GWHYD_HEADER_ROWS:
+            if text.strip().startswith(name):
+                rows[name] = [int(v) for v in text.strip()[len(name):].split()]
+
+
+@profiling.stage()
+def read_gwhyd(file):
+    '''
+    Reads the GW hydrograph output file to a dataframe of time x hydrograph id (strings, the
+    HYDROGRAPH ID header or 1..N), with the LAYER, NODE and ELEMENT header rows (if any) in attrs.
+
+    The timesteps are split into tokens and converted in one call
+    '''
+    with open(file, 'rb') as fh:
+        rows = _read_gwhyd_header(fh)
+        tokens = np.array(fh.read().split())
+    nhyd = len(rows['HYDROGRAPH ID']) if 'HYDROGRAPH ID' in rows else None
+    if nhyd is None:  # count the tokens of the first timestep
+        with open(file, 'rb') as fh:
+            _read_gwhyd_header(fh)
+            nhyd = len(fh.readline().split()) - 1
+    ntimes = len(tokens) // (nhyd + 1)
+    tokens = tokens[:ntimes * (nhyd + 1)].reshape(ntimes, nhyd + 1)
+    times = pd.DatetimeIndex(pd.to_datetime([t.decode().split('_')[0] for t in tokens[:, 0]]),
+                             name='Time')
+    ids = rows.get('HYDROGRAPH ID', range(1, nhyd + 1))
+    df = pd.DataFrame(tokens[:, 1:].astype('float'), index=times,
+                      columns=pd.Index([str(i) for i in ids]))
+    df.attrs.update({name.lower(): values for name, values in rows.items()
+                     if name != 'HYDROGRAPH ID'})
+    return df
+
+
+def cache_gwhyd(file):
+    '''
+    Caches the hydrographs as a (time, hydrograph) float32 memory map with the times, ids and header
+    rows in its manifest
+    '''
+    cache_file = gwhyd_cache_filename(file)
+    cache.remove_manifest(cache_file)
+    source = cache.source_fingerprint(file)
+    df = read_gwhyd(file)
+    with cache.atomic_write(cache_file) as fh:
+        np.ascontiguousarray(df.values, dtype='<f4').tofile(fh)
+    cache.write_manifest(cache_file, file, source=source, parser_version=GWHYD_PARSER_VERSION,
+                         shape=list(df.shape), dtype='<f4',
+                         times=[t.isoformat() for t in df.index], ids=list(df.columns),
+                         rows=df.attrs)
+
+
+@profiling.stage()
+def load_gwhyd(file, dfhyd=None, key='Calibration_ID', ids=None, recache=False):
+    '''
+    Simulated hydrographs from the GW hydrograph output file as a dataframe of time x hydrograph,
+    caching them the first time (and when the file changes).
+
+    With dfhyd (the NOUTH table of read_hydrograph, in the order of the hydrographs) the columns are
+    the key column of it (e.g. Calibration_ID or iouth) as strings instead of the hydrograph ids.
+    ids (of the columns) selects hydrographs, only those are read from the cache
+    '''
+    cache_file = gwhyd_cache_filename(file)
+    if recache or not cache.is_cache_valid(cache_file, file, parser_version=GWHYD_PARSER_VERSION):
+        cache_gwhyd(file)
+    manifest = cache.read_manifest(cache_file)
+    data = _map_cube(cache_file, manifest['dtype'], tuple(manifest['shape']))
+    columns = pd.Index(manifest['ids'])
+    if dfhyd is not None:
+        if len(dfhyd) != len(columns):
+            raise ValueError(f'{len(dfhyd)} hydrographs in the table, {len(columns)} in {file}')
+        columns = pd.Index([str(v) for v in dfhyd[key]])
+    positions = np.arange(len(columns))
+    if ids is not None:
+        positions = columns.get_indexer(pd.Index([str(i) for i in ids]))
+        if (positions < 0).any():
+            raise KeyError(f'hydrographs {list(np.asarray(ids)[positions < 0])} not in {file}')
+    times = pd.DatetimeIndex(pd.to_datetime(manifest['times']), name='Time')
+    df = pd.DataFrame(np.asarray(data[:, positions]), index=times, columns=columns[positions])
+    df.attrs.update({name: [values[i] for i in positions]
+                     for name, values in manifest['rows'].items()})
+    return df
 
 
 #
 GridData = namedtuple('GridData', ['elements', 'nodes', 'stratigraphy', 'nlayers'])
 
 
-def load_data(elements_file, nodes_file, stratigraphy_file):
+def subset_grid(grid_data, bbox=None, subregion=None, nodes=None):
+    '''
+    Grid restricted to the nodes inside bbox (xmin, ymin, xmax, ymax), the nodes of the elements in
+    subregion (one or more ids from the 5th column of the elements file) and/or the node ids in
+    nodes. Only the elements with all their nodes in the subset are kept
+    '''
+    el, dfn = grid_data.elements, grid_data.nodes
+    keep = np.ones(len(dfn), dtype=bool)
+    if bbox is not None:
+        xmin, ymin, xmax, ymax = bbox
+        keep &= (dfn.x.between(xmin, xmax) & dfn.y.between(ymin, ymax)).values
+    if subregion is not None:
+        if '5' not in el.columns:
+            raise ValueError('elements have no subregion column')
+        el_sub = el[el['5'].isin(np.atleast_1d(subregion))]
+        keep &= dfn.index.isin(np.unique(el_sub[['1', '2', '3', '4']].values))
+    if nodes is not None:
+        keep &= dfn.index.isin([int(n) for n in nodes])
+    node_ids = dfn.index[keep]
+    vertices = el[['1', '2', '3', '4']]
+    inside = (vertices.isin(node_ids) | (vertices == 0)).all(axis=1)
+    return GridData(el[inside], dfn.loc[node_ids], grid_data.stratigraphy.reindex(node_ids),
+                    grid_data.nlayers)
+
+
+@profiling.stage()
+def load_data(elements_file, nodes_file, stratigraphy_file, bbox=None, subregion=None, nodes=None):
+    '''
+    Grid (elements, nodes, stratigraphy), restricted to an area if any of bbox, subregion or nodes
+    are given (see subset_grid). Use grid_data.nodes.index as the nodes to load_gwh for the
+    matching heads
+    '''
     el = read_elements(elements_file)
-    nodes = read_nodes(nodes_file)
+    dfn = read_nodes(nodes_file)
     strat = read_stratigraphy(stratigraphy_file)
     # FIXME: not a great way to get layers but works. need a cleaner implementation
     nlayers = len(strat.columns) // 2
-    return GridData(el, nodes, strat, nlayers)
+    grid_data = GridData(el, dfn, strat, nlayers)
+    if bbox is not None or subregion is not None or nodes is not None:
+        grid_data = subset_grid(grid_data, bbox=bbox, subregion=subregion, nodes=nodes)
+    return grid_data
+
+
+@profiling.stage()
+def load_gwh(gwh_file, nlayers, recache=False, content_hash=False, workers=1, lazy=False,
+             max_bytes=None, start=None, end=None, node_major=False, nodes=None,
+             resolution='month', how='mean'):
+    '''
+    Dictionary of layer dataframes of heads, or with lazy=True a LazyHeads mapping that only reads
+    the layer, times or nodes that are indexed from the cache and keeps at most max_bytes of whole
+    layers loaded. With node_major the cache also keeps a node major copy that LazyHeads reads time
+    series of nodes from and that the layer dataframes are views of (for time series plots, see
+    gwh_cube_layers).
 
+    start and/or end (times, inclusive) limit the heads to that window. If the cache is valid it is
+    sliced, otherwise (and not lazy) only the window is parsed from the head file. nodes (node ids,
+    e.g. the nodes of a grid from load_data with a bbox or subregion) limits the heads to those
+    nodes, only their columns are read from the cache.
 
-def load_gwh(gwh_file, nlayers, recache=False):
-    gwh = read_and_cache(gwh_file, nlayers, recache)
-    return gwh
+    resolution ('water_year' or 'decade') and how ('mean', 'min' or 'max') give the heads at the
+    coarsest temporal aggregation level kept that satisfies them (see gwh_level), which is
+    computed and cached with the cube the first time
+    '''
+    window = start is not None or end is not None
+    if resolution != 'month':
+        cube = ensure_gwh_level(gwh_file, nlayers, resolution, how, recache=recache,
+                                workers=workers)
+        cube = slice_gwh_cube(cube, start, end)
+        if nodes is not None:
+            cube = subset_gwh_cube(cube, nodes)
+        return LazyHeads(cube, max_bytes=max_bytes) if lazy else gwh_cube_layers(cube)
+    if window and not lazy and not recache and not is_gwh_cube_valid(gwh_file, nlayers):
+        dfgwh = read_gwhead(gwh_file, nlayers, workers=workers, start=start, end=end, dtype='<f4')
+        if nodes is not None:
+            dfgwh = {k: df.iloc[:, _node_positions(df.columns, nodes)] for k, df in dfgwh.items()}
+        return dfgwh
+    cube = ensure_gwh_cube(gwh_file, nlayers, recache, content_hash, workers, node_major=node_major)
+    if window:
+        cube = slice_gwh_cube(cube, start, end)
+    if nodes is not None:
+        cube = subset_gwh_cube(cube, nodes)
+    if lazy:
+        return LazyHeads(cube, max_bytes=max_bytes)
+    return gwh_cube_layers(cube, node_major=node_major)
 
 
 def diff_heads(dfgwh, dfgwh_base):
-    for k in dfgwh.keys():
-        dfgwh[k] = dfgwh[k] - dfgwh_base[k]
-    return dfgwh
+    '''
+    Difference dfgwh - dfgwh_base of two runs as a DiffHeads mapping. Nothing is subtracted until
+    layers, times or nodes are indexed and neither run is modified
+    '''
+    return DiffHeads(dfgwh, dfgwh_base)
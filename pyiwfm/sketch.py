@@ -0,0 +1,141 @@
+# mergeable statistics
+# Summaries of many arrays of the same shape (e.g. the heads of the runs of an ensemble) that are
+# built from a few arrays at a time and merged, so that runs can be read one after the other or by
+# several processes. NaN values are left out of the statistics.
+from collections import namedtuple
+
+import numpy as np
+
+# count, mean and sum of squared differences from the mean (Welford / Chan et al.)
+Moments = namedtuple('Moments', ['count', 'mean', 'm2'])
+# count and values (sorted along the last axis, NaN padded), each value of weight count / (number of
+# values)
+QuantileSketch = namedtuple('QuantileSketch', ['count', 'values'])
+
+
+def moments(values):
+    '''
+    Moments of values along the first axis
+    '''
+    values = np.asarray(values, dtype='float')
+    valid = ~np.isnan(values)
+    count = valid.sum(axis=0)
+    total = np.where(valid, values, 0).sum(axis=0)
+    mean = np.divide(total, count, out=np.zeros(count.shape), where=count > 0)
+    m2 = np.where(valid, values - mean, 0) ** 2
+    return Moments(count, mean, m2.sum(axis=0))
+
+
+def merge_moments(a, b):
+    count = a.count + b.count
+    delta = b.mean - a.mean
+    frac = np.divide(b.count, count, out=np.zeros(count.shape), where=count > 0)
+    mean = a.mean + delta * frac
+    m2 = a.m2 + b.m2 + delta ** 2 * a.count * frac
+    return Moments(count, mean, m2)
+
+
+def moments_mean(m):
+    return np.where(m.count > 0, m.mean, np.nan)
+
+
+def moments_std(m, ddof=1):
+    var = np.divide(m.m2, m.count - ddof, out=np.full(m.m2.shape, np.nan),
+                    where=m.count > ddof)
+    return np.sqrt(var)
+
+
+def _midpoints(weights):
+    '''
+    Cumulative weight at the middle of each value as a fraction of the total weight of its row
+    '''
+    cum = np.cumsum(weights, axis=-1)
+    total = cum[..., -1:]
+    return np.divide(cum - weights / 2, total, out=np.ones(weights.shape), where=total > 0)
+
+
+def _interp_rows(positions, values, nvalid, targets):
+    '''
+    Linear interpolation of each row of values at targets, the positions (midpoints) of each row
+    being increasing over its first nvalid values
+    '''
+    rows = positions.shape[0]
+    last = np.maximum(nvalid - 1, 0)[:, None]
+    # search all rows at once by shifting the (0..1) positions of row i by 2 * i
+    shift = 2 * np.arange(rows)[:, None]
+    flat = np.where(np.arange(positions.shape[1]) < nvalid[:, None], positions, 1.5) + shift
+    idx = np.searchsorted(flat.ravel(), (targets[None, :] + shift).ravel(), side='right')
+    idx = idx.reshape(rows, len(targets)) - np.arange(rows)[:, None] * positions.shape[1]
+    lo = np.clip(idx - 1, 0, last)
+    hi = np.clip(idx, 0, last)
+    plo = np.take_along_axis(positions, lo, axis=1)
+    phi = np.take_along_axis(positions, hi, axis=1)
+    span = phi - plo
+    frac = np.clip(np.divide(targets - plo, span, out=np.zeros(span.shape), where=span > 0), 0, 1)
+    vlo = np.take_along_axis(values, lo, axis=1)
+    vhi = np.take_along_axis(values, hi, axis=1)
+    result = vlo + (vhi - vlo) * frac
+    return np.where(nvalid[:, None] > 0, result, np.nan)
+
+
+def _compress(values, weights, size):
+    '''
+    size equal weight values that keep the distribution of the weighted values of each row (values
+    sorted with NaN, weight 0, last)
+    '''
+    nvalid = (weights > 0).sum(axis=1)
+    targets = (np.arange(size) + 0.5) / size
+    return _interp_rows(_midpoints(weights), values, nvalid, targets)
+
+
+def quantile_sketch(values, size=64):
+    '''
+    Sketch of the distribution of values along the first axis, kept exactly as long as there are
+    no more than size values (per element), otherwise as size equal weight values
+    '''
+    values = np.moveaxis(np.asarray(values, dtype='float'), 0, -1)
+    count = (~np.isnan(values)).sum(axis=-1)
+    values = np.sort(values, axis=-1)
+    if values.shape[-1] > size:
+        shape = values.shape[:-1]
+        values = values.reshape(-1, values.shape[-1])
+        weights = (~np.isnan(values)).astype('float')
+        values = _compress(values, weights, size).reshape(shape + (size,))
+    return QuantileSketch(count, values)
+
+
+def merge_sketches(a, b, size=64):
+    shape = a.count.shape
+    va = a.values.reshape(-1, a.values.shape[-1])
+    vb = b.values.reshape(-1, b.values.shape[-1])
+    na, nb = a.count.reshape(-1, 1), b.count.reshape(-1, 1)
+    ka = (~np.isnan(va)).sum(axis=1, keepdims=True)
+    kb = (~np.isnan(vb)).sum(axis=1, keepdims=True)
+    values = np.concatenate([va, vb], axis=1)
+    weights = np.concatenate([np.where(np.isnan(va), 0, np.divide(na, np.maximum(ka, 1))),
+                              np.where(np.isnan(vb), 0, np.divide(nb, np.maximum(kb, 1)))], axis=1)
+    order = np.argsort(values, axis=1)
+    values = np.take_along_axis(values, order, axis=1)
+    weights = np.take_along_axis(weights, order, axis=1)
+    # rows of exactly kept values stay exact while they fit
+    exact = ((na == ka) & (nb == kb) & (ka + kb <= size))[:, 0]
+    merged = np.full((len(values), size), np.nan)
+    width = min(size, values.shape[1])
+    merged[exact, :width] = values[exact, :width]
+    if not exact.all():
+        merged[~exact] = _compress(values[~exact], weights[~exact], size)
+    count = (na + nb).reshape(shape)
+    return QuantileSketch(count, merged.reshape(shape + (size,)))
+
+
+def sketch_quantiles(sketch, quantiles):
+    '''
+    Quantiles (0..1) of the sketch, array with the quantiles along the first axis. For exactly kept
+    values this is numpy.quantile(..., method='hazen')
+    '''
+    shape = sketch.count.shape
+    values = sketch.values.reshape(-1, sketch.values.shape[-1])
+    nvalid = (~np.isnan(values)).sum(axis=1)
+    positions = (np.arange(values.shape[1])[None, :] + 0.5) / np.maximum(nvalid, 1)[:, None]
+    result = _interp_rows(positions, values, nvalid, np.asarray(quantiles, dtype='float'))
+    return np.moveaxis(result, -1, 0).reshape((len(quantiles),) + shape)
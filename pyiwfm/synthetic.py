@@ -0,0 +1,218 @@
+# synthetic IWFM model
+# Writes a model of any size in the formats pyiwfm reads, for tests and benchmarks that can not
+# depend on real model data: Nodes, Elements (quads, some cells split into two triangles),
+# Stratigraphy and GW_HeadAll.out files and observation stations and measurements csv files
+# (site_code, x, y and site_code, date, gwe as read by obsreader).
+#
+# The nodes are a rectangular grid (perturbed inside) in EPSG:26910 meters. The ground surface, the
+# heads and the observations all sample the same smooth field of space and time, so observations
+# interpolated to the nodes match the heads within the measurement noise.
+import math
+import os
+from collections import namedtuple
+
+import numpy as np
+import pandas as pd
+
+SyntheticModel = namedtuple('SyntheticModel', ['elements_file', 'nodes_file', 'stratigraphy_file',
+                                               'head_file', 'stations_file', 'measurements_file',
+                                               'nlayers', 'times'])
+# lower left corner of the grid (EPSG:26910), in the Central Valley
+ORIGIN = (600000., 4200000.)
+
+
+def grid_shape(nnodes):
+    '''
+    (columns, rows) of the most square grid of at least nnodes nodes
+    '''
+    nx = max(2, math.ceil(math.sqrt(nnodes)))
+    return nx, max(2, math.ceil(nnodes / nx))
+
+
+def make_nodes(nnodes, spacing=500., seed=0):
+    '''
+    Nodes (x, y indexed by node id) of a grid of at least nnodes nodes, numbered by rows from the
+    lower left. Nodes inside the grid are moved randomly by up to a fifth of the spacing
+    '''
+    nx, ny = grid_shape(nnodes)
+    i, j = np.meshgrid(np.arange(nx), np.arange(ny))
+    x = ORIGIN[0] + spacing * i.ravel().astype('float')
+    y = ORIGIN[1] + spacing * j.ravel().astype('float')
+    inside = ((i > 0) & (i < nx - 1) & (j > 0) & (j < ny - 1)).ravel()
+    rng = np.random.default_rng(seed)
+    x[inside] += rng.uniform(-0.2, 0.2, inside.sum()) * spacing
+    y[inside] += rng.uniform(-0.2, 0.2, inside.sum()) * spacing
+    return pd.DataFrame({'x': x, 'y': y}, index=pd.RangeIndex(1, nx * ny + 1))
+
+
+def make_elements(nnodes, tri_fraction=0.25, nsubregions=2, seed=0):
+    '''
+    Elements (node ids '1'..'4', 0 for the 4th node of triangles, and subregion '5', indexed by
+    element id) of the cells of the grid of make_nodes, counterclockwise. A tri_fraction of the
+    cells are split into two triangles. Subregions are bands of columns
+    '''
+    nx, ny = grid_shape(nnodes)
+    i, j = [a.ravel() for a in np.meshgrid(np.arange(nx - 1), np.arange(ny - 1))]
+    n1 = j * nx + i + 1
+    quads = np.stack([n1, n1 + 1, n1 + 1 + nx, n1 + nx], axis=1)
+    subregion = 1 + i * nsubregions // (nx - 1)
+    split = np.random.default_rng(seed).random(len(quads)) < tri_fraction
+    zeros = np.zeros(split.sum(), dtype=quads.dtype)
+    lower = np.stack([quads[split, 0], quads[split, 1], quads[split, 2], zeros], axis=1)
+    upper = np.stack([quads[split, 0], quads[split, 2], quads[split, 3], zeros], axis=1)
+    # the triangles of a cell follow each other
+    cells = np.concatenate([quads[~split], lower, upper])
+    order = np.argsort(np.concatenate([np.flatnonzero(~split), np.flatnonzero(split) + 0.25,
+                                       np.flatnonzero(split) + 0.5]), kind='stable')
+    regions = np.concatenate([subregion[~split], subregion[split], subregion[split]])[order]
+    dfe = pd.DataFrame(cells[order], columns=['1', '2', '3', '4'],
+                       index=pd.RangeIndex(1, len(cells) + 1))
+    dfe['5'] = regions
+    return dfe
+
+
+def _unit(values, lo, hi):
+    return (np.asarray(values, dtype='float') - lo) / max(hi - lo, 1.)
+
+
+def ground_surface(x, y, extent):
+    '''
+    Ground surface elevation at x, y of the grid covering extent (xmin, ymin, xmax, ymax)
+    '''
+    u, v = _unit(x, extent[0], extent[2]), _unit(y, extent[1], extent[3])
+    return 50. + 250. * u + 20. * np.sin(2 * np.pi * v)
+
+
+def head_field(x, y, extent, months, layer=0):
+    '''
+    Head at x, y (layer 0 based) months after the first timestep: below the ground surface, deeper
+    in lower layers, with a seasonal cycle and a decline that is faster to the east
+    '''
+    u, v = _unit(x, extent[0], extent[2]), _unit(y, extent[1], extent[3])
+    return (ground_surface(x, y, extent) - 30. - 40. * v - 3. * layer
+            + 5. * np.sin(2 * np.pi * months / 12.) - 0.02 * months * (1. + u))
+
+
+def make_stratigraphy(nodes, nlayers=4):
+    '''
+    Stratigraphy like read_stratigraphy: GSE and, for each layer, the thickness of the aquitard
+    above it (A) and of the layer (L)
+    '''
+    extent = grid_extent(nodes)
+    strat = pd.DataFrame({'GSE': ground_surface(nodes.x.values, nodes.y.values, extent)},
+                         index=nodes.index.rename('NodeID'))
+    for k in range(1, nlayers + 1):
+        strat['A%d' % k] = 0. if k == 1 else 10.
+        strat['L%d' % k] = 50. + 50. * k
+    return strat
+
+
+def grid_extent(nodes):
+    return nodes.x.min(), nodes.y.min(), nodes.x.max(), nodes.y.max()
+
+
+def write_nodes(file, nodes):
+    with open(file, 'w') as fh:
+        fh.write('C IWFM synthetic model nodes\nC\n')
+        fh.write('%10d  /ND\n%10.1f  / FACT\n' % (len(nodes), 1.))
+        np.savetxt(fh, np.column_stack([nodes.index.values, nodes.x.values, nodes.y.values]),
+                   fmt=['%8d', '%16.4f', '%16.4f'])
+
+
+def write_elements(file, elements):
+    nsubregions = int(elements['5'].max())
+    with open(file, 'w') as fh:
+        fh.write('C IWFM synthetic model elements\nC\n')
+        fh.write('%10d  / NE\n%10d  / NREGN\n' % (len(elements), nsubregions))
+        fh.write(''.join('Region%d  / RNAME%d\n' % (k, k) for k in range(1, nsubregions + 1)))
+        fh.write('C-----\nC   IE  IDE(1) IDE(2) IDE(3) IDE(4) IRGE\nC-----\n')
+        np.savetxt(fh, np.column_stack([elements.index.values, elements.values]), fmt='%8d')
+
+
+def write_stratigraphy(file, strat):
+    nlayers = (len(strat.columns) - 1) // 2
+    with open(file, 'w') as fh:
+        fh.write('C IWFM synthetic model stratigraphy\nC\n')
+        fh.write('%10d  /NL\n%10.1f  / FACT\n' % (nlayers, 1.))
+        fh.write('C   ID   GSE' + ''.join('   W(%d)' % k for k in range(1, 2 * nlayers + 1))
+                 + '\nC-----\n')
+        np.savetxt(fh, np.column_stack([strat.index.values, strat.values]),
+                   fmt=['%8d'] + ['%10.2f'] * len(strat.columns))
+
+
+def write_gwhead(file, times, heads):
+    '''
+    Writes a GW_HeadAll.out file of the times and their heads, an iterable of (layer, node) arrays
+    (e.g. a generator so that large files are written one timestep at a time)
+    '''
+    with open(file, 'w') as fh:
+        for step, values in zip(times, heads):
+            if fh.tell() == 0:
+                nnodes = values.shape[1]
+                title = ('GROUNDWATER HEAD AT ALL NODES', '(UNIT=FEET)')
+                fh.write('*' * 80 + '\n*\n*%50s\n*%45s\n*\n' % title)
+                fh.write('*%21s' % 'NODE' + ''.join('%12d' % (n + 1) for n in range(nnodes))
+                         + '\n')
+                fmt = '%12.4f' * nnodes + '\n'
+            stamp = step.strftime('%m/%d/%Y_24:00')
+            fh.write(''.join('%-22s' % (stamp if k == 0 else '') + fmt % tuple(layer)
+                             for k, layer in enumerate(values.tolist())))
+
+
+def make_stations(nodes, nstations, seed=0):
+    '''
+    Observation stations (site_code, x, y) at random locations in the grid, away from its edges
+    '''
+    xmin, ymin, xmax, ymax = grid_extent(nodes)
+    margin = 0.02 * min(xmax - xmin, ymax - ymin)
+    rng = np.random.default_rng(seed + 1)
+    return pd.DataFrame({'site_code': ['SYN%05d' % (i + 1) for i in range(nstations)],
+                         'x': rng.uniform(xmin + margin, xmax - margin, nstations),
+                         'y': rng.uniform(ymin + margin, ymax - margin, nstations)})
+
+
+def make_measurements(stations, extent, times, nmeasurements, noise=0.5, seed=0):
+    '''
+    Measurements (site_code, date, gwe) of the layer 1 head at the stations at random days of
+    nmeasurements timesteps each, with normal noise of sd noise
+    '''
+    rng = np.random.default_rng(seed + 2)
+    nmeasurements = min(nmeasurements, len(times))
+    shape = (len(stations), nmeasurements)
+    # distinct timesteps of each station
+    steps = np.sort(np.argsort(rng.random((len(stations), len(times))), axis=1)[:, :nmeasurements],
+                    axis=1)
+    days = rng.integers(0, 28, shape)
+    values = head_field(stations.x.values[:, None], stations.y.values[:, None], extent,
+                        steps - days / 30.) + rng.normal(0, noise, shape)
+    return pd.DataFrame({'site_code': np.repeat(stations.site_code.values, nmeasurements),
+                         'date': times[steps.ravel()] - pd.to_timedelta(days.ravel(), unit='D'),
+                         'gwe': values.ravel().round(2)})
+
+
+def write_model(folder, nnodes=100, nlayers=4, ntimes=120, nstations=20, nmeasurements=24,
+                start='1973-10-31', spacing=500., tri_fraction=0.25, seed=0):
+    '''
+    Writes a synthetic model of at least nnodes nodes (see grid_shape), nlayers layers and ntimes
+    monthly timesteps from start, and nstations observation stations of nmeasurements measurements
+    each, to folder. Returns the SyntheticModel of the files written
+    '''
+    os.makedirs(folder, exist_ok=True)
+    model = SyntheticModel(*[os.path.join(folder, f) for f in (
+        'Elements.dat', 'Nodes.dat', 'Stratigraphy.dat', 'GW_HeadAll.out', 'stations.csv',
+        'measurements.csv')], nlayers=nlayers,
+        times=pd.date_range(start, periods=ntimes, freq='ME', name='Time'))
+    nodes = make_nodes(nnodes, spacing=spacing, seed=seed)
+    extent = grid_extent(nodes)
+    write_nodes(model.nodes_file, nodes)
+    write_elements(model.elements_file, make_elements(nnodes, tri_fraction=tri_fraction, seed=seed))
+    write_stratigraphy(model.stratigraphy_file, make_stratigraphy(nodes, nlayers))
+    x, y = nodes.x.values, nodes.y.values
+    write_gwhead(model.head_file, model.times,
+                 (np.stack([head_field(x, y, extent, t, k) for k in range(nlayers)])
+                  for t in range(ntimes)))
+    stations = make_stations(nodes, nstations, seed=seed)
+    stations.to_csv(model.stations_file, index=False)
+    make_measurements(stations, extent, model.times, nmeasurements, seed=seed).to_csv(
+        model.measurements_file, index=False, date_format='%Y-%m-%d')
+    return model
@@ -1,5 +1,6 @@
 # trimesh animator
 import bisect
+import functools
 import math
 import os
 
@@ -10,6 +11,7 @@ import datashader as ds
 import holoviews as hv
 import holoviews.operation.datashader as hd
 import geoviews as gv
+import geoviews.operation  # gv.operation, its lazy import recurses in geoviews 1.15
 import geoviews.feature as gf
 import numpy as np
 import pandas as pd
@@ -26,23 +28,53 @@ from holoviews.plotting.util import process_cmap
 from PIL import Image
 
 import pyiwfm
+import pyiwfm.geo
+from pyiwfm import profiling
+from pyiwfm.lazy import DiffHeads
+
+
+@functools.lru_cache(maxsize=None)
+def load_extensions():
+    '''
+    Loads the holoviews bokeh and the panel extensions, once. Called by the animators rather than
+    on import so that importing pyiwfm does not initialize the plotting backends
+    '''
+    hv.extension('bokeh')
+    pn.extension()
 
-hv.extension('bokeh')
-pn.extension()
 #
 # from holoviews.util.transform import lon_lat_to_easting_northing as ll2en # only in holoviews 1.14 which breaks this code
 
 
+@profiling.stage()
 def convertxy(df, src_crs=ccrs.epsg('26910'), target_crs=ccrs.PlateCarree()):
     xyz = target_crs.transform_points(src_crs, df.x.values, df.y.values, None)
     dfm = df.copy()
     dfm.x = xyz[:, 0]
     dfm.y = xyz[:, 1]
     return dfm
+
+
+def mercator_nodes(nodes, nodes_file=None):
+    '''
+    Nodes (x, y) in Web Mercator, the crs of the map tiles, from the projection cached with
+    nodes_file (see geo.load_projected_nodes) or, without it, projected now. Animators given these
+    nodes (crs=ccrs.GOOGLE_MERCATOR) do not project the mesh again
+    '''
+    if nodes_file is None:
+        projected = pyiwfm.geo.project_nodes(nodes)
+    else:
+        projected = pyiwfm.geo.load_projected_nodes(nodes_file).loc[nodes.index]
+    return pd.DataFrame({'x': projected.mercator_x.values, 'y': projected.mercator_y.values},
+                        index=nodes.index)
 #
 
 
-def build_trimesh_simplex(dfe):
+def build_trimesh_simplex(dfe, node_ids=None):
+    '''
+    Triangles (quads split in two) as 0-based vertex positions. Node ids are taken as 1-based
+    positions unless node_ids, the order of the vertices (e.g. a subset of nodes), is given
+    '''
     if len(dfe.columns) == 5:
         dfe = dfe.drop(['5'], axis=1)
     dfq = dfe[dfe['4'] != 0]
@@ -57,6 +89,9 @@ def build_trimesh_simplex(dfe):
     dftri.columns = ['v1', 'v2', 'v3']
 
     dftri = pd.concat([dftri, dftri1, dftri2], axis=0, ignore_index=True)
+    if node_ids is not None:
+        positions = pd.Index(node_ids).get_indexer(dftri.values.ravel())
+        return pd.DataFrame(positions.reshape(dftri.shape), columns=dftri.columns)
     # adjust trimesh simplices by -1 to adjust from 1-based to 0-based
     dftri = dftri - 1
     return dftri
@@ -106,6 +141,13 @@ class GWHeadAnimator(param.Parameterized):
     layer = param.Integer(default=1, bounds=(1,4))
     year = param.ObjectSelector(default='',objects=['']) # will be set in constructor
     depth = param.Boolean(default=True, doc='If true then show depth values else show level (referenced to a datum)')
+    difference = param.Boolean(default=True,
+                               doc='For two runs show the difference, else the heads of the run')
+    run = param.ObjectSelector(default='', objects=[''], doc='Run of the ensemble shown')
+    resolution = param.ObjectSelector(default='month', objects=['month', 'water_year', 'decade'],
+                                      doc='Time resolution, coarser levels are precomputed')
+    aggregate = param.ObjectSelector(default='mean', objects=['mean', 'min', 'max'],
+                                     doc='Aggregate of the heads over the time resolution')
     draw_contours = param.Boolean(default=False, doc='Draw contours')
     do_shading = param.Boolean(default=False, doc='Do datashading (holoviz)')
     fix_color_range = param.Boolean(
@@ -114,6 +156,7 @@ class GWHeadAnimator(param.Parameterized):
     color_map = param.Selector(default='rainbow4', objects=linear_perceptual_cmaps, doc='Color Map to use')
 
     def __init__(self, dfe, dfn0, dfgwh, dfgse, **kwargs):
+        load_extensions()
         self.current_color_map = self.color_map
         self.cmap_rainbow = process_cmap(self.color_map, provider="colorcet")
         self.tiles = gv.tile_sources.CartoLight().opts(
@@ -123,36 +166,79 @@ class GWHeadAnimator(param.Parameterized):
                        'tools': ['hover'], 'alpha': 0.5, 'logz': False,
                        'min_width': 900, 'min_height': 700}  # 'clim': (0,100)}
         self.title = kwargs.pop('title','')
+        crs = kwargs.pop('crs', ccrs.PlateCarree())  # of the nodes
+        self.ensemble = kwargs.pop('ensemble', None)
+        self.levels = kwargs.pop('levels', None)
         self.shaded_opts = self.hvopts.copy()
         for key in ['cmap', 'colorbar', 'logz', 'tools']:
             self.shaded_opts.pop(key)
         self.overlay = None
         self.dmap = None
         super().__init__(**kwargs)
-        self.trimesh = gv.TriMesh((build_trimesh_simplex(dfe), gv.Points(dfn0, vdims='z')))
-        self.trimesh = gv.operation.project(self.trimesh)
+        with profiling.timed('trimesh_animator.project'):
+            self.trimesh = gv.TriMesh((build_trimesh_simplex(dfe, dfn0.index),
+                                       gv.Points(dfn0, vdims='z', crs=crs)), crs=crs)
+            if crs != ccrs.GOOGLE_MERCATOR:  # the crs of the map tiles
+                self.trimesh = gv.operation.project(self.trimesh)
         self.dfgwh = dfgwh
         self.dfgse = dfgse
         self.layer = 1  # layers are 1-based
         # setup parameter based on index
         self.param.year.objects=list(self.dfgwh[self.layer-1].index)
         self.year=self.dfgwh[self.layer-1].index[0]
+        if self.ensemble is not None:
+            self.param.run.objects = list(self.ensemble.runs)
+            self.run = self.ensemble.runs[0]
         #
 
+    def update_heads(self, dfgwh):
+        '''
+        Replaces the heads with dfgwh (e.g. with timesteps appended by a running simulation) and
+        adds any new times to the year selector, the displayed year is kept
+        '''
+        self.dfgwh = dfgwh
+        self.param.year.objects = list(self.dfgwh[self.layer - 1].index)
+
+    @param.depends('resolution', 'aggregate', watch=True)
+    def update_level(self):
+        '''
+        Switches to the heads at the selected time resolution (levels returns them for a resolution
+        and aggregate) and shows the first time at or after the displayed one
+        '''
+        if self.levels is None:
+            return
+        year = self.year
+        self.update_heads(self.levels(self.resolution, self.aggregate))
+        index = self.dfgwh[self.layer - 1].index
+        self.year = index[min(index.searchsorted(year), len(index) - 1)]
+
     def keep_zoom(self, x_range, y_range):
         self.startX, self.endX = x_range
         self.startY, self.endY = y_range
 
+    def current_heads(self):
+        '''
+        The heads shown: the heads of the selected run of an ensemble or, for the difference of two
+        runs (DiffHeads), the heads of the run when difference is off
+        '''
+        if self.ensemble is not None:
+            return pyiwfm.ensemble.run_heads(self.ensemble, self.run)
+        if isinstance(self.dfgwh, DiffHeads) and not self.difference:
+            return self.dfgwh.heads
+        return self.dfgwh
+
     # @param.depends('year','depth')
-    def update_mesh(self, year, depth):
-        if year not in self.dfgwh[self.layer - 1].index:
+    def update_mesh(self, year, depth, difference=True, run='', resolution='month',
+                    aggregate='mean'):
+        dfgwh = self.current_heads()
+        if year not in dfgwh[self.layer - 1].index:
             self.trimesh.nodes.data.z = np.nan
         else:
             if depth:
                 self.trimesh.nodes.data.z = self.dfgse['GSE'].values - \
-                    self.dfgwh[self.layer - 1].loc[year, :].values
+                    dfgwh[self.layer - 1].loc[year, :].values
             else:
-                self.trimesh.nodes.data.z = self.dfgwh[self.layer - 1].loc[year, :].values
+                self.trimesh.nodes.data.z = dfgwh[self.layer - 1].loc[year, :].values
         return self.trimesh
 
     @param.depends('draw_contours', 'do_shading', 'fix_color_range', 'color_range', 'color_map', watch=True)
@@ -166,8 +252,12 @@ class GWHeadAnimator(param.Parameterized):
                 self.cmap_rainbow = process_cmap(self.color_map)
         self.hvopts['cmap'] = self.cmap_rainbow
         if self.dmap is None:   
-            self.dmap = hv.DynamicMap(self.update_mesh, streams=[self.param.year, self.param.depth], cache_size=1) 
-            self.dmap = self.dmap.redim.values(year=self.dfgwh[0].index, depth=[True, False])
+            streams = [self.param.year, self.param.depth, self.param.difference, self.param.run,
+                       self.param.resolution, self.param.aggregate]
+            self.dmap = hv.DynamicMap(self.update_mesh, streams=streams, cache_size=1)
+            self.dmap = self.dmap.redim.values(year=self.dfgwh[0].index, depth=[True, False],
+                                               difference=[True, False],
+                                               run=self.param.run.objects)
         # create mesh and contours
         mesh = hd.rasterize(self.dmap, precompute=True, aggregator=ds.mean('z'))
         if self.fix_color_range:
@@ -199,20 +289,84 @@ class GWHeadAnimator(param.Parameterized):
         return overlay
 
 
-def build_gwh_animator(elements_file, nodes_file, stratigraphy_file, gw_head_file, gw_head_file_base=None, recache=False, title=''):
+@profiling.stage()
+def build_gwh_animator(elements_file, nodes_file, stratigraphy_file, gw_head_file,
+                       gw_head_file_base=None, recache=False, title='', workers=1, lazy=False,
+                       bbox=None, subregion=None, node_major=False):
+    '''
+    node_major also keeps the node major copy of the heads cache and reads the heads lazily, so that
+    frames (animation) are read from the time major cube and time series from the node major copy
+    '''
     # load data from files and convert to map crs
-    grid_data = pyiwfm.load_data(elements_file, nodes_file, stratigraphy_file)
-    dfgwh = pyiwfm.load_gwh(gw_head_file, grid_data.nlayers, recache=recache)
+    grid_data = pyiwfm.load_data(elements_file, nodes_file, stratigraphy_file, bbox=bbox,
+                                 subregion=subregion)
+    nodes = None if bbox is None and subregion is None else grid_data.nodes.index
+    lazy = lazy or node_major
+    dfgwh = pyiwfm.load_gwh(gw_head_file, grid_data.nlayers, recache=recache, workers=workers,
+                            lazy=lazy, nodes=nodes, node_major=node_major)
     if gw_head_file_base:
-        dfgwhb = pyiwfm.load_gwh(gw_head_file_base, grid_data.nlayers, recache=recache)
+        dfgwhb = pyiwfm.load_gwh(gw_head_file_base, grid_data.nlayers, recache=recache,
+                                 workers=workers, lazy=lazy, nodes=nodes, node_major=node_major)
         dfgwh = pyiwfm.reader.diff_heads(dfgwh, dfgwhb)
-    dfn0 = convertxy(grid_data.nodes)
+    level_heads = {('month', None): dfgwh}
+
+    def levels(resolution, how):
+        level = pyiwfm.reader.gwh_level(resolution, how)
+        if level not in level_heads:
+            heads = [pyiwfm.load_gwh(f, grid_data.nlayers, lazy=lazy, nodes=nodes,
+                                     resolution=level[0], how=level[1])
+                     for f in filter(None, [gw_head_file, gw_head_file_base])]
+            level_heads[level] = pyiwfm.reader.diff_heads(*heads) if len(heads) > 1 else heads[0]
+        return level_heads[level]
+    dfn0 = mercator_nodes(grid_data.nodes, nodes_file)
     dfgw0 = dfgwh[0]
     dfn0['z'] = dfgw0.iloc[0, :].values
     # make animator
     return GWHeadAnimator(grid_data.elements, dfn0, dfgwh, grid_data.stratigraphy, 
                           name='Groundwater Level %s Animator' % ('' if gw_head_file_base == None else 'Difference'),
-                          title=title)
+                          title=title, levels=levels, crs=ccrs.GOOGLE_MERCATOR)
+
+
+@profiling.stage()
+def build_ensemble_animator(store_dir, title='', bbox=None, subregion=None):
+    '''
+    Animator for the runs of an ensemble store (see pyiwfm.ensemble.build_ensemble) with a selector
+    for the run. The grid is read once and the heads of each run are views of its cube
+    '''
+    ensemble = pyiwfm.ensemble.load_ensemble(store_dir)
+    grid_data = pyiwfm.reader.subset_grid(ensemble.grid_data, bbox=bbox, subregion=subregion)
+    if bbox is not None or subregion is not None:
+        cubes = [pyiwfm.reader.subset_gwh_cube(cube, grid_data.nodes.index)
+                 for cube in ensemble.cubes]
+        ensemble = ensemble._replace(grid_data=grid_data, cubes=cubes)
+    dfgwh = pyiwfm.ensemble.run_heads(ensemble, ensemble.runs[0])
+    manifest = pyiwfm.cache.read_manifest(pyiwfm.ensemble.ensemble_filename(store_dir))
+    dfn0 = mercator_nodes(grid_data.nodes, manifest['grid'][1])  # of the nodes file of the grid
+    dfn0['z'] = dfgwh[0].iloc[0, :].values
+    return GWHeadAnimator(grid_data.elements, dfn0, dfgwh, grid_data.stratigraphy,
+                          name='Groundwater Level Ensemble Animator', title=title,
+                          ensemble=ensemble, crs=ccrs.GOOGLE_MERCATOR)
+
+
+def follow_heads(gwa, gw_head_file, period=10):
+    '''
+    Checks the head file of a simulation that is still running every period seconds, appends the new
+    timesteps to its cache and pushes them to the animator. Returns the panel periodic callback
+    (call stop() to stop following)
+    '''
+    gwa.resolution = 'month'
+    gwa.levels = None  # the aggregation levels are not followed
+    nlayers = len(gwa.dfgwh)
+    nodes = gwa.dfgwh[0].columns
+
+    def check_for_new_heads():
+        if pyiwfm.reader.update_gwh_cube(gw_head_file, nlayers):
+            cube = pyiwfm.load_gwh_cube(gw_head_file)
+            if len(nodes) != len(cube.columns):  # animating a subset of the nodes
+                cube = pyiwfm.reader.subset_gwh_cube(cube, nodes)
+            gwa.update_heads(pyiwfm.reader.gwh_cube_layers(cube))
+
+    return pn.state.add_periodic_callback(check_for_new_heads, period=int(period * 1000))
 
 
 def build_description_pane():
@@ -238,9 +392,14 @@ def build_description_pane():
     Drag the slider or select the slider and then use forward and back arrow keys to step through time
 
     The depth checkbox allows for toggling between displaying Groundwater depth and Groundwater level (UTM Z10N, NAVD 83)
+
+    ### Resolution and Aggregate
+    Steps through water years (mean, min or max) or decades (mean) instead of the model timesteps.
+    These are precomputed with the cache of the heads, so playback reads far less data
     ''')
 
 
+@profiling.stage()
 def build_panel(gwa):
     # Define control components for the color controls tab
     col1 = pn.Column(gwa.param.draw_contours, gwa.param.do_shading)
@@ -249,6 +408,13 @@ def build_panel(gwa):
     year_slider = pn.widgets.DiscretePlayer.from_param(gwa.param.year, name='Year')
     depth_checkbox = pn.widgets.Checkbox.from_param(gwa.param.depth, name='Depth', sizing_mode='stretch_width')
     row3 = pn.Row(year_slider, depth_checkbox, sizing_mode='stretch_width')
+    if isinstance(gwa.dfgwh, DiffHeads):
+        row3.append(pn.widgets.Checkbox.from_param(gwa.param.difference, name='Difference'))
+    if gwa.ensemble is not None:
+        row3.append(pn.widgets.Select.from_param(gwa.param.run, name='Run'))
+    if gwa.levels is not None:
+        row3.append(pn.widgets.Select.from_param(gwa.param.resolution, name='Resolution'))
+        row3.append(pn.widgets.Select.from_param(gwa.param.aggregate, name='Aggregate'))
     color_controls = pn.Column(
         pn.pane.Markdown("### Color Controls"),
         col1, 
@@ -301,6 +467,7 @@ def show_side_by_side_animator(edge_file1, node_file1, gse_file1, gw_head_file1,
     gwa2 = build_gwh_animator(edge_file2, node_file2, gse_file2, gw_head_file2, recache=recache, title=title2)
     return build_side_by_side_animator_panel(gwa1, gwa2)    
 
+@profiling.stage()
 def build_side_by_side_animator_panel(gwa1, gwa2, title='Groundwater Level Animator Side by Side'):
     @param.depends(gwa1.param.draw_contours, gwa1.param.do_shading,
                    gwa1.param.fix_color_range, gwa1.param.color_range, gwa1.param.color_map)
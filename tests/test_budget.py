@@ -0,0 +1,78 @@
+import h5py
+import numpy as np
+import pandas as pd
+import pytest
+
+from pyiwfm import budget, reader
+from tests.test_reader import small_heads
+
+
+def write_budget(file, ntimes=30, transposed=False):
+    names = ['Subregion 1 (SR1)', 'Subregion 2 (SR2)', 'ENTIRE MODEL AREA']
+    headers = ['Time', 'Deep Percolation', 'Pumping', 'Storage']
+    values = np.arange(len(names) * ntimes * 3, dtype='float').reshape(len(names), ntimes, 3)
+    with h5py.File(file, 'w') as h5:
+        attrs = h5.create_group('Attributes')
+        attrs.attrs['NTimeSteps'] = ntimes
+        attrs.attrs['TimeStep%BeginDateAndTime'] = b'10/31/1973_24:00'
+        attrs.attrs['TimeStep%Unit'] = b'1MON'
+        attrs.attrs['cLocationNames'] = np.array([n.encode() for n in names])
+        attrs.attrs['LocationData1%cFullColumnHeaders'] = np.array([h.encode() for h in headers])
+        for name, data in zip(names, values):
+            h5.create_dataset(name, data=data.T if transposed else data)
+    return names, headers[1:], values
+
+
+@pytest.mark.parametrize('transposed', [False, True])
+def test_budget(tmp_path, transposed):
+    file = str(tmp_path / 'GW_Budget.hdf')
+    names, headers, values = write_budget(file, transposed=transposed)
+    with budget.load_budget(file) as bud:
+        assert list(bud) == names
+        sr2 = bud['Subregion 2 (SR2)']
+        assert list(sr2.columns) == headers and len(sr2.index) == 30
+        # same time axis as the heads
+        times, _ = small_heads(ntimes=30)
+        assert (sr2.index == times).all()
+        pd.testing.assert_series_equal(sr2.loc[:, 'Pumping'],
+                                       pd.Series(values[1, :, 1], index=times.rename('Time'),
+                                                 name='Pumping'))
+        assert np.array_equal(sr2.loc[times[[2, 7, 5]], ['Storage', 'Deep Percolation']].values,
+                              values[1][np.ix_([2, 7, 5], [2, 0])])
+        assert sr2.iloc[4, 2] == values[1, 4, 2]
+        assert np.array_equal(sr2.to_frame().values, values[1])
+        wy = bud.aggregate('water_year', 'sum')
+        expected = sr2.to_frame().groupby(reader.water_years(times)).sum()
+        assert np.array_equal(wy['Subregion 2 (SR2)'].values, expected.values)
+        assert list(wy['ENTIRE MODEL AREA'].index.year) == [1974, 1975, 1976]
+        cached = bud.aggregate('water_year', 'sum')
+        pd.testing.assert_frame_equal(cached['Subregion 1 (SR1)'], wy['Subregion 1 (SR1)'])
+
+
+def test_zone_budget(tmp_path):
+    file = str(tmp_path / 'GW_ZBudget.hdf')
+    rng = np.random.default_rng(0)
+    data = {name: rng.normal(size=(12, 5)) for name in ['Deep Percolation', 'Pumping']}
+    with h5py.File(file, 'w') as h5:
+        attrs = h5.create_group('Attributes')
+        attrs.attrs['NTimeSteps'] = 12
+        attrs.attrs['TimeStep%BeginDateAndTime'] = b'10/31/1973_24:00'
+        attrs.attrs['TimeStep%Unit'] = b'1MON'
+        layer = h5.create_group('Layer_1')
+        for name, values in data.items():
+            layer.create_dataset(name, data=values)
+    zones = pd.Series([1, 1, 2, 2, 2], index=[1, 2, 3, 4, 5])
+    with budget.load_zone_budget(file, zones) as zbud:
+        assert list(zbud) == [1, 2]
+        zone2 = zbud[2]
+        assert np.allclose(zone2.loc[:, 'Pumping'].values, data['Pumping'][:, 2:].sum(axis=1))
+        assert np.allclose(zone2.iloc[3, :].values,
+                           [data['Deep Percolation'][3, 2:].sum(), data['Pumping'][3, 2:].sum()])
+        assert len(zbud.aggregate('water_year', 'mean')[1]) == 1
+
+
+def test_budget_times():
+    times = budget.budget_times('09/30/1990_24:00', 3, '1DAY')
+    assert list(times.day) == [30, 1, 2]
+    with pytest.raises(ValueError, match='1WEEK'):
+        budget.budget_times('09/30/1990_24:00', 3, '1WEEK')
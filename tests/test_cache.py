@@ -0,0 +1,129 @@
+import os
+
+import pytest
+
+from pyiwfm import cache
+
+
+def write(file, text, mtime=None):
+    with open(file, 'w') as fh:
+        fh.write(text)
+    if mtime is not None:
+        os.utime(file, ns=(mtime, mtime))
+
+
+def test_manifest_roundtrip(tmp_path):
+    source = str(tmp_path / 'source.txt')
+    cache_file = str(tmp_path / 'source.txt.cache')
+    write(source, 'abc')
+    write(cache_file, 'cached')
+    assert not cache.is_cache_valid(cache_file, source)  # no manifest yet
+    cache.write_manifest(cache_file, source, nlayers=4, parser_version=1)
+    assert cache.is_cache_valid(cache_file, source, nlayers=4, parser_version=1)
+    assert not cache.is_cache_valid(cache_file, source, nlayers=3, parser_version=1)
+    assert not cache.is_cache_valid(cache_file, source, nlayers=4, parser_version=2)
+    cache.remove_manifest(cache_file)
+    assert not cache.is_cache_valid(cache_file, source, nlayers=4, parser_version=1)
+
+
+def test_source_changes_invalidate(tmp_path):
+    source = str(tmp_path / 'source.txt')
+    cache_file = str(tmp_path / 'source.txt.cache')
+    write(source, 'abc', mtime=10**18)
+    write(cache_file, 'cached')
+    cache.write_manifest(cache_file, source)
+    write(source, 'abcd', mtime=10**18)  # size changed
+    assert not cache.is_cache_valid(cache_file, source)
+    cache.write_manifest(cache_file, source)
+    write(source, 'abce', mtime=2 * 10**18)  # same size, rewritten
+    assert not cache.is_cache_valid(cache_file, source)
+
+
+def test_content_hash_accepts_touched_source(tmp_path):
+    source = str(tmp_path / 'source.txt')
+    cache_file = str(tmp_path / 'source.txt.cache')
+    write(source, 'abc', mtime=10**18)
+    write(cache_file, 'cached')
+    cache.write_manifest(cache_file, source, content_hash=True)
+    os.utime(source, ns=(2 * 10**18, 2 * 10**18))
+    assert cache.is_cache_valid(cache_file, source)
+    write(source, 'abd', mtime=3 * 10**18)
+    assert not cache.is_cache_valid(cache_file, source)
+
+
+def write_cache(cache_file, nbytes):
+    with cache.atomic_write(cache_file) as fh:
+        fh.write(b'x' * nbytes)
+
+
+@pytest.fixture
+def cache_dir(tmp_path):
+    root = str(tmp_path / 'cache')
+    cache.configure(cache_dir=root)
+    yield root
+    cache.configure()
+
+
+def test_cache_dir(tmp_path, cache_dir):
+    import numpy as np
+    from pyiwfm import reader
+    from tests.test_reader import small_heads, write_gwhead
+    model = tmp_path / 'model'
+    model.mkdir()
+    file = str(model / 'GW_HeadAll.out')
+    times, heads = small_heads()
+    write_gwhead(file, times, heads)
+    os.chmod(model, 0o555)  # read only model archive
+    try:
+        # looking a cache up does not create its entry
+        assert not reader.is_gwh_cube_valid(file, nlayers=3)
+        assert cache.cache_entries() == [] and not os.path.exists(cache_dir)
+        dfheads = reader.read_and_cache(file, nlayers=3)
+        assert np.allclose(dfheads[1].values, heads[:, 1, :])
+        assert sorted(os.listdir(model)) == ['GW_HeadAll.out']
+        cube_file = reader.gwh_cube_filename(file)
+        assert cube_file.startswith(cache_dir)
+        assert os.path.dirname(cube_file) == cache.entry_dirname(file)
+        assert reader.is_gwh_cube_valid(file, nlayers=3)
+    finally:
+        os.chmod(model, 0o755)
+    # a cache next to the source file is still used
+    local = str(tmp_path / 'data.csv')
+    write(local, 'a,b\n1,2\n')
+    write(local + '.pik', '')
+    assert cache.cache_filename(local, '.pik') == local + '.pik'
+
+
+def test_evict(tmp_path, cache_dir):
+    sources = []
+    for i in range(3):
+        source = str(tmp_path / f'source{i}.txt')
+        write(source, 'abc')
+        cache_file = cache.cache_filename(source, '.cache')
+        write_cache(cache_file, 1000)
+        cache.write_manifest(cache_file, source)
+        os.utime(cache.entry_dirname(source), ns=(i * 10**9, i * 10**9))
+        sources.append(source)
+    assert len(cache.cache_entries()) == 3
+    # using the oldest entry makes the second one least recently used
+    assert cache.is_cache_valid(cache.cache_filename(sources[0], '.cache'), sources[0])
+    cache.configure(cache_dir=cache_dir, max_bytes='2.5K')
+    removed = cache.evict()
+    assert removed == [cache.entry_dirname(sources[1])]
+    assert not os.path.exists(cache.entry_dirname(sources[1]))
+    # the entry being written is kept, the others are removed to fit it
+    cache.configure(cache_dir=cache_dir, max_bytes=1500)
+    cache_file = cache.cache_filename(sources[1], '.cache')
+    write_cache(cache_file, 1000)
+    cache.write_manifest(cache_file, sources[1])
+    assert [entry for _, _, entry in cache.cache_entries()] == [cache.entry_dirname(sources[1])]
+
+
+def test_cache_env(tmp_path, monkeypatch):
+    monkeypatch.setenv(cache.CACHE_DIR_ENV, str(tmp_path / 'cache'))
+    monkeypatch.setenv(cache.CACHE_MAX_BYTES_ENV, '20G')
+    assert cache.cache_dir() == str(tmp_path / 'cache')
+    assert cache.cache_max_bytes() == 20 << 30
+    monkeypatch.delenv(cache.CACHE_DIR_ENV)
+    source = str(tmp_path / 'source.txt')
+    assert cache.cache_filename(source, '.cube') == source + '.cube'
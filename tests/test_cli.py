@@ -1,4 +1,17 @@
+import subprocess
+import sys
+
 from pyiwfm import cli
 
+
 def test_cli_template():
     assert cli.cli() is None
+
+
+def test_import_is_lazy():
+    # the visualization and interpolation packages are only imported when used
+    code = ('import sys, pyiwfm;'
+            'heavy = ["holoviews", "panel", "matplotlib", "scipy", "geopandas"];'
+            'assert not [m for m in heavy if m in sys.modules], sys.modules.keys();'
+            'pyiwfm.load_obs_stations; assert "geopandas" in sys.modules')
+    subprocess.run([sys.executable, '-c', code], check=True)
@@ -0,0 +1,85 @@
+import numpy as np
+import pytest
+
+from pyiwfm import ensemble, reader, sketch
+from tests.test_reader import small_heads, write_gwhead, write_grid
+
+
+def write_runs(folder, nruns=3):
+    grid_files = write_grid(str(folder))
+    times, heads = small_heads(nnodes=9)
+    head_files = []
+    for i in range(nruns):
+        (folder / f'run{i}').mkdir()
+        head_files.append(str(folder / f'run{i}' / 'GW_HeadAll.out'))
+        write_gwhead(head_files[-1], times, heads + 10 * i)
+    return grid_files, head_files, times, heads
+
+
+def test_build_ensemble(tmp_path):
+    grid_files, head_files, times, heads = write_runs(tmp_path)
+    store = str(tmp_path / 'store')
+    ens = ensemble.build_ensemble(store, *grid_files, head_files, workers=1)
+    assert ens.runs == ['run0', 'run1', 'run2']
+    assert ens.node_data.shape == (3, 9, 3, len(times))
+    assert len(ens.grid_data.nodes) == 9
+    # one run, one frame and all runs, one node
+    assert np.allclose(ensemble.run_frame(ens, 'run1', times[2], layer=1).values,
+                       heads[2, 1, :] + 10)
+    assert np.allclose(ensemble.run_heads(ens, 'run2')[0].values, heads[:, 0, :] + 20)
+    dfnode = ensemble.node_heads(ens, 4, layer=2)
+    assert list(dfnode.columns) == ens.runs and (dfnode.index == times).all()
+    assert np.allclose(dfnode.values, heads[:, 2, 3][:, None] + [0, 10, 20])
+    assert ensemble.is_ensemble_valid(store)
+    write_gwhead(head_files[1], times[:-1], heads[:-1])
+    assert not ensemble.is_ensemble_valid(store)
+    with pytest.raises(ValueError):
+        ensemble.build_ensemble(store, *grid_files, head_files, workers=1)
+
+
+def test_build_ensemble_parallel(tmp_path):
+    grid_files, head_files, times, heads = write_runs(tmp_path)
+    store = str(tmp_path / 'store')
+    ens = ensemble.build_ensemble(store, *grid_files, head_files, runs=['a', 'b', 'c'],
+                                  workers=2, chunk_bytes=64)
+    assert np.allclose(np.asarray(ens.node_data).transpose(3, 0, 2, 1),
+                       heads[:, :, None, :] + np.array([0, 10, 20])[:, None])
+    assert ensemble.load_ensemble(store).runs == ['a', 'b', 'c']
+
+
+def test_ensemble_statistics(tmp_path):
+    grid_files, head_files, times, heads = write_runs(tmp_path, nruns=5)
+    runs = heads[None] + 10 * np.arange(5)[:, None, None, None]
+    prefix = str(tmp_path / 'stats')
+    for kwargs in [{}, {'workers': 2, 'chunk_bytes': 64 * 32 * 4}]:
+        files = ensemble.ensemble_statistics(head_files, 3, prefix, **kwargs)
+        assert sorted(files) == ['mean', 'p10', 'p50', 'p90', 'std']
+        mean = reader.load_gwh(files['mean'], nlayers=3)
+        assert (mean[1].index == times).all()
+        assert np.allclose(mean[1].values, runs.mean(axis=0)[:, 1, :])
+        std = reader.load_gwh(files['std'], nlayers=3, lazy=True)
+        assert np.allclose(std[2].loc[:, :].values, runs.std(axis=0, ddof=1)[:, 2, :])
+        p10 = reader.load_gwh_cube(files['p10']).data
+        assert np.allclose(p10, np.quantile(runs, 0.1, axis=0, method='hazen'))
+    # approximate quantiles for more runs than the sketch keeps
+    files = ensemble.ensemble_statistics(head_files, 3, prefix, quantiles=[0.5], sketch_size=2)
+    assert np.allclose(reader.load_gwh_cube(files['p50']).data, heads + 20)
+
+
+def test_merge_sketches():
+    rng = np.random.default_rng(0)
+    x = rng.normal(size=(40, 3, 5))
+    x[3, 0, 0] = np.nan
+    s = sketch.merge_sketches(sketch.quantile_sketch(x[:15]), sketch.quantile_sketch(x[15:]))
+    expected = np.nanquantile(x, [0.1, 0.5, 0.9], axis=0, method='hazen')
+    assert np.allclose(sketch.sketch_quantiles(s, [0.1, 0.5, 0.9]), expected)
+    m = sketch.merge_moments(sketch.moments(x[:7]), sketch.moments(x[7:]))
+    assert np.allclose(sketch.moments_std(m), np.nanstd(x, axis=0, ddof=1))
+    assert (m.count == (~np.isnan(x)).sum(axis=0)).all()
+    x = rng.normal(size=(4000, 2))
+    s = sketch.quantile_sketch(x[:50], 32)
+    for i in range(50, 4000, 50):
+        s = sketch.merge_sketches(s, sketch.quantile_sketch(x[i:i + 50], 32), 32)
+    assert (s.count == 4000).all()
+    assert np.allclose(sketch.sketch_quantiles(s, [0.1, 0.5, 0.9]),
+                       np.quantile(x, [0.1, 0.5, 0.9], axis=0), atol=0.1)
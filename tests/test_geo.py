@@ -0,0 +1,58 @@
+import numpy as np
+import pandas as pd
+import pytest
+import shapely
+
+from pyiwfm import cache, geo, synthetic
+
+
+def test_elements_gdf():
+    nodes = synthetic.make_nodes(30)
+    elements = synthetic.make_elements(30, tri_fraction=0.5)
+    gdf = geo.elements_gdf(nodes, elements)
+    assert list(gdf.index) == list(elements.index)
+    # same polygons as built one element at a time
+    for eid in elements.index[::3]:
+        ids = elements.loc[eid, ['1', '2', '3', '4']]
+        expected = shapely.geometry.Polygon(nodes.loc[ids[ids != 0]].values.tolist())
+        assert shapely.equals_exact(gdf.geometry[eid], expected, 0)
+    assert np.isclose(gdf.area.sum(), (nodes.x.max() - nodes.x.min()) *
+                      (nodes.y.max() - nodes.y.min()))
+    # extra node columns are z
+    nodes3d = nodes.assign(ID=nodes.index.values)
+    assert geo.elements_gdf(nodes3d, elements).has_z.all()
+    gnodes = geo.nodes_gdf(nodes)
+    assert np.array_equal(gnodes.geometry.x.values, nodes.x.values)
+    assert gnodes.crs == 'EPSG:26910'
+    with pytest.raises(KeyError):
+        geo.elements_gdf(nodes.iloc[1:], elements)
+
+
+def test_interp_weights():
+    # a quad, a triangle (nan 4th node) and a degenerate triangle
+    x = np.array([[0., 2., 2., 0.], [0., 1., 0., np.nan], [0., 1., 2., np.nan]])
+    y = np.array([[0., 0., 1., 1.], [0., 0., 1., np.nan], [0., 1., 2., np.nan]])
+    xp, yp = np.array([1.5, 0.25, 1.]), np.array([0.25, 0.5, 1.])
+    weights = geo.interp_weights(xp, yp, x, y)
+    assert weights.shape == (3, 4)
+    assert np.allclose(weights[:2].sum(axis=1), 1) and weights[1, 3] == 0
+    # the weights reproduce the point
+    assert np.allclose(np.nansum(weights[:2] * x[:2], axis=1), xp[:2])
+    assert np.allclose(np.nansum(weights[:2] * y[:2], axis=1), yp[:2])
+    assert np.isnan(weights[2]).all()
+    assert np.allclose(geo.interp(1.5, 0.25, x[0], y[0]), weights[0])
+    with pytest.raises(ValueError):
+        geo.interp(1., 1., x[2, :3], y[2, :3])
+
+
+def test_load_projected_nodes(tmp_path):
+    model = synthetic.write_model(str(tmp_path), nnodes=50, ntimes=2)
+    projected = geo.load_projected_nodes(model.nodes_file)
+    nodes = synthetic.make_nodes(50)
+    assert list(projected.index) == list(nodes.index)
+    # the grid origin, near Stockton, and the Web Mercator of its longitude
+    assert np.allclose(projected.iloc[0][['lon', 'lat']], [-121.86, 37.94], atol=0.01)
+    assert np.isclose(projected.mercator_x.iloc[0], np.radians(projected.lon.iloc[0]) * 6378137)
+    assert cache.is_cache_valid(geo.projected_nodes_filename(model.nodes_file), model.nodes_file,
+                                crs='EPSG:26910')
+    pd.testing.assert_frame_equal(geo.load_projected_nodes(model.nodes_file), projected)
@@ -0,0 +1,105 @@
+import numpy as np
+import pandas as pd
+
+from pyiwfm import reader
+from pyiwfm.lazy import LazyHeads
+from tests.test_reader import small_heads, write_gwhead
+
+
+def lazy_heads(tmp_path, **kwargs):
+    times, heads = small_heads(ntimes=6, nlayers=3, nnodes=8)
+    file = str(tmp_path / 'GW_HeadAll.out')
+    write_gwhead(file, times, heads)
+    return times, heads, reader.load_gwh(file, nlayers=3, lazy=True, **kwargs)
+
+
+def test_lazy_matches_frames(tmp_path):
+    times, heads, gwh = lazy_heads(tmp_path)
+    frames = reader.load_gwh(str(tmp_path / 'GW_HeadAll.out'), nlayers=3)
+    assert list(gwh.keys()) == [0, 1, 2]
+    for k in gwh:
+        layer, df = gwh[k], frames[k]
+        assert (layer.index == df.index).all()
+        assert (layer.columns == df.columns).all()
+        pd.testing.assert_series_equal(layer.loc[times[2], :], df.loc[times[2], :])
+        pd.testing.assert_frame_equal(layer.loc[:, ['2', '5']], df.loc[:, ['2', '5']])
+        pd.testing.assert_frame_equal(layer.loc[times[1]:times[3], '3':'4'],
+                                      df.loc[times[1]:times[3], '3':'4'])
+        pd.testing.assert_series_equal(layer.iloc[:, 4], df.iloc[:, 4])
+        assert layer.iloc[3, 2] == df.iloc[3, 2]
+        pd.testing.assert_frame_equal(layer.iloc[[0, 5], [1, 7]], df.iloc[[0, 5], [1, 7]])
+        # anything else goes through the loaded layer
+        pd.testing.assert_series_equal(layer.mean(), df.mean())
+
+
+def test_lazy_memory_cap(tmp_path):
+    times, heads, gwh = lazy_heads(tmp_path, max_bytes=6 * 8 * 4 * 2)  # two float32 layers
+    for k in [0, 1, 2]:
+        gwh[k].to_frame()
+    assert list(gwh._frames.keys()) == [1, 2]
+    gwh[1].to_frame()
+    gwh[0].to_frame()
+    assert list(gwh._frames.keys()) == [1, 0]
+    assert np.allclose(gwh[0].to_frame().values, heads[:, 0, :])
+
+
+def test_lazy_diff_heads(tmp_path):
+    times, heads, gwh = lazy_heads(tmp_path)
+    diff = reader.diff_heads(gwh, gwh)
+    assert (diff[2].values == 0).all()
+
+
+def test_lazy_node_major(tmp_path):
+    times, heads = small_heads(ntimes=6, nlayers=3, nnodes=8)
+    file = str(tmp_path / 'GW_HeadAll.out')
+    write_gwhead(file, times, heads)
+    gwh = reader.load_gwh(file, nlayers=3, lazy=True, node_major=True)
+    assert gwh.cube.node_data.shape == (3, 8, 6)
+    assert np.allclose(np.asarray(gwh.cube.node_data), heads.transpose(1, 2, 0))
+    frames = reader.load_gwh(file, nlayers=3)
+    pd.testing.assert_frame_equal(gwh[2].loc[:, ['2', '7']], frames[2].loc[:, ['2', '7']])
+    pd.testing.assert_series_equal(gwh[1].loc[times[2], :], frames[1].loc[times[2], :])
+    # time series are read from the node major copy, frames from the time major cube
+    marked = LazyHeads(gwh.cube._replace(node_data=np.asarray(gwh.cube.node_data) + 0.5))
+    assert np.allclose(marked[1].iloc[:, 3], heads[:, 1, 3] + 0.5)
+    assert np.allclose(marked[0].loc[times[1]:times[4], ['1', '8']], heads[1:5, 0][:, [0, 7]] + 0.5)
+    assert np.allclose(marked[1].loc[times[2], :], heads[2, 1])
+    assert np.allclose(marked[1].iloc[2:4, :], heads[2:4, 1])
+    # the node major copy goes stale when the cube changes
+    write_gwhead(file, times[:4], heads[:4])
+    assert reader.load_gwh(file, nlayers=3, lazy=True).cube.node_data is None
+
+
+def test_node_major_frames(tmp_path):
+    times, heads = small_heads(ntimes=6, nlayers=3, nnodes=8)
+    file = str(tmp_path / 'GW_HeadAll.out')
+    write_gwhead(file, times, heads)
+    cube = reader.ensure_gwh_cube(file, nlayers=3, node_major=True)
+    layers = reader.gwh_cube_layers(cube, node_major=True)
+    assert np.shares_memory(layers[1].iloc[:, 3].values, cube.node_data)
+    assert np.allclose(layers[1].values, heads[:, 1, :])
+    dfgwh = reader.load_gwh(file, nlayers=3, node_major=True)
+    pd.testing.assert_frame_equal(dfgwh[2], reader.load_gwh(file, nlayers=3)[2])
+
+
+def test_diff_heads_view(tmp_path):
+    times, heads = small_heads(ntimes=6, nlayers=3, nnodes=8)
+    file, base_file = str(tmp_path / 'GW_HeadAll.out'), str(tmp_path / 'GW_HeadAll_base.out')
+    write_gwhead(file, times, heads)
+    write_gwhead(base_file, times[1:], heads[1:] * 0.5)  # base run starts a step later
+    for lazy in (False, True):
+        gwh = reader.load_gwh(file, nlayers=3, lazy=lazy)
+        base = reader.load_gwh(base_file, nlayers=3, lazy=lazy)
+        diff = reader.diff_heads(gwh, base)
+        assert list(diff) == [0, 1, 2] and diff[1].index.equals(gwh[1].index)
+        expected = heads * 0.5
+        expected[0] = np.nan
+        assert np.isnan(diff[1].loc[times[0], '3'])
+        assert np.isclose(diff[1].loc[times[2], '3'], expected[2, 1, 2])
+        assert np.allclose(diff[2].loc[times[3], :], expected[3, 2])
+        assert np.allclose(diff[0].iloc[:, 4], expected[:, 0, 4], equal_nan=True)
+        assert np.allclose(diff[1].iloc[[1, 4], [0, 7]], expected[[1, 4], 1][:, [0, 7]])
+        assert np.allclose(diff[2].to_frame(), expected[:, 2], equal_nan=True)
+        assert np.allclose(diff[2].values, expected[:, 2], equal_nan=True)
+        # neither run is modified
+        assert np.allclose(gwh[1].loc[:, :], heads[:, 1])
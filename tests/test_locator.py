@@ -0,0 +1,76 @@
+import os
+
+import numpy as np
+import shapely
+
+from pyiwfm import cache, ensemble, geo, locator, meshcalc, reader, synthetic
+from tests.test_ensemble import write_runs
+
+
+def test_locate():
+    nodes = synthetic.make_nodes(200)
+    elements = synthetic.make_elements(200, tri_fraction=0.5)
+    loc = locator.build_locator(nodes, elements)
+    xmin, ymin, xmax, ymax = synthetic.grid_extent(nodes)
+    rng = np.random.default_rng(0)
+    xp, yp = rng.uniform(xmin - 500, xmax + 500, 2000), rng.uniform(ymin - 500, ymax + 500, 2000)
+    location = locator.locate(loc, xp, yp)
+    # the same elements as shapely
+    polygons = geo.elements_gdf(nodes, elements).geometry
+    points = shapely.points(xp, yp)
+    inside = location.elements >= 0
+    assert np.array_equal(inside, shapely.covers(shapely.union_all(polygons.values), points))
+    assert shapely.covers(polygons.loc[location.elements[inside]].values, points[inside]).all()
+    # the weights of the nodes reproduce the points
+    weights, vertices = location.weights[inside], location.vertices[inside]
+    x = nodes.x.reindex(vertices.ravel()).values.reshape(vertices.shape)
+    assert np.allclose(np.nansum(weights * x, axis=1), xp[inside])
+    assert np.allclose(weights.sum(axis=1), 1) and (weights[vertices == 0] == 0).all()
+    assert np.isnan(location.weights[~inside]).all() and (location.vertices[~inside] == 0).all()
+
+
+def test_load_locator(tmp_path):
+    model = synthetic.write_model(str(tmp_path), nnodes=50, ntimes=2)
+    loc = locator.load_locator(model.elements_file, model.nodes_file)
+    assert cache.is_cache_valid(locator.locator_filename(model.elements_file), model.elements_file)
+    cached = locator.load_locator(model.elements_file, model.nodes_file)
+    for name in locator.ElementLocator._fields:
+        assert np.array_equal(getattr(loc, name), getattr(cached, name))
+    grid = reader.load_data(model.elements_file, model.nodes_file, model.stratigraphy_file)
+    assert list(cached.element_ids) == list(grid.elements.index)
+    os.utime(model.nodes_file, ns=(0, 0))  # rebuilt when the nodes change
+    assert not cache.is_cache_valid(locator.locator_filename(model.elements_file),
+                                    model.elements_file,
+                                    nodes=cache.source_fingerprint(model.nodes_file))
+
+
+def test_point_operator(tmp_path):
+    grid_files, head_files, times, heads = write_runs(tmp_path)
+    ens = ensemble.build_ensemble(str(tmp_path / 'store'), *grid_files, head_files, workers=1)
+    loc = locator.build_locator(ens.grid_data.nodes, ens.grid_data.elements)
+    # the centers of the 2 quads of subregion 1, in layers 1 and 3, and a point outside
+    operator = locator.point_operator(loc, [500., 1500., 5000.], [500., 500., 0.], [0, 2, 0],
+                                      points=['a', 'b', 'c'])
+    assert operator.matrix.shape == (3, 6) and list(operator.nodes) == [1, 2, 3, 4, 5, 6]
+    expected = np.stack([heads[:, 0, [0, 1, 4, 3]].mean(axis=1),
+                         heads[:, 2, [1, 2, 5, 4]].mean(axis=1)], axis=1)
+    for source in (ensemble.run_heads(ens, 'run1'), ensemble.run_heads(ens, 'run1', lazy=True),
+                   ens.cubes[1]):
+        df = locator.apply_point_operator(operator, source)
+        assert list(df.columns) == ['a', 'b', 'c'] and (df.index == times).all()
+        assert np.allclose(df[['a', 'b']].values, expected + 10) and df['c'].isna().all()
+    df = locator.apply_point_operator(operator, ens)
+    assert list(df.columns.levels[0]) == ens.runs
+    assert np.allclose(df['run2'][['a', 'b']].values, expected + 20)
+
+
+def test_least_squares_quads():
+    # a quad and a triangle, an observation in the half of the quad beyond its first triangle
+    nodes = np.array([[0., 0.], [1., 0.], [1., 1.], [0., 1.], [2., 0.]])
+    elements = np.array([[0, 1, 2, 3], [1, 4, 2, -1]])
+    values = meshcalc.build_least_squares_system(nodes, elements, [[0.2, 0.8], [1.2, 0.2]],
+                                                 [1., 2.], reg_weight=1e-6)
+    # the node values interpolate back to the observations
+    assert np.isclose(geo.interp(0.2, 0.8, nodes[:4, 0], nodes[:4, 1]) @ values[:4], 1.)
+    assert np.isclose(geo.interp(1.2, 0.2, nodes[[1, 4, 2], 0], nodes[[1, 4, 2], 1])
+                      @ values[[1, 4, 2]], 2., atol=1e-4)
@@ -0,0 +1,33 @@
+import json
+
+from pyiwfm import profiling, reader
+from tests.test_reader import write_grid
+
+
+def test_stages(tmp_path):
+    files = write_grid(str(tmp_path))
+    profiling.disable()
+    reader.load_data(*files)
+    assert profiling.records() == []
+    profiling.enable()
+    try:
+        reader.load_data(*files)
+        reader.load_data(*files)
+        with profiling.timed('test.block'):
+            reader.read_nodes(files[1])
+        names = [(r['depth'], r['name']) for r in profiling.records()]
+        assert names[:4] == [(0, 'reader.load_data'), (1, 'reader.read_elements'),
+                             (1, 'reader.read_nodes'), (1, 'reader.read_stratigraphy')]
+        assert names[-2:] == [(0, 'test.block'), (1, 'reader.read_nodes')]
+        df = profiling.summary()
+        assert df.loc[(0, 'reader.load_data'), 'calls'] == 2
+        assert df.loc[(1, 'reader.read_nodes'), 'calls'] == 3
+        assert (df['wall_s'] >= 0).all() and (df['peak_rss_mb'] > 0).all()
+        file = str(tmp_path / 'stages.json')
+        profiling.write_json(file)
+        with open(file) as fh:
+            saved = json.load(fh)
+        assert len(saved['records']) == 10 and saved['summary'][0]['name'] == 'reader.load_data'
+    finally:
+        profiling.disable()
+        profiling.reset()
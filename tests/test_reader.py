@@ -15,3 +15,402 @@ def test_read_and_cache_svsim_head():
     assert len(dfheads.keys()) == nlayers
     df1 = dfheads[0]
     assert len(df1) == 505
+
+
+def write_gwhead(file, times, heads):
+    '''write heads (ntimes, nlayers, nnodes) in GW_HeadAll.out format'''
+    nnodes = heads.shape[2]
+    with open(file, 'w') as fh:
+        fh.write('*' * 80 + '\n*\n*   GROUNDWATER HEAD AT ALL NODES\n*   (UNIT=FEET)\n*\n')
+        fh.write('*%21s' % 'NODE' + ''.join('%12d' % (i + 1) for i in range(nnodes)) + '\n')
+        for t, step in zip(times, heads):
+            for k, layer in enumerate(step):
+                stamp = t.strftime('%m/%d/%Y_24:00') if k == 0 else ''
+                fh.write('%-22s' % stamp + ''.join('%12.4f' % v for v in layer) + '\n')
+
+
+def small_heads(ntimes=5, nlayers=3, nnodes=7):
+    import numpy as np
+    import pandas as pd
+    times = pd.date_range('1973-10-31', periods=ntimes, freq='ME')
+    heads = np.arange(ntimes * nlayers * nnodes, dtype='float').reshape(ntimes, nlayers, nnodes)
+    heads = heads / 4 - 10
+    return times, heads
+
+
+def test_iter_gwhead(tmp_path):
+    times, heads = small_heads()
+    file = str(tmp_path / 'GW_HeadAll.out')
+    write_gwhead(file, times, heads)
+    steps = list(reader.iter_gwhead(file, nlayers=3))
+    assert len(steps) == len(times)
+    for (t, h), te, he in zip(steps, times, heads):
+        assert t == te
+        assert (h == he).all()
+
+
+def test_read_gwhead(tmp_path):
+    times, heads = small_heads()
+    file = str(tmp_path / 'GW_HeadAll.out')
+    write_gwhead(file, times, heads)
+    dfheads = reader.read_gwhead(file, nlayers=3)
+    assert list(dfheads.keys()) == [0, 1, 2]
+    df = dfheads[1]
+    assert df.index.name == 'Time'
+    assert list(df.columns) == [str(i) for i in range(1, 8)]
+    assert (df.values == heads[:, 1, :]).all()
+    assert df.index.freq == times.freq
+    assert reader.load_gwh(file, nlayers=3)[1].index.freq == times.freq
+
+
+def test_get_index_and_rearrange(tmp_path):
+    import pandas as pd
+    times, heads = small_heads()
+    file = str(tmp_path / 'GW_HeadAll.out')
+    write_gwhead(file, times, heads)
+    colspecs = [(0, 22)] + [(i * 12 + 22, i * 12 + 34) for i in range(7)]
+    df = pd.read_fwf(file, skiprows=6, header=None, colspecs=colspecs)
+    idx = reader.get_index(df.iloc[::3])
+    assert (idx == times).all() and idx.name == 'Time' and idx.freq == times.freq
+    layer = reader.rearrange(df.iloc[1::3], drop_first=True)
+    assert list(layer.columns) == [str(i) for i in range(1, 8)]
+    assert (layer.values == heads[:, 1, :]).all()
+
+
+def test_read_gwhead_ignores_incomplete_record(tmp_path):
+    times, heads = small_heads()
+    file = str(tmp_path / 'GW_HeadAll.out')
+    write_gwhead(file, times, heads)
+    with open(file) as fh:
+        lines = fh.readlines()
+    with open(file, 'w') as fh:
+        fh.writelines(lines[:-1])
+    dfheads = reader.read_gwhead(file, nlayers=3)
+    assert len(dfheads[0]) == len(times) - 1
+
+
+def test_read_and_cache_cube(tmp_path):
+    import numpy as np
+    times, heads = small_heads()
+    file = str(tmp_path / 'GW_HeadAll.out')
+    write_gwhead(file, times, heads)
+    dfheads = reader.read_and_cache(file, nlayers=3, recache=True)
+    cube = reader.load_gwh_cube(file)
+    assert cube.data.shape == heads.shape
+    assert isinstance(cube.data, np.memmap)
+    assert (cube.times == times).all()
+    layers = reader.gwh_cube_layers(cube)
+    for k in range(3):
+        assert np.shares_memory(layers[k].values, cube.data)
+        assert np.allclose(dfheads[k].values, heads[:, k, :])
+    # second call loads from the cache
+    dfheads = reader.read_and_cache(file, nlayers=3)
+    assert np.allclose(dfheads[2].loc[times[3], :].values, heads[3, 2, :])
+
+
+def test_read_and_cache_rebuilds_stale_cube(tmp_path):
+    import numpy as np
+    times, heads = small_heads()
+    file = str(tmp_path / 'GW_HeadAll.out')
+    write_gwhead(file, times, heads)
+    reader.read_and_cache(file, nlayers=3)
+    assert reader.is_gwh_cube_valid(file, nlayers=3)
+    assert not reader.is_gwh_cube_valid(file, nlayers=2)
+    # model re-run in place with one more timestep
+    times, heads = small_heads(ntimes=6)
+    write_gwhead(file, times, heads + 1)
+    assert not reader.is_gwh_cube_valid(file, nlayers=3)
+    dfheads = reader.read_and_cache(file, nlayers=3)
+    assert len(dfheads[0]) == 6
+    assert np.allclose(dfheads[0].values, heads[:, 0, :] + 1)
+
+
+def test_load_or_cache(tmp_path):
+    file = str(tmp_path / 'data.csv')
+    with open(file, 'w') as fh:
+        fh.write('a,b\n1,2\n')
+    assert reader.load_or_cache(file).shape == (1, 2)
+    assert reader.load_or_cache(file, usecols=['a']).shape == (1, 1)
+    with open(file, 'w') as fh:
+        fh.write('a,b\n1,2\n3,4\n')
+    assert reader.load_or_cache(file).shape == (2, 2)
+
+
+def test_read_gwhead_parallel(tmp_path):
+    import numpy as np
+    times, heads = small_heads(ntimes=23, nlayers=2, nnodes=5)
+    file = str(tmp_path / 'GW_HeadAll.out')
+    write_gwhead(file, times, heads)
+    ranges = reader.gwhead_byte_ranges(file, 8)
+    assert len(ranges) == 8
+    assert all(end == start for (_, end), (start, _) in zip(ranges[:-1], ranges[1:]))
+    dfheads = reader.read_gwhead(file, nlayers=2, workers=2)
+    assert (dfheads[1].index == times).all()
+    assert np.allclose(dfheads[1].values, heads[:, 1, :])
+    dfheads = reader.read_and_cache(file, nlayers=2, workers=2)
+    assert np.allclose(dfheads[0].values, heads[:, 0, :])
+    # more ranges than are kept in flight, still yielded in time order
+    blocks = list(reader.iter_gwhead_blocks(file, nlayers=2, workers=2, block_bytes=200))
+    assert len(blocks) > 4
+    assert [t for block_times, _ in blocks for t in block_times] == list(times)
+
+
+def test_read_gwhead_engines(tmp_path):
+    import numpy as np
+    import pytest
+    times, heads = small_heads(ntimes=9, nlayers=2, nnodes=6)
+    file = str(tmp_path / 'GW_HeadAll.out')
+    write_gwhead(file, times, heads)
+    for engine in reader.GWHEAD_ENGINES:
+        blocks = list(reader.iter_gwhead_blocks(file, nlayers=2, engine=engine, block_bytes=500))
+        assert sum(len(t) for t, _ in blocks) == len(times)
+        assert np.allclose(np.concatenate([h for _, h in blocks]), heads)
+    with pytest.raises(ValueError):
+        reader.read_gwhead(file, nlayers=2, engine='fortran')
+
+
+def test_read_gwhead_blank_fields(tmp_path):
+    import numpy as np
+    import pandas as pd
+    times, heads = small_heads(ntimes=3, nlayers=2, nnodes=4)
+    file = str(tmp_path / 'GW_HeadAll.out')
+    write_gwhead(file, times, heads)
+    with open(file) as fh:
+        lines = fh.readlines()
+    # blank last value of layer 2, first timestep
+    lines[7] = lines[7][:22 + 12 * 3] + ' ' * 12 + '\n'
+    with open(file, 'w') as fh:
+        fh.writelines(lines)
+    for engine in reader.GWHEAD_ENGINES:
+        dfheads = reader.read_gwhead(file, nlayers=2, engine=engine)
+        # nodes with missing values are kept as NaN
+        assert list(dfheads[1].columns) == ['1', '2', '3', '4']
+        assert np.isnan(dfheads[1].iloc[0, 3])
+        assert np.allclose(dfheads[1].iloc[1:, 3], heads[1:, 1, 3])
+        assert np.allclose(dfheads[0].values, heads[:, 0, :])
+    # the cube cache and the uncached window read agree on columns and dtype
+    cached = reader.load_gwh(file, nlayers=2, recache=True)
+    reader.cache.remove_manifest(reader.gwh_cube_filename(file))
+    window = reader.load_gwh(file, nlayers=2, start=times[0])
+    for k in range(2):
+        pd.testing.assert_frame_equal(window[k], cached[k], check_freq=False)
+
+
+def test_update_gwh_cube(tmp_path):
+    import numpy as np
+    times, heads = small_heads(ntimes=8, nlayers=2, nnodes=5)
+    file = str(tmp_path / 'GW_HeadAll.out')
+    full = str(tmp_path / 'full.out')
+    write_gwhead(full, times, heads)
+    with open(full, 'rb') as fh:
+        text = fh.read()
+    header_end = len(b''.join(text.splitlines(keepends=True)[:reader.GWHEAD_HEADER_LINES]))
+    record = (len(text) - header_end) // len(times)
+
+    def run_until(nbytes):  # simulation has written nbytes of records
+        with open(file, 'wb') as fh:
+            fh.write(text[:header_end + nbytes])
+
+    run_until(3 * record)
+    reader.read_and_cache(file, nlayers=2)
+    assert reader.update_gwh_cube(file, nlayers=2) == []
+    run_until(5 * record + record // 2 + 7)  # last record only partially written
+    added = reader.update_gwh_cube(file, nlayers=2)
+    assert list(added) == list(times[3:5])
+    cube = reader.load_gwh_cube(file)
+    assert np.allclose(cube.data, heads[:5])
+    run_until(8 * record)
+    assert list(reader.update_gwh_cube(file, nlayers=2)) == list(times[5:])
+    cube = reader.load_gwh_cube(file)
+    assert (cube.times == times).all()
+    assert np.allclose(cube.data, heads)
+    run_until(2 * record)  # re-run started over
+    assert len(reader.update_gwh_cube(file, nlayers=2)) == 2
+    assert np.allclose(reader.load_gwh_cube(file).data, heads[:2])
+    write_gwhead(file, times, heads + 1000)  # re-run with other values written past the cached part
+    assert len(reader.update_gwh_cube(file, nlayers=2)) == len(times)
+    assert reader.is_gwh_cube_valid(file, nlayers=2)
+    assert np.allclose(reader.load_gwh(file, nlayers=2)[1].values, heads[:, 1, :] + 1000)
+
+
+def test_load_gwh_header_only(tmp_path):
+    import numpy as np
+    times, heads = small_heads(ntimes=2, nlayers=2, nnodes=5)
+    file = str(tmp_path / 'GW_HeadAll.out')
+    write_gwhead(file, times[:0], heads[:0])  # no timestep written yet
+    dfheads = reader.load_gwh(file, nlayers=2)
+    assert list(dfheads.keys()) == [0, 1] and dfheads[0].empty
+    assert len(reader.load_gwh(file, nlayers=2, lazy=True, node_major=True)[1]) == 0
+    assert reader.load_gwh_cube(file).node_data.size == 0
+    assert reader.update_gwh_cube(file, nlayers=2) == []
+    write_gwhead(file, times, heads)
+    assert list(reader.update_gwh_cube(file, nlayers=2)) == list(times)
+    assert np.allclose(reader.load_gwh_cube(file).data, heads)
+
+
+def test_gwhead_index_and_windows(tmp_path):
+    import numpy as np
+    times, heads = small_heads(ntimes=12, nlayers=2, nnodes=5)
+    file = str(tmp_path / 'GW_HeadAll.out')
+    write_gwhead(file, times, heads)
+    info = reader.gwhead_info(file, nlayers=2)
+    assert (info.nlayers, info.nnodes, info.ntimes) == (2, 5, 12)
+    assert (info.start, info.end) == (times[0], times[-1])
+    offsets, index_times, end = reader.load_gwh_index(file, nlayers=2)
+    assert (index_times == times).all()
+    with open(file, 'rb') as fh:
+        fh.seek(int(offsets[4]))
+        assert fh.readline().startswith(times[4].strftime('%m/%d/%Y').encode())
+    dfheads = reader.read_gwhead(file, nlayers=2, start=times[3], end=times[6])
+    assert (dfheads[1].index == times[3:7]).all()
+    assert np.allclose(dfheads[1].values, heads[3:7, 1, :])
+    dfheads = reader.read_gwhead(file, nlayers=2, start='1974-06-15')
+    assert (dfheads[0].index == times[8:]).all()
+    assert len(reader.read_gwhead(file, nlayers=2, start='2000-01-01')[0]) == 0
+    # window parsed from the file when there is no cache, sliced from the cache otherwise
+    dfheads = reader.load_gwh(file, nlayers=2, end=times[2])
+    assert not reader.is_gwh_cube_valid(file, nlayers=2)
+    assert (dfheads[0].index == times[:3]).all()
+    reader.read_and_cache(file, nlayers=2)
+    dfheads = reader.load_gwh(file, nlayers=2, start=times[9])
+    assert np.allclose(dfheads[1].values, heads[9:, 1, :])
+    gwh = reader.load_gwh(file, nlayers=2, start=times[9], lazy=True)
+    assert np.allclose(gwh[1].loc[:, '3'].values, heads[9:, 1, 2])
+
+
+def write_grid(folder, nlayers=3):
+    '''write a 3 x 3 node grid of 2 quads (subregion 1) and a quad and 2 triangles (subregion 2)'''
+    import os
+    nodes = [(i + 1, 1000. * (i % 3), 1000. * (i // 3)) for i in range(9)]
+    elements = [(1, 1, 2, 5, 4, 1), (2, 2, 3, 6, 5, 1),
+                (3, 4, 5, 8, 0, 2), (4, 4, 8, 7, 0, 2), (5, 5, 6, 9, 8, 2)]
+    files = [os.path.join(folder, f) for f in ('Elements.dat', 'Nodes.dat', 'Stratigraphy.dat')]
+    with open(files[0], 'w') as fh:
+        fh.write('C elements\n%d  / NE\n' % len(elements))
+        fh.write('C   IE  IDE(1) IDE(2) IDE(3) IDE(4) IRGE\nC' + '-' * 40 + '\n')
+        fh.write(''.join('%6d' * 6 % e + '\n' for e in elements))
+    with open(files[1], 'w') as fh:
+        fh.write('C nodes\n%d  /ND\n1.0  / FACT\n' % len(nodes))
+        fh.write(''.join('%6d%14.2f%14.2f\n' % n for n in nodes))
+    with open(files[2], 'w') as fh:
+        fh.write('C stratigraphy\n%d  /NL\n1.0  / FACT\n' % nlayers)
+        fh.write('C   ID   GSE   W(1)   W(2)\nC' + '-' * 40 + '\n')
+        layers = '%8.1f%8.1f' % (0., 50.) * nlayers
+        fh.write(''.join('%6d%10.1f' % (n[0], 100. + n[0]) + layers + '\n' for n in nodes))
+    return files
+
+
+def test_load_data_subsets(tmp_path):
+    import numpy as np
+    files = write_grid(str(tmp_path))
+    grid = reader.load_data(*files)
+    assert list(grid.elements.index) == [1, 2, 3, 4, 5] and len(grid.nodes) == 9
+    sub = reader.load_data(*files, subregion=1)
+    assert list(sub.elements.index) == [1, 2]
+    assert list(sub.nodes.index) == [1, 2, 3, 4, 5, 6]
+    assert list(sub.stratigraphy.index) == [1, 2, 3, 4, 5, 6]
+    sub = reader.load_data(*files, bbox=(0, 500, 2000, 2000))
+    assert list(sub.nodes.index) == [4, 5, 6, 7, 8, 9]
+    assert list(sub.elements.index) == [3, 4, 5]
+    sub = reader.load_data(*files, nodes=[1, 2, 4, 5, 8])
+    assert list(sub.elements.index) == [1, 3]
+    # heads of the subset nodes only
+    times, heads = small_heads(nnodes=9)
+    file = str(tmp_path / 'GW_HeadAll.out')
+    write_gwhead(file, times, heads)
+    full = reader.load_gwh(file, nlayers=3)
+    for kwargs in [{}, {'node_major': True}, {'lazy': True}]:
+        dfgwh = reader.load_gwh(file, nlayers=3, nodes=sub.nodes.index, **kwargs)
+        assert list(dfgwh[1].columns) == ['1', '2', '4', '5', '8']
+        expected = full[1].loc[:, ['1', '2', '4', '5', '8']].values
+        assert np.array_equal(dfgwh[1].loc[:, :].values, expected)
+    reader.cache.remove_manifest(reader.gwh_cube_filename(file))
+    dfgwh = reader.load_gwh(file, nlayers=3, nodes=[9, 3], start=times[1])
+    pd_columns = list(dfgwh[2].columns)
+    assert pd_columns == ['9', '3'] and len(dfgwh[2]) == len(times) - 1
+    import pytest
+    with pytest.raises(KeyError):
+        reader.load_gwh(file, nlayers=3, nodes=[1, 10], start=times[1])
+    with pytest.raises(KeyError):
+        reader.load_gwh(file, nlayers=3, nodes=[1, 10])
+
+
+def test_rebuild_keeps_mapped_cube(tmp_path):
+    import numpy as np
+    times, heads = small_heads()
+    file = str(tmp_path / 'GW_HeadAll.out')
+    write_gwhead(file, times, heads)
+    cube = reader.ensure_gwh_cube(file, nlayers=3, node_major=True)
+    write_gwhead(file, times, heads + 1000)  # re-run while the old cube is mapped
+    rebuilt = reader.ensure_gwh_cube(file, nlayers=3, node_major=True)
+    assert np.allclose(cube.data, heads) and np.allclose(cube.node_data, heads.transpose(1, 2, 0))
+    assert np.allclose(rebuilt.data, heads + 1000)
+    assert not [f for f in tmp_path.iterdir() if f.name.endswith('.tmp')]
+
+
+def test_gwh_levels(tmp_path):
+    import numpy as np
+    import pandas as pd
+    times = pd.date_range('1921-10-31', periods=25 * 12 + 2, freq='ME')
+    heads = np.round(np.random.default_rng(0).normal(size=(len(times), 2, 4)), 4)
+    file = str(tmp_path / 'GW_HeadAll.out')
+    write_gwhead(file, times, heads)
+    monthly = reader.load_gwh(file, nlayers=2)[1]
+    wy_max = reader.load_gwh(file, nlayers=2, resolution='water_year', how='max')[1]
+    expected = monthly.groupby(reader.water_years(times)).max()
+    assert np.allclose(wy_max.values, expected.values)
+    assert wy_max.index[0] == pd.Timestamp('1922-09-30') and len(wy_max) == 26
+    decade = reader.load_gwh(file, nlayers=2, resolution='decade', lazy=True)
+    expected = monthly.groupby(reader.water_years(times) // 10 * 10).mean()
+    assert np.allclose(decade[1].loc[:, :].values, expected.values, atol=1e-5)
+    assert list(decade[1].index.year) == [1929, 1939, 1946]
+    # no decade max, the coarsest level with a max is the water year
+    assert reader.gwh_level('decade', 'max') == ('water_year', 'max')
+    assert reader.gwh_level('month', 'max') == ('month', None)
+    decade_max = reader.load_gwh(file, nlayers=2, resolution='decade', how='max')[1]
+    pd.testing.assert_frame_equal(decade_max, wy_max)
+    # levels follow timesteps appended to the cube
+    write_gwhead(file, times.append(pd.date_range('1947-12-31', periods=12, freq='ME')),
+                 np.concatenate([heads, heads[:12] + 100]))
+    reader.update_gwh_cube(file, nlayers=2)
+    wy_max = reader.load_gwh(file, nlayers=2, resolution='water_year', how='max')[1]
+    assert len(wy_max) == 28 and wy_max.values.max() > 100
+
+
+def write_gwhyd(file, times, heads, layers):
+    '''write hydrographs (ntimes, nhyd) in the GW hydrograph output format'''
+    nhyd = heads.shape[1]
+    with open(file, 'w') as fh:
+        fh.write('*' * 40 + '\n*     GROUNDWATER HYDROGRAPH\n*     (UNIT=FEET)\n*\n')
+        for name, values in [('HYDROGRAPH ID', range(1, nhyd + 1)), ('LAYER', layers),
+                             ('NODE', [0] * nhyd), ('ELEMENT', range(101, 101 + nhyd))]:
+            fh.write('*%24s' % name + ''.join('%12d' % v for v in values) + '\n')
+        fh.write('*        TIME\n')
+        for t, step in zip(times, heads):
+            fh.write('%-22s' % t.strftime('%m/%d/%Y_24:00') + ''.join('%12.4f' % v for v in step)
+                     + '\n')
+
+
+def test_load_gwhyd(tmp_path):
+    import numpy as np
+    import pandas as pd
+    import pytest
+    times, heads = small_heads(ntimes=6, nlayers=1, nnodes=4)
+    file = str(tmp_path / 'GW_Hyd.out')
+    write_gwhyd(file, times, heads[:, 0, :], layers=[1, 1, 2, 3])
+    df = reader.read_gwhyd(file)
+    assert list(df.columns) == ['1', '2', '3', '4'] and (df.index == times).all()
+    assert np.allclose(df.values, heads[:, 0, :]) and df.attrs['layer'] == [1, 1, 2, 3]
+    dfhyd = pd.DataFrame({'iouthl': [1, 1, 2, 3], 'Calibration_ID': [11, 7, 25, 3]})
+    dfcal = reader.load_gwhyd(file, dfhyd)
+    assert list(dfcal.columns) == ['11', '7', '25', '3']
+    assert np.allclose(dfcal.values, heads[:, 0, :])
+    sub = reader.load_gwhyd(file, dfhyd, ids=[3, 7])
+    assert np.allclose(sub.values, heads[:, 0, [3, 1]]) and sub.attrs['element'] == [104, 102]
+    with pytest.raises(KeyError):
+        reader.load_gwhyd(file, dfhyd, ids=[5])
+    with pytest.raises(ValueError):
+        reader.load_gwhyd(file, dfhyd.iloc[:3])
+    # no timestep written yet
+    write_gwhyd(file, times[:0], heads[:0, 0, :], layers=[1, 1, 2, 3])
+    assert reader.load_gwhyd(file).shape == (0, 4)
@@ -0,0 +1,33 @@
+import numpy as np
+import pandas as pd
+
+from pyiwfm import obsreader, reader, synthetic
+
+
+def test_write_model(tmp_path):
+    model = synthetic.write_model(str(tmp_path), nnodes=40, nlayers=3, ntimes=14, nstations=5,
+                                  nmeasurements=4)
+    nx, ny = synthetic.grid_shape(40)
+    nodes = reader.read_nodes(model.nodes_file)
+    pd.testing.assert_frame_equal(nodes, synthetic.make_nodes(40), check_index_type=False,
+                                  check_names=False)
+    elements = reader.read_elements(model.elements_file)
+    ntri = (elements['4'] == 0).sum()
+    assert 0 < ntri < len(elements) and len(elements) == (nx - 1) * (ny - 1) + ntri // 2
+    assert set(elements['5']) == {1, 2}
+    strat = reader.read_stratigraphy(model.stratigraphy_file)
+    assert list(strat.columns) == ['GSE', 'A1', 'L1', 'A2', 'L2', 'A3', 'L3']
+    assert len(strat) == nx * ny
+    grid = reader.load_data(model.elements_file, model.nodes_file, model.stratigraphy_file)
+    assert grid.nlayers == 3
+    heads = reader.read_gwhead(model.head_file, 3)
+    assert (heads[0].index == model.times).all() and heads[2].shape == (14, nx * ny)
+    extent = synthetic.grid_extent(nodes)
+    expected = synthetic.head_field(nodes.x.values, nodes.y.values, extent, 5, layer=2)
+    assert np.allclose(heads[2].iloc[5].values, expected, atol=1e-4)
+    assert (heads[0].values < strat.GSE.values).all()
+    stations = obsreader.load_obs_stations(model.stations_file)
+    assert len(stations) == 5 and stations.crs == 'EPSG:26910'
+    measurements = obsreader.load_obs_measurements(model.measurements_file)
+    assert len(measurements) == 20 and not measurements.duplicated(['site_code', 'date']).any()
+    assert measurements.date.min() >= model.times[0] - pd.Timedelta(days=28)